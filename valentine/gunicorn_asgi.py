@@ -0,0 +1,21 @@
+"""
+gunicorn settings for the ASGI deployment:
+
+    gunicorn valentine.asgi:application -c gunicorn_asgi.py
+
+Each uvicorn worker runs an event loop, so one process serves many
+concurrent requests to the async views instead of one per sync worker.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'uvicorn_worker.UvicornWorker'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+# Recycle workers now and then to bound memory growth
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = '-'
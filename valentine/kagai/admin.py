@@ -1,30 +1,154 @@
+import sys
+
 from django.contrib import admin
-from .models import UserProfile, LoveNote, Connection, Favorite
+from django.contrib.auth.models import User
+from django.db.models import Q
+from . import exports
+from .models import UserProfile, LoveNote, Connection, Favorite, UserStats, Interest, ImageJob, Notification
+from .pagination import EstimatedCountPaginator
+from .search import get_search_backend
+
+def prefix_filter(model, path, term):
+    """
+    ``Q`` on ``model`` for rows whose ``path`` starts with ``term``
+    (case-sensitive). The prefix becomes a range that a plain B-tree index
+    answers, unlike ``LIKE``. A relation in ``path`` becomes ``IN`` over the
+    related table, so the outer query seeks its foreign key index.
+    """
+    name, _, rest = path.partition('__')
+    if rest:
+        related = model._meta.get_field(name).related_model
+        return Q(**{f'{name}__in': related.objects.filter(prefix_filter(related, rest, term)).values('pk')})
+    if term[-1] == chr(sys.maxunicode):
+        # No character sorts after the last one to bound the range with
+        return Q(**{f'{name}__startswith': term})
+    upper = term[:-1] + chr(ord(term[-1]) + 1)
+    return Q(**{f'{name}__gte': term, f'{name}__lt': upper})
+
+class IndexedSearchMixin:
+    """
+    Admin search that stays on indexes. Every ``^`` field in
+    ``search_fields`` is matched by prefix with ``prefix_filter``, and
+    ``full_text_filter`` can add matches from the search backend. Admin search
+    would otherwise run ``icontains`` on every field, a full scan per term.
+    """
+    search_help_text = 'Usernames match by their start, case-sensitively'
+
+    def full_text_filter(self, term):
+        """A ``Q`` for rows the search backend finds for ``term``, or None"""
+        return None
+
+    def get_search_results(self, request, queryset, search_term):
+        for term in search_term.split():
+            q = Q()
+            for field in self.get_search_fields(request):
+                q |= prefix_filter(self.model, field.removeprefix('^'), term)
+            full_text = self.full_text_filter(term)
+            if full_text is not None:
+                q |= full_text
+            queryset = queryset.filter(q)
+        # IN subqueries never repeat a row
+        return queryset, False
+
+class BigTableAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    """
+    Changelists that stay fast at millions of rows: estimated counts instead
+    of COUNT(*), no second count of the unfiltered table, newest first by
+    primary key (no sort), related objects joined in, and ids instead of
+    select boxes listing every user.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ['-pk']
 
 @admin.register(UserProfile)
-class UserProfileAdmin(admin.ModelAdmin):
+class UserProfileAdmin(BigTableAdmin):
     list_display = ['user', 'location', 'is_verified', 'created_at']
     list_filter = ['is_verified', 'gender', 'created_at']
-    search_fields = ['user__username', 'location', 'bio']
+    list_select_related = ['user']
+    search_fields = ['^user__username']
+    search_help_text = 'Usernames by their start; names, bio, location and interests by word'
+    raw_id_fields = ['user']
     readonly_fields = ['created_at', 'updated_at']
 
+    def full_text_filter(self, term):
+        return Q(user__in=User.objects.filter(get_search_backend().user_filter(term)).values('pk'))
+
 @admin.register(LoveNote)
-class LoveNoteAdmin(admin.ModelAdmin):
+class LoveNoteAdmin(BigTableAdmin):
     list_display = ['sender', 'recipient', 'status', 'is_anonymous', 'created_at']
     list_filter = ['status', 'is_anonymous', 'created_at']
-    search_fields = ['sender__username', 'recipient__username', 'content']
+    list_select_related = ['sender', 'recipient']
+    search_fields = ['^sender__username', '^recipient__username']
+    search_help_text = 'Sender or recipient usernames by their start; title and content by word'
+    raw_id_fields = ['sender', 'recipient']
     readonly_fields = ['created_at', 'sent_at', 'opened_at']
+    # "Select all" then an export action streams every matching note
+    actions = ['export_jsonl', 'export_csv']
+
+    def full_text_filter(self, term):
+        return get_search_backend().note_filter(term)
+
+    def _export(self, request, queryset, fmt):
+        fields, rows = exports.admin_notes(queryset)
+        return exports.response(request, 'kagai-notes', fields, rows, fmt, compress=True)
+
+    @admin.action(description='Export selected notes as JSON Lines (gzipped)')
+    def export_jsonl(self, request, queryset):
+        return self._export(request, queryset, 'jsonl')
+
+    @admin.action(description='Export selected notes as CSV (gzipped)')
+    def export_csv(self, request, queryset):
+        return self._export(request, queryset, 'csv')
 
 @admin.register(Connection)
-class ConnectionAdmin(admin.ModelAdmin):
+class ConnectionAdmin(BigTableAdmin):
     list_display = ['user1', 'user2', 'status', 'created_at']
     list_filter = ['status', 'created_at']
-    search_fields = ['user1__username', 'user2__username']
+    list_select_related = ['user1', 'user2']
+    search_fields = ['^user1__username', '^user2__username']
+    raw_id_fields = ['user1', 'user2']
     readonly_fields = ['created_at', 'updated_at']
 
 @admin.register(Favorite)
-class FavoriteAdmin(admin.ModelAdmin):
+class FavoriteAdmin(BigTableAdmin):
     list_display = ['user', 'note', 'created_at']
     list_filter = ['created_at']
-    search_fields = ['user__username']
+    # The note's name shows its sender and recipient
+    list_select_related = ['user', 'note__sender', 'note__recipient']
+    search_fields = ['^user__username']
+    raw_id_fields = ['user', 'note']
+    readonly_fields = ['created_at']
+
+@admin.register(UserStats)
+class UserStatsAdmin(BigTableAdmin):
+    list_display = ['user', 'sent_notes', 'received_notes', 'connections', 'pending_requests', 'updated_at']
+    list_select_related = ['user']
+    search_fields = ['^user__username']
+    raw_id_fields = ['user']
+    readonly_fields = ['updated_at']
+
+@admin.register(Interest)
+class InterestAdmin(admin.ModelAdmin):
+    list_display = ['name', 'slug', 'created_at']
+    search_fields = ['name', 'slug']
     readonly_fields = ['created_at']
+
+@admin.register(ImageJob)
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ['profile', 'source', 'status', 'attempts', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    list_select_related = ['profile__user']
+    search_fields = ['profile__user__username', 'source']
+    raw_id_fields = ['profile']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
+
+@admin.register(Notification)
+class NotificationAdmin(BigTableAdmin):
+    list_display = ['user', 'kind', 'actor', 'is_read', 'created_at']
+    list_filter = ['kind', 'is_read', 'created_at']
+    list_select_related = ['user', 'actor']
+    search_fields = ['^user__username', '^actor__username']
+    raw_id_fields = ['user', 'actor', 'note', 'connection']
+    # is_read feeds UserStats.unread_notifications; only the app changes it
+    readonly_fields = ['is_read', 'created_at', 'read_at']
@@ -0,0 +1,557 @@
+"""
+Front-end asset pipeline, run by the ``build_assets`` management command.
+
+Bootstrap and Font Awesome are vendored into ``KAGAI_ASSETS['VENDOR_DIR']``
+(fetched once from the CDNs pinned in ``VENDOR``, checked against their
+integrity hashes) and combined with the app's own stylesheets and scripts
+into the bundles listed in ``BUNDLES``.
+The build writes to ``KAGAI_ASSETS['OUTPUT_DIR']`` (``static/dist``):
+
+* one minified CSS and one JS file per bundle;
+* the Font Awesome rules and font files cut down to the icons the
+  templates and scripts actually use (the fonts are subset with fontTools
+  when it is installed, ``pip install fonttools brotli``);
+* a critical stylesheet per bundle holding only the rules that match the
+  page shell, which ``{% asset_styles %}`` inlines while the full
+  stylesheet loads without blocking rendering;
+* responsive AVIF/WebP/JPEG derivatives of ``static/images`` (one set per
+  distinct file), used by ``{% picture %}`` and swapped in for CSS
+  background images;
+* ``assets.json``, listing the files of each bundle and the icon fonts its
+  page shell needs, which are preloaded, and the image derivatives.
+
+``collectstatic`` then fingerprints the output through
+``kagai.storage.StaticFilesStorage`` and WhiteNoise serves it compressed
+and cached as immutable. Until ``build_assets`` has run, the template tags
+fall back to the CDN and the unbundled source files.
+"""
+import base64
+import hashlib
+import json
+import posixpath
+import re
+import shutil
+import urllib.request
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.templatetags.static import static
+
+from .images import MIME_TYPES, build_image_derivatives
+
+DEFAULTS = {
+    'VENDOR_DIR': None,
+    'OUTPUT_DIR': None,
+    # Directories scanned for the Font Awesome icons in use
+    'ICON_SOURCES': [],
+}
+
+FONT_AWESOME = 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0'
+
+# A pinned download and its Subresource Integrity hash, the format the
+# CDNs publish, which the download must match
+Vendored = namedtuple('Vendored', ['url', 'integrity'])
+
+# Vendored file -> pinned download
+VENDOR = {
+    'bootstrap.min.css': Vendored(
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+        'sha384-9ndCyUaIbzAi2FUVXJi0CjmCapSmO7SnpJef0486qhLnuZ2cdeRhO02iuK6FUUVM',
+    ),
+    'bootstrap.bundle.min.js': Vendored(
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+        'sha384-geWF76RCwLtnZ8qwWowPQNguL3RmwHVBC9FhGdlKrxdiJJigb/j/68SIy3Te4Bkz',
+    ),
+    'fontawesome.min.css': Vendored(
+        f'{FONT_AWESOME}/css/all.min.css',
+        'sha512-iecdLmaskl7CVkqkXNQ/ZH/XLlvWZOJyj7Yy7tcenmpD1ypASozpmT/E0iPtmFIB46ZmdtAc9eNBvH0H/ZpiBw==',
+    ),
+    'webfonts/fa-solid-900.woff2': Vendored(
+        f'{FONT_AWESOME}/webfonts/fa-solid-900.woff2',
+        'sha512-DM3BUVUQ2QLAtKSLhjxIuthuH3ZrH5yJCmTijZHufG1IgkHFMfwJTRWynCEdpx4JJYeph+JO6OZ++OqZwoToIQ==',
+    ),
+    'webfonts/fa-brands-400.woff2': Vendored(
+        f'{FONT_AWESOME}/webfonts/fa-brands-400.woff2',
+        'sha512-07R5G5iPz9mRGiFYFj0MRNZ5dlCJC11Kx2lBfgnY/Cxn7cWVvo55J94FGahe6zV30Mfjhb3JnXYsemz7rQIbOQ==',
+    ),
+}
+
+# Font Awesome style class -> (font family, weight, vendored font)
+ICON_FONTS = {
+    'solid': ('Font Awesome 6 Free', 900, 'webfonts/fa-solid-900.woff2'),
+    'brands': ('Font Awesome 6 Brands', 400, 'webfonts/fa-brands-400.woff2'),
+}
+ICON_STYLE_CLASSES = {
+    'fa': 'solid', 'fas': 'solid', 'fa-solid': 'solid',
+    'fab': 'brands', 'fa-brands': 'brands',
+}
+
+# Sources are static paths, ``vendor:<file>`` or ``icons`` (the Font
+# Awesome subset). ``critical`` lists the templates making up the page
+# shell whose rules are inlined.
+BUNDLES = {
+    'app': {
+        'css': ['vendor:bootstrap.min.css', 'icons', 'css/style.css'],
+        'js': ['vendor:bootstrap.bundle.min.js', 'js/main.js'],
+        'critical': ['base.html', 'includes/navbar.html'],
+    },
+    'proposal': {
+        'css': ['css/valentine_proposal.css'],
+        'js': ['js/valentine_proposal.js'],
+    },
+}
+
+MANIFEST = 'assets.json'
+DIST = 'dist'
+IMAGE_DIR = 'images'
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp')
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+SOURCE_MAP_RE = re.compile(r'^\s*(//|/\*)# sourceMappingURL=.*$', re.M)
+URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+ICON_RULE_RE = re.compile(r'^\.(fa-[a-z0-9-]+)::?before$')
+ICON_CLASS_RE = re.compile(r'\bfa-[a-z0-9-]+\b')
+CONTENT_RE = re.compile(r'content:\s*"\\([0-9a-f]+)"')
+CLASS_ATTR_RE = re.compile(r'class="([^"]*)"')
+ID_ATTR_RE = re.compile(r'id="([^"{]*)"')
+TAG_RE = re.compile(r'<([a-z][a-z0-9]*)')
+BACKGROUND_RE = re.compile(r'(?<=[{;])(background(?:-image)?):([^;{}]*)url\("([^"]+)"\)([^;{}]*)')
+SELECTOR_TOKEN_RE = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*)|\[[^\]]*\]|::?[\w-]+(\([^)]*\))?|\*')
+
+
+class AssetError(Exception):
+    pass
+
+
+def config(name):
+    value = getattr(settings, 'KAGAI_ASSETS', {}).get(name, DEFAULTS[name])
+    return Path(value) if name.endswith('_DIR') and value is not None else value
+
+
+# ==================== CSS ====================
+
+def parse_css(css):
+    """
+    Split a stylesheet into top-level ``(prelude, body)`` pairs. Nested
+    at-rules such as ``@media`` keep their body as a string; parse it again
+    to get at the rules inside.
+    """
+    rules = []
+    depth, start, prelude_end, quote = 0, 0, None, None
+    i = 0
+    while i < len(css):
+        char = css[i]
+        if quote:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            if depth == 0:
+                prelude_end = i
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append((css[start:prelude_end].strip(), css[prelude_end + 1:i]))
+                start = i + 1
+        elif char == ';' and depth == 0:
+            # Body-less at-rules such as @charset and @import
+            rules.append((css[start:i].strip(), None))
+            start = i + 1
+        i += 1
+    return rules
+
+
+def serialize_css(rules):
+    return ''.join(f'{prelude};' if body is None else f'{prelude}{{{body}}}' for prelude, body in rules)
+
+
+def minify_css(css):
+    """Strip comments and insignificant whitespace"""
+    css = COMMENT_RE.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def rebase_urls(css, source, target):
+    """Rewrite relative ``url()``s in ``source`` (a static path) for ``target``"""
+    source_dir, target_dir = posixpath.dirname(source), posixpath.dirname(target)
+
+    def rebase(match):
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(source_dir, url))
+        return f'url("{posixpath.relpath(path, target_dir or ".")}")'
+
+    return URL_RE.sub(rebase, css)
+
+
+def responsive_backgrounds(css, target, derivatives):
+    """
+    Swap background images in ``css`` (written to the static path ``target``)
+    for their derivatives: a JPEG declaration for browsers without
+    ``image-set()``, followed by one that also offers AVIF and WebP.
+    ``derivatives(path)`` maps a static path to ``{format: path}`` or None.
+    """
+    target_dir = posixpath.dirname(target)
+
+    def replace(match):
+        prop, before, url, after = match.groups()
+        found = None if re.match(r'^([a-z]+:|/)', url) else derivatives(
+            posixpath.normpath(posixpath.join(target_dir, url))
+        )
+        if not found:
+            return match.group(0)
+        relative = {fmt: posixpath.relpath(path, target_dir) for fmt, path in found.items()}
+        image_set = ','.join(f'url("{path}") type("{MIME_TYPES[fmt]}")' for fmt, path in relative.items())
+        return f'{prop}:{before}url("{relative["jpeg"]}"){after};{prop}:{before}image-set({image_set}){after}'
+
+    return BACKGROUND_RE.sub(replace, css)
+
+
+def template_tokens(names):
+    """Classes, ids and tag names used in the given templates"""
+    classes, ids, tags = set(), set(), {'html', 'body', 'head'}
+    for name in names:
+        source = Path(get_template(name).origin.name).read_text()
+        # Template tags inside attributes are not class names
+        source = re.sub(r'{%.*?%}|{{.*?}}', ' ', source)
+        for value in CLASS_ATTR_RE.findall(source):
+            classes.update(value.split())
+        ids.update(ID_ATTR_RE.findall(source))
+        tags.update(TAG_RE.findall(source))
+    return classes, ids, tags
+
+
+def _selector_matches(selector, classes, ids, tags):
+    for match in SELECTOR_TOKEN_RE.finditer(selector):
+        prefix, name = match.group(1), match.group(2)
+        if name is None:
+            # Attribute selectors, pseudo-classes and * are not checked
+            continue
+        if prefix == '.' and name not in classes:
+            return False
+        if prefix == '#' and name not in ids:
+            return False
+        if not prefix and name.lower() not in tags:
+            return False
+    return True
+
+
+def critical_css(css, classes, ids, tags):
+    """
+    The rules of ``css`` that can apply to markup made only of ``classes``,
+    ``ids`` and ``tags``. ``:root`` custom properties are always kept;
+    fonts and keyframes load with the full stylesheet.
+    """
+    kept = []
+    for prelude, body in parse_css(css):
+        if body is None or prelude.startswith(('@font-face', '@keyframes', '@-webkit-keyframes')):
+            continue
+        if prelude.startswith(('@media', '@supports', '@layer')):
+            inner = critical_css(body, classes, ids, tags)
+            if inner:
+                kept.append((prelude, inner))
+        elif prelude.startswith('@'):
+            continue
+        else:
+            selectors = [
+                selector for selector in prelude.split(',')
+                if selector.strip().startswith(':root') or _selector_matches(selector.strip(), classes, ids, tags)
+            ]
+            if selectors:
+                kept.append((','.join(selectors), body))
+    return serialize_css(kept)
+
+
+# ==================== Icons ====================
+
+def used_icons(directories):
+    """Font Awesome icon and style classes mentioned in templates and scripts"""
+    icons, styles = set(), set()
+    for directory in directories:
+        for path in Path(directory).rglob('*'):
+            if path.suffix not in ('.html', '.js') or DIST in path.parts:
+                continue
+            text = path.read_text(errors='ignore')
+            icons.update(ICON_CLASS_RE.findall(text))
+            for name, style in ICON_STYLE_CLASSES.items():
+                if re.search(rf'["\'\s]{name}\s', text):
+                    styles.add(style)
+    return icons, styles
+
+
+def icon_css(css, icons):
+    """
+    Cut the Font Awesome stylesheet down to ``icons``: unused icon rules and
+    every ``@font-face`` (``build_icons`` writes its own) are dropped.
+    Returns the CSS and the code points the remaining icons need.
+    """
+    kept, codepoints = [], set()
+    for prelude, body in parse_css(css):
+        if prelude.startswith('@font-face'):
+            continue
+        selectors = [selector.strip() for selector in prelude.split(',')]
+        if body is not None and all(ICON_RULE_RE.match(selector) for selector in selectors):
+            selectors = [s for s in selectors if ICON_RULE_RE.match(s).group(1) in icons]
+            if not selectors:
+                continue
+            codepoints.update(int(point, 16) for point in CONTENT_RE.findall(body))
+            prelude = ','.join(selectors)
+        kept.append((prelude, body))
+    return serialize_css(kept), codepoints
+
+
+def subset_font(source, target, codepoints, log=None):
+    """
+    Write ``source`` reduced to ``codepoints``. When fontTools is missing or
+    cannot read the font, the file is copied unchanged and False returned.
+    """
+    log = log or (lambda message: None)
+    try:
+        from fontTools import subset
+    except ImportError:
+        log(f'  fontTools is not installed; copied {source.name} without subsetting')
+        shutil.copyfile(source, target)
+        return False
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    try:
+        font = subset.load_font(str(source), options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=codepoints)
+        subsetter.subset(font)
+        subset.save_font(font, str(target), options)
+    # fontTools raises TTLibError for most bad input, but truncated tables
+    # surface as struct, key or assertion errors from the table parsers
+    except Exception as exc:
+        log(f'  Could not subset {source.name} ({exc}); copied it without subsetting')
+        shutil.copyfile(source, target)
+        return False
+    return True
+
+
+# ==================== Build ====================
+
+def integrity(data, algorithm):
+    """The Subresource Integrity hash of ``data``, e.g. ``sha384-...``"""
+    digest = hashlib.new(algorithm, data).digest()
+    return f'{algorithm}-{base64.b64encode(digest).decode()}'
+
+
+def fetch_vendor(vendor_dir, force=False, log=None):
+    """
+    Download missing vendored files; returns the names fetched. Raises
+    AssetError, before writing it, for a download that does not match its
+    pinned hash.
+    """
+    log = log or (lambda message: None)
+    fetched = []
+    for name, vendored in VENDOR.items():
+        path = vendor_dir / name
+        if path.exists() and not force:
+            continue
+        log(f'Fetching {vendored.url}')
+        with urllib.request.urlopen(vendored.url, timeout=30) as response:
+            data = response.read()
+        found = integrity(data, vendored.integrity.split('-', 1)[0])
+        if found != vendored.integrity:
+            raise AssetError(
+                f'{vendored.url} does not match its pinned hash: expected {vendored.integrity}, got {found}'
+            )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        fetched.append(name)
+    return fetched
+
+
+class Builder:
+    """Build every bundle from ``vendor_dir`` and ``static_dir`` into ``output_dir``"""
+
+    def __init__(self, vendor_dir, static_dir, output_dir, icon_sources, log=None):
+        self.vendor_dir = Path(vendor_dir)
+        self.static_dir = Path(static_dir)
+        self.output_dir = Path(output_dir)
+        self.icon_sources = icon_sources
+        self.log = log or (lambda message: None)
+        self.manifest = {'bundles': {}}
+        self._icons = None
+        # Icon style -> built font
+        self.fonts = {}
+
+    def read(self, source):
+        if source.startswith('vendor:'):
+            path = self.vendor_dir / source.split(':', 1)[1]
+        else:
+            path = self.static_dir / source
+        if not path.exists():
+            hint = ' (run build_assets without --offline)' if source.startswith('vendor:') else ''
+            raise AssetError(f'Missing asset source {path}{hint}')
+        # Source maps are not shipped, and collectstatic fails on dangling references
+        return SOURCE_MAP_RE.sub('', path.read_text())
+
+    def write(self, name, content):
+        path = self.output_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        self.log(f'  {DIST}/{name} ({path.stat().st_size / 1024:.1f} KB)')
+        return f'{DIST}/{name}'
+
+    def icons(self):
+        """The Font Awesome subset; built once and shared by every bundle"""
+        if self._icons is None:
+            icons, styles = used_icons(self.icon_sources)
+            css, codepoints = icon_css(self.read('vendor:fontawesome.min.css'), icons)
+            faces = []
+            for style in sorted(styles):
+                family, weight, font = ICON_FONTS[style]
+                target = f'fonts/{posixpath.basename(font)}'
+                (self.output_dir / 'fonts').mkdir(parents=True, exist_ok=True)
+                subset_font(self.vendor_dir / font, self.output_dir / target, codepoints, log=self.log)
+                self.fonts[style] = f'{DIST}/{target}'
+                faces.append(
+                    f'@font-face{{font-family:"{family}";font-style:normal;font-weight:{weight};'
+                    f'font-display:block;src:url("{target}") format("woff2")}}'
+                )
+            self.log(f'  {len(icons)} icons, {len(codepoints)} glyphs')
+            self._icons = ''.join(faces) + css
+        return self._icons
+
+    def build_css(self, bundle, sources):
+        target = f'{bundle}.css'
+        parts = []
+        for source in sources:
+            if source == 'icons':
+                parts.append(self.icons())
+            else:
+                css = self.read(source)
+                if source.startswith('vendor:'):
+                    parts.append(css)
+                    continue
+                css = minify_css(rebase_urls(css, source, f'{DIST}/{target}'))
+                parts.append(responsive_backgrounds(css, f'{DIST}/{target}', self.background_image))
+        return target, '\n'.join(parts)
+
+    def build_js(self, bundle, sources):
+        try:
+            from rjsmin import jsmin
+        except ImportError:
+            jsmin = None
+        parts = []
+        for source in sources:
+            js = self.read(source).strip()
+            if jsmin is not None and not source.startswith('vendor:'):
+                js = jsmin(js)
+            # Guard against files that omit their final semicolon
+            parts.append(js.rstrip(';') + ';')
+        return f'{bundle}.js', '\n'.join(parts)
+
+    def build_images(self):
+        """Derivatives of every image under static/images, built once per distinct file"""
+        self.log('Images')
+        images, sets = {}, {}
+        for path in sorted((self.static_dir / IMAGE_DIR).rglob('*')):
+            if path.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            name = path.relative_to(self.static_dir).as_posix()
+            data = path.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()[:16]
+            if digest in sets:
+                duplicate = next(other for other, known in images.items() if known == digest)
+                self.log(f'  {name}: same file as {duplicate}, reusing its derivatives')
+            else:
+                sets[digest] = build_image_derivatives(data, self.output_dir / IMAGE_DIR, f'{DIST}/{IMAGE_DIR}')
+                files = [path for variants in sets[digest]['variants'].values() for _, path in variants]
+                size = sum((self.output_dir / IMAGE_DIR / posixpath.basename(path)).stat().st_size for path in files)
+                self.log(f'  {name}: {len(files)} files ({size / 1024:.1f} KB)')
+            images[name] = digest
+        self.manifest['images'] = images
+        self.manifest['image_sets'] = sets
+
+    def background_image(self, path):
+        """The widest derivative of a static image in each format, for CSS backgrounds"""
+        digest = self.manifest['images'].get(path)
+        if digest is None:
+            return None
+        return {fmt: files[-1][1] for fmt, files in self.manifest['image_sets'][digest]['variants'].items()}
+
+    def build(self):
+        if self.output_dir.exists():
+            shutil.rmtree(self.output_dir)
+        self.output_dir.mkdir(parents=True)
+        self.build_images()
+
+        for bundle, spec in BUNDLES.items():
+            self.log(f'Bundle "{bundle}"')
+            entry = {}
+            if spec.get('css'):
+                target, css = self.build_css(bundle, spec['css'])
+                entry['css'] = self.write(target, css)
+                if spec.get('critical'):
+                    classes, ids, tags = template_tokens(spec['critical'])
+                    entry['critical'] = self.write(f'{bundle}.critical.css', critical_css(css, classes, ids, tags))
+                    styles = {ICON_STYLE_CLASSES[name] for name in classes if name in ICON_STYLE_CLASSES}
+                    entry['preload'] = [
+                        {'path': self.fonts[style], 'as': 'font', 'type': 'font/woff2'}
+                        for style in sorted(styles) if style in self.fonts
+                    ]
+            if spec.get('js'):
+                target, js = self.build_js(bundle, spec['js'])
+                entry['js'] = self.write(target, js)
+            self.manifest['bundles'][bundle] = entry
+
+        self.write(MANIFEST, json.dumps(self.manifest, indent=2))
+        load_manifest.cache_clear()
+        return self.manifest
+
+
+# ==================== Runtime ====================
+
+@lru_cache(maxsize=None)
+def load_manifest():
+    """The manifest written by the last build, or None before the first one"""
+    output_dir = config('OUTPUT_DIR')
+    path = output_dir / MANIFEST if output_dir else None
+    if path is None or not path.exists():
+        return None
+    manifest = json.loads(path.read_text())
+    # Critical CSS is inlined into every page; read it once per process
+    for entry in manifest['bundles'].values():
+        if 'critical' in entry:
+            css = (output_dir / Path(entry['critical']).relative_to(DIST)).read_text()
+            entry['critical_css'] = _static_urls(css, entry['critical'])
+    return manifest
+
+
+def _static_urls(css, path):
+    """Point relative ``url()``s of the static file ``path`` at their (fingerprinted) static URLs"""
+    def absolute(match):
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+        return f'url("{static(posixpath.normpath(posixpath.join(posixpath.dirname(path), url)))}")'
+
+    return URL_RE.sub(absolute, css)
+
+
+def fallback_sources(bundle, kind):
+    """URLs or static paths to load ``bundle`` from before it has been built"""
+    sources = []
+    for source in BUNDLES[bundle].get(kind, []):
+        if source == 'icons':
+            sources.append(VENDOR['fontawesome.min.css'].url)
+        elif source.startswith('vendor:'):
+            sources.append(VENDOR[source.split(':', 1)[1]].url)
+        else:
+            sources.append(source)
+    return sources
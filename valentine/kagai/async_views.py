@@ -0,0 +1,285 @@
+"""
+Async versions of the read-heavy kagai views, served when
+``KAGAI_ASYNC_VIEWS`` is enabled (the ASGI profile in ``valentine/asgi.py``).
+
+They mirror the views in ``kagai.views`` but load everything with the async
+ORM, so a worker keeps serving other requests while one waits on the
+database. Queries are awaited one after another: the async ORM hands each
+one to the request's single sync thread (``sync_to_async`` is thread
+sensitive by default), so gathering them would not overlap them. All data a
+template touches is loaded before rendering: lazy relations would raise
+``SynchronousOnlyOperation`` inside the event loop.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from . import events as kagai_events, graph, views
+from .conditional import conditional_page
+from .models import UserProfile, LoveNote, Connection, UserStats, UserInterest
+from .pagination import InvalidCursor, KeysetPaginator, aranked_page
+from .routers import read_from_replica
+from .search import get_search_backend
+
+
+async def _auser(request):
+    """Resolve the user once and pin it, so templates never load it synchronously"""
+    user = await request.auser()
+    request.user = user
+    return user
+
+
+async def _astats(request, user):
+    """
+    Load the user's stats for the page and the navbar's unread badge; the
+    template cannot fetch them lazily inside the event loop.
+    """
+    # Already loaded when the ETag was computed
+    if getattr(request, 'kagai_stats', None) is None:
+        request.kagai_stats = await UserStats.afor_user(user)
+    return request.kagai_stats
+
+
+async def _alist(queryset):
+    return [obj async for obj in queryset]
+
+
+# The backend may check the database the first time it is looked up, so
+# resolve it on the sync side too
+@sync_to_async
+def _search_notes(user, query, box, limit, offset):
+    return get_search_backend().search_notes(user, query, box=box, limit=limit, offset=offset)
+
+
+@sync_to_async
+def _search_users(query, exclude_id, gender, interest, limit, offset):
+    return get_search_backend().search_users(
+        query, exclude_id=exclude_id, gender=gender, interest=interest, limit=limit, offset=offset,
+    )
+
+
+# ==================== Dashboard & Main Views ====================
+
+@login_required(login_url='kagai:login')
+@conditional_page(views._dashboard_validators)
+async def dashboard(request):
+    """Main dashboard view"""
+    user = await _auser(request)
+
+    profile = await UserProfile.objects.aget(user=user)
+    stats = await _astats(request, user)
+    recent_received = await _alist(LoveNote.objects.for_inbox(user).filter(status='sent').order_by('-created_at')[:5])
+    suggestions = await sync_to_async(views._suggested_users)(user)
+
+    context = {
+        'profile': profile,
+        'stats': stats,
+        'recent_received': recent_received,
+        'suggestions': suggestions,
+    }
+    return render(request, 'dashboard.html', context)
+
+
+# ==================== Profile Views ====================
+
+@read_from_replica
+@login_required(login_url='kagai:login')
+@conditional_page(views._profile_validators)
+async def profile(request, username):
+    """View user profile"""
+    user = await _auser(request)
+    user_obj = await aget_object_or_404(User.objects.select_related('profile'), username=username)
+    profile = user_obj.profile
+
+    connection = await Connection.abetween(user, user_obj) if user.id != user_obj.id else None
+    interests = await _alist(profile.profile_interests.select_related('interest'))
+    # Only queries the database when the graph needs rebuilding
+    connection_graph = await sync_to_async(graph.get_graph)()
+    await _astats(request, user)
+    mutual = connection_graph.mutual(user.id, user_obj.id) if user.id != user_obj.id else []
+
+    context = {
+        'profile_user': user_obj,
+        'profile': profile,
+        'interests': sorted(interests, key=lambda tag: tag.position),
+        'connection': connection,
+        'is_friend': connection is not None and connection.status == 'accepted',
+        'is_pending': connection is not None and connection.status == 'pending',
+        'connection_count': connection_graph.degree(user_obj.id),
+        'mutual_count': len(mutual),
+        'mutual_connections': await _alist(User.objects.filter(pk__in=mutual[:3]).order_by('username')) if mutual else [],
+    }
+    return render(request, 'profile.html', context)
+
+
+# ==================== Love Notes Views ====================
+
+@login_required(login_url='kagai:login')
+@conditional_page(views._view_note_validators)
+async def view_note(request, note_id):
+    """View a specific love note"""
+    user = await _auser(request)
+    notes = LoveNote.objects.with_people().with_favorite(user)
+    note = await aget_object_or_404(notes, id=note_id)
+    await _astats(request, user)
+
+    if user.id not in (note.recipient_id, note.sender_id):
+        messages.error(request, 'You do not have permission to view this note')
+        return redirect('kagai:dashboard')
+
+    if user.id == note.recipient_id and note.status == 'sent':
+        await sync_to_async(views._mark_opened)(note)
+
+    context = {
+        'note': note,
+        'sender_profile': note.sender.profile if not note.is_anonymous else None,
+        'is_favorite': note.is_favorite,
+    }
+    return render(request, 'view_note.html', context)
+
+
+async def _notes_page(user, box, cursor=None, query=''):
+    """Async version of ``views._notes_page``"""
+    notes = views._notes_queryset(user, box)
+
+    if query:
+        async def search(limit, offset):
+            return await _search_notes(user, query, box, limit, offset)
+        return await aranked_page(search, notes, cursor, per_page=views.NOTES_PER_PAGE)
+
+    return await KeysetPaginator(notes, views.NOTE_ORDERING, per_page=views.NOTES_PER_PAGE).apage(cursor)
+
+
+@read_from_replica
+@login_required(login_url='kagai:login')
+@conditional_page(views._my_notes_validators)
+async def my_notes(request):
+    """View all user's notes"""
+    user = await _auser(request)
+    query = request.GET.get('q', '').strip()
+    received_cursor = request.GET.get('received', '')
+    sent_cursor = request.GET.get('sent', '')
+
+    try:
+        received_notes = await _notes_page(user, 'received', received_cursor, query)
+        sent_notes = await _notes_page(user, 'sent', sent_cursor, query)
+    except InvalidCursor:
+        messages.error(request, 'That page link is no longer valid')
+        return redirect('kagai:my_notes')
+    stats = await _astats(request, user)
+
+    context = {
+        'sent_notes': sent_notes,
+        'received_notes': received_notes,
+        'sent_cursor': sent_cursor,
+        'received_cursor': received_cursor,
+        'query': query,
+        'total_sent': stats.total_sent_notes,
+        'total_received': stats.total_received_notes,
+    }
+    return render(request, 'my_notes.html', context)
+
+
+# ==================== Browse & Discover ====================
+
+async def _browse_page(user, params, cursor=None):
+    """Async version of ``views._browse_page``"""
+    users = views._browse_queryset(user, params)
+    gender = params['gender'] if params['gender'] != 'all' else ''
+
+    if params['query']:
+        async def search(limit, offset):
+            return await _search_users(params['query'], user.id, gender, params['interest'], limit, offset)
+        return await aranked_page(search, users, cursor, per_page=views.USERS_PER_PAGE)
+
+    if gender:
+        users = users.filter(profile__gender=gender)
+
+    sort = params['sort']
+    if sort == 'recommended':
+        page = await KeysetPaginator(
+            views._with_recommendations(users, user), views.BROWSE_SORTS[sort], per_page=views.USERS_PER_PAGE
+        ).apage(cursor)
+        if page or cursor:
+            return page
+        sort = views.FALLBACK_BROWSE_SORT
+    elif sort == 'overlap':
+        mine = await _alist(
+            UserInterest.objects.filter(profile__user=user).values_list('interest_id', flat=True)
+        )
+        if mine:
+            users = views._with_overlap(users, mine)
+        else:
+            sort = views.FALLBACK_BROWSE_SORT
+
+    # Page links must carry the sort their cursor was made for
+    params['sort'] = sort
+    return await KeysetPaginator(users, views.BROWSE_SORTS[sort], per_page=views.USERS_PER_PAGE).apage(cursor)
+
+
+@read_from_replica
+@login_required(login_url='kagai:login')
+async def browse_users(request):
+    """Browse other users"""
+    user = await _auser(request)
+    params = views._browse_params(request)
+
+    try:
+        users = await _browse_page(user, params, request.GET.get('cursor'))
+    except InvalidCursor:
+        messages.error(request, 'That page link is no longer valid')
+        return redirect('kagai:browse_users')
+    await _astats(request, user)
+
+    context = {
+        'users': users,
+        'query': params['query'],
+        'gender': params['gender'],
+        'interest': params['interest'],
+        'sort': params['sort'],
+    }
+    return render(request, 'browse_users.html', context)
+
+
+# ==================== Live Events ====================
+
+async def _event_stream(user_id, last_event_id):
+    subscription = kagai_events.get_broker().subscribe(
+        user_id, last_event_id, heartbeat=kagai_events.config('HEARTBEAT')
+    )
+    deadline = time.monotonic() + kagai_events.config('MAX_AGE')
+    try:
+        yield 'retry: 5000\n\n'
+        async for event in subscription:
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield kagai_events.format_event(event)
+            if time.monotonic() > deadline:
+                break
+    finally:
+        subscription.close()
+
+
+@login_required(login_url='kagai:login')
+async def events(request):
+    """Stream the user's live notifications as Server-Sent Events"""
+    # Under WSGI the stream would be buffered and hold a sync worker for
+    # the whole MAX_AGE, so it only exists on the ASGI stack
+    if not kagai_events.config('ENABLED') or not isinstance(request, ASGIRequest):
+        raise Http404('Live events are not enabled')
+    user = await _auser(request)
+    response = StreamingHttpResponse(
+        _event_stream(user.id, request.headers.get('Last-Event-ID')),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx and similar proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
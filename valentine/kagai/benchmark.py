@@ -0,0 +1,383 @@
+"""
+Request benchmarks for every kagai URL.
+
+``run`` drives each route in ``ROUTES`` through the Django test client (or,
+with ``base_url``, a running server such as gunicorn) and reports latency
+percentiles, queries per request and memory use. Routes that write are
+wrapped in a transaction that is rolled back after every request, so the
+seeded data is the same for each sample.
+
+``run_sessions`` repeats the read routes once per session engine to compare
+the ``SESSION_PROFILES`` strategies.
+
+Use it through the ``benchmark`` management command, after seeding data with
+``seed_data``.
+"""
+import importlib
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from . import urls as kagai_urls
+from .models import LoveNote, Connection, Notification, UserStats
+from .querystats import QueryRecorder
+
+SERVER_TIMING_QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+
+class Route:
+    """One benchmarked request: a URL name plus how to build its arguments"""
+
+    def __init__(self, name, method='get', auth=True, writes=False, args=None, data=None, label=None,
+                 stream=False):
+        self.name = name
+        self.method = method
+        self.auth = auth
+        self.writes = writes
+        self.args = args or (lambda fixtures: [])
+        # A dict, or a callable taking the fixtures
+        self.data = data if callable(data) else (lambda fixtures: data or {})
+        self.label = label or name
+        # Streaming responses never finish; time until the headers arrive
+        self.stream = stream
+
+
+ROUTES = [
+    Route('home', auth=False),
+    Route('register', auth=False),
+    Route('login', auth=False),
+    Route('logout', writes=True),
+    Route('valentine_proposal', auth=False),
+    Route('dashboard'),
+    Route('edit_profile'),
+    Route('profile', args=lambda f: [f.other.username]),
+    Route('browse_users'),
+    Route('browse_users', label='browse_users (search)', data={'q': 'love'}),
+    Route('browse_users_json'),
+    Route('send_note', args=lambda f: [f.other.username]),
+    Route('send_note', method='post', writes=True, label='send_note (POST)',
+          args=lambda f: [f.other.username], data={'title': 'Hi', 'content': 'Benchmark note'}),
+    Route('view_note', args=lambda f: [f.note.pk]),
+    Route('toggle_favorite', method='post', writes=True, args=lambda f: [f.note.pk]),
+    Route('my_notes'),
+    Route('my_notes', label='my_notes (search)', data={'q': 'love'}),
+    Route('my_notes_json'),
+    Route('bulk_send_notes', method='post', writes=True,
+          data=lambda f: {'recipients': [f.other.username, f.stranger.username], 'content': 'Benchmark note'}),
+    Route('bulk_delete_notes', method='post', writes=True, data=lambda f: {'ids': [f.note.pk]}),
+    Route('bulk_favorite_notes', method='post', writes=True, data=lambda f: {'ids': [f.note.pk]}),
+    Route('notifications'),
+    Route('mark_notifications_read', method='post', writes=True,
+          data=lambda f: {'ids': f.unread_notifications()}),
+    Route('mark_all_notifications_read', method='post', writes=True),
+    Route('export_data', args=lambda f: ['notes']),
+    Route('export_data', label='export_data (connections, csv gzip)', args=lambda f: ['connections'],
+          data={'format': 'csv', 'gzip': '1'}),
+    Route('events', stream=True),
+    Route('send_connection_request', writes=True, args=lambda f: [f.stranger.username]),
+    Route('accept_connection', writes=True, args=lambda f: [f.incoming_request().pk]),
+    Route('reject_connection', writes=True, args=lambda f: [f.incoming_request().pk]),
+    Route('remove_connection', writes=True, args=lambda f: [f.incoming_request('accepted').pk]),
+]
+
+
+def missing_routes():
+    """URL names in kagai.urls without a benchmark route"""
+    names = {pattern.name for pattern in kagai_urls.urlpatterns}
+    return sorted(names - {route.name for route in ROUTES})
+
+
+class Fixtures:
+    """The user the benchmark logs in as and the objects its URLs point at"""
+
+    def __init__(self, username=None):
+        if username:
+            self.user = User.objects.get(username=username)
+        else:
+            # The busiest account makes for the most pessimistic listings
+            stats = UserStats.objects.select_related('user').order_by('-received_notes', 'user_id').first()
+            if stats is None:
+                raise User.DoesNotExist('No users to benchmark; run seed_data first')
+            self.user = stats.user
+
+        self.note = LoveNote.objects.for_inbox(self.user).order_by('-created_at').first()
+        if self.note is None:
+            raise LoveNote.DoesNotExist(f'{self.user.username} has not received any notes')
+        self.other = self.note.sender
+
+        connected = Connection.objects.filter(Q(user1=self.user) | Q(user2=self.user))
+        excluded = {self.user.pk}
+        for user1_id, user2_id in connected.values_list('user1_id', 'user2_id'):
+            excluded.update((user1_id, user2_id))
+        self.stranger = User.objects.exclude(pk__in=excluded).order_by('pk').first()
+        if self.stranger is None:
+            raise User.DoesNotExist(f'{self.user.username} is connected to everyone')
+
+    def incoming_request(self, status='pending'):
+        """A connection from a stranger to the user; only called inside a rolled back transaction"""
+        return Connection.objects.create(user1=self.stranger, user2=self.user, status=status)
+
+    def unread_notifications(self, count=10):
+        """Ids of fresh unread notifications; only called inside a rolled back transaction"""
+        return [
+            Notification.notify(self.user, 'favorite', actor=self.other, note=self.note).pk
+            for _ in range(count)
+        ]
+
+
+def percentile(samples, pct):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def rolled_back(enabled):
+    if not enabled:
+        yield
+        return
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+class ClientDriver:
+    """Send requests in-process through the Django test client"""
+    mode = 'client'
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.client = Client()
+        self.client.force_login(fixtures.user)
+        self.anonymous = Client()
+
+    def request(self, route, path, data):
+        client = self.client if route.auth else self.anonymous
+        recorder = QueryRecorder()
+        with recorder.record():
+            start = time.perf_counter()
+            response = getattr(client, route.method)(path, data)
+            if response.streaming and not route.stream:
+                # Downloads run their queries while the body is read
+                for _ in response:
+                    pass
+            elapsed = time.perf_counter() - start
+        response.close()
+        session_queries = sum(n for sql, n in recorder.fingerprints.items() if '"django_session"' in sql)
+        return response.status_code, elapsed, recorder.count, recorder.duration, session_queries
+
+    def reset(self, route):
+        """Undo side effects that a rolled back transaction does not cover"""
+        if route.name == 'logout':
+            self.client.force_login(self.fixtures.user)
+
+
+class HTTPDriver:
+    """
+    Send requests to a running server. Queries per request are read from the
+    Server-Timing header added by QueryStatsMiddleware when it is enabled.
+    Routes that write are skipped because they cannot be rolled back.
+    """
+    mode = 'http'
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, fixtures, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.session_key = self._login(fixtures.user)
+
+    def _login(self, user):
+        store = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.save()
+        return store.session_key
+
+    def request(self, route, path, data):
+        url = self.base_url + path
+        if data:
+            url += '?' + urllib.parse.urlencode(data)
+        request = urllib.request.Request(url)
+        if route.auth:
+            request.add_header('Cookie', f'{settings.SESSION_COOKIE_NAME}={self.session_key}')
+        opener = urllib.request.build_opener(self.NoRedirect)
+        start = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                if not route.stream:
+                    response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as exc:
+            status, headers = exc.code, exc.headers
+        elapsed = time.perf_counter() - start
+        match = SERVER_TIMING_QUERIES_RE.search(headers.get('Server-Timing', ''))
+        return status, elapsed, int(match.group(1)) if match else None, None, None
+
+    def reset(self, route):
+        pass
+
+
+def run(requests=50, warmup=5, username=None, base_url=None, routes=None, measure_memory=False, log=None):
+    """
+    Benchmark ``routes`` (default: all of ``ROUTES``) and return a JSON-ready
+    dict of per-route results plus metadata about the run.
+    """
+    log = log or (lambda message: None)
+    fixtures = Fixtures(username)
+    # DEBUG would make every cursor log its queries and skew the numbers
+    with override_settings(DEBUG=False, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        driver = HTTPDriver(fixtures, base_url) if base_url else ClientDriver(fixtures)
+        results = {}
+        for route in routes or ROUTES:
+            if route.writes and driver.mode == 'http':
+                log(f'{route.label:<32} skipped (writes)')
+                continue
+            if route.stream and driver.mode == 'client':
+                # The test client goes through WSGI, where streams are not served
+                log(f'{route.label:<32} skipped (needs ASGI)')
+                continue
+            results[route.label] = _run_route(driver, fixtures, route, requests, warmup, measure_memory)
+            result = results[route.label]
+            log(
+                f"{route.label:<32} {result['status']:>4} p50 {result['p50_ms']:8.2f}ms "
+                f"p95 {result['p95_ms']:8.2f}ms p99 {result['p99_ms']:8.2f}ms "
+                f"{result['queries'] if result['queries'] is not None else '-':>4} queries"
+            )
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'mode': driver.mode,
+            'base_url': base_url,
+            'user': fixtures.user.username,
+            'requests': requests,
+            'warmup': warmup,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'session_engine': settings.SESSION_ENGINE,
+            'rows': {
+                'users': User.objects.count(),
+                'notes': LoveNote.objects.count(),
+                'connections': Connection.objects.count(),
+            },
+        },
+        'routes': results,
+    }
+
+
+def _run_route(driver, fixtures, route, requests, warmup, measure_memory):
+    timings, queries, db_times, session_queries, statuses = [], [], [], [], set()
+    path = None
+    for i in range(warmup + requests):
+        with rolled_back(route.writes):
+            path = reverse(f'kagai:{route.name}', args=route.args(fixtures))
+            status, elapsed, count, db_time, sessions = driver.request(route, path, route.data(fixtures))
+        driver.reset(route)
+        statuses.add(status)
+        if i >= warmup:
+            timings.append(elapsed * 1000)
+            queries.append(count)
+            db_times.append(db_time)
+            session_queries.append(sessions)
+
+    peak_alloc_kb = None
+    if measure_memory and driver.mode == 'client':
+        # tracemalloc slows everything down, so measure in a separate request
+        tracemalloc.start()
+        with rolled_back(route.writes):
+            driver.request(route, reverse(f'kagai:{route.name}', args=route.args(fixtures)), route.data(fixtures))
+        driver.reset(route)
+        peak_alloc_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+
+    return {
+        'method': route.method.upper(),
+        'path': path,
+        'status': max(statuses),
+        'samples': len(timings),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': max(queries) if None not in queries else None,
+        'session_queries': max(session_queries) if None not in session_queries else None,
+        'db_ms': round(statistics.fmean(db_times) * 1000, 3) if None not in db_times else None,
+        'peak_rss_kb': peak_rss_kb() if driver.mode == 'client' else None,
+        'peak_alloc_kb': peak_alloc_kb,
+    }
+
+
+def run_sessions(engines=None, routes=None, **kwargs):
+    """
+    Run the authenticated read routes once per session engine and return
+    ``{strategy: run result}``. ``engines`` maps strategy names to engines
+    (default: ``settings.SESSION_PROFILES``); other arguments go to ``run``.
+    Writes are left out: they measure the rows they change, not sessions.
+    """
+    engines = engines or settings.SESSION_PROFILES
+    routes = [route for route in routes or ROUTES if route.auth and not route.writes and not route.stream]
+    results = {}
+    for name, engine in engines.items():
+        with override_settings(SESSION_ENGINE=engine):
+            results[name] = run(routes=routes, **kwargs)
+    return results
+
+
+def compare(baseline, current, max_regression=None):
+    """
+    Compare two ``run`` results. Returns ``(rows, regressions)`` where rows are
+    ``(label, old_p95, new_p95, change, old_queries, new_queries)`` and
+    regressions lists the labels whose p95 grew by more than
+    ``max_regression`` percent or which issue more queries than before.
+    """
+    rows, regressions = [], []
+    for label, new in current['routes'].items():
+        old = baseline.get('routes', {}).get(label)
+        if old is None:
+            continue
+        change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        rows.append((label, old['p95_ms'], new['p95_ms'], change, old['queries'], new['queries']))
+        more_queries = None not in (old['queries'], new['queries']) and new['queries'] > old['queries']
+        if more_queries or (max_regression is not None and change > max_regression):
+            regressions.append(label)
+    return rows, regressions
@@ -0,0 +1,113 @@
+"""
+Caching for the kagai app.
+
+Everything goes through ``get_or_set`` so each named cache records hit and
+miss counters (see the ``cache_stats`` command). Entries are invalidated
+explicitly by the signal handlers in ``kagai.signals``; timeouts only bound
+how stale relative timestamps ("5 minutes ago") can get.
+
+The cache alias and timeouts come from the ``KAGAI_CACHE`` setting.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+DEFAULTS = {
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+    'STATS': True,
+}
+
+GLOBAL_STATS = 'global_stats'
+USER_CARD = 'user_card'
+PROFILE_DETAILS = 'profile_details'
+DASHBOARD_STATS = 'dashboard_stats'
+DASHBOARD_NOTES = 'dashboard_notes'
+
+# Fragments that depend on one user's account and profile
+PROFILE_FRAGMENTS = (USER_CARD, PROFILE_DETAILS)
+# Fragments that depend on one user's notes and connections
+DASHBOARD_FRAGMENTS = (DASHBOARD_STATS, DASHBOARD_NOTES)
+
+STATS_PREFIX = 'kagai:cachestats'
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_CACHE', {}).get(name, DEFAULTS[name])
+
+
+def get_cache():
+    return caches[config('ALIAS')]
+
+
+def make_key(name, *parts):
+    return ':'.join(['kagai', name, *(str(part) for part in parts)])
+
+
+def _count(name, outcome):
+    if not config('STATS'):
+        return
+    cache = get_cache()
+    key = f'{STATS_PREFIX}:{name}:{outcome}'
+    # add() is a no-op when the counter exists; incr() then bumps it
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+
+
+def get_or_set(name, key, compute, timeout=None):
+    """Return the cached value for ``key``, computing and storing it on a miss"""
+    cache = get_cache()
+    value = cache.get(key)
+    if value is not None:
+        _count(name, 'hit')
+        return value
+    _count(name, 'miss')
+    value = compute()
+    cache.set(key, value, config('TIMEOUT') if timeout is None else timeout)
+    return value
+
+
+def invalidate(keys):
+    """Delete ``keys`` once the current transaction commits"""
+    keys = list(keys)
+    if keys:
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def invalidate_global_stats():
+    invalidate([make_key(GLOBAL_STATS)])
+
+
+def invalidate_profile(*user_ids):
+    invalidate(make_key(name, user_id) for user_id in user_ids for name in PROFILE_FRAGMENTS)
+
+
+def invalidate_dashboard(*user_ids):
+    invalidate(make_key(name, user_id) for user_id in user_ids for name in DASHBOARD_FRAGMENTS)
+
+
+def stats(names=None):
+    """Return ``{name: {'hit': n, 'miss': n, 'ratio': r}}`` for the named caches"""
+    names = names or [GLOBAL_STATS, *PROFILE_FRAGMENTS, *DASHBOARD_FRAGMENTS]
+    keys = {
+        f'{STATS_PREFIX}:{name}:{outcome}': (name, outcome)
+        for name in names for outcome in ('hit', 'miss')
+    }
+    values = get_cache().get_many(list(keys))
+    result = {name: {'hit': 0, 'miss': 0} for name in names}
+    for key, count in values.items():
+        name, outcome = keys[key]
+        result[name][outcome] = count
+    for counts in result.values():
+        total = counts['hit'] + counts['miss']
+        counts['ratio'] = counts['hit'] / total if total else None
+    return result
+
+
+def reset_stats(names=None):
+    names = names or [GLOBAL_STATS, *PROFILE_FRAGMENTS, *DASHBOARD_FRAGMENTS]
+    get_cache().delete_many([f'{STATS_PREFIX}:{name}:{outcome}' for name in names for outcome in ('hit', 'miss')])
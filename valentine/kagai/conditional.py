@@ -0,0 +1,113 @@
+"""
+HTTP conditional GET for the logged-in pages.
+
+Each page view gets a validator function that reads the state its HTML
+depends on with a few aggregate queries (timestamps, counts, ids) instead of
+loading rows and rendering. ``conditional_page`` turns that state into an
+ETag plus a Last-Modified from the newest timestamp. A matching
+``If-None-Match`` is answered with 304 Not Modified before the view runs. Pages
+are marked ``Cache-Control: private, no-cache`` so browsers and the CDN
+revalidate every time instead of reusing a copy blindly.
+
+The ETag also covers what base.html renders around every page: the viewer,
+their navbar counters, the asset bundles and ``KAGAI_CONDITIONAL['RELEASE']``.
+Set RELEASE per deploy so template changes do not hide behind 304s. Requests
+with flash messages waiting are always rendered.
+
+Last-Modified cannot see deletions. Clients sending If-None-Match, which
+every browser does, get exact answers.
+"""
+import functools
+import hashlib
+import json
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from django.utils.http import http_date
+
+from . import assets
+from .models import UserStats
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Identifies the deployed code, e.g. the git commit
+    'RELEASE': '',
+}
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_CONDITIONAL', {}).get(name, DEFAULTS[name])
+
+
+def latest(*timestamps):
+    """The newest of ``timestamps``, ignoring None"""
+    return max((timestamp for timestamp in timestamps if timestamp is not None), default=None)
+
+
+def _page_state(request):
+    """What base.html renders for the viewer, with their stats kept for the view"""
+    stats = getattr(request, 'kagai_stats', None) or UserStats.for_user(request.user)
+    request.kagai_stats = stats
+    manifest = assets.load_manifest()
+    return [
+        config('RELEASE'),
+        manifest and manifest.get('version', sorted(manifest['bundles'].items())),
+        request.user.pk,
+        [getattr(stats, field) for field in UserStats.COUNTERS],
+    ], stats.updated_at
+
+
+def _validate(validators, request, args, kwargs):
+    """Return ``(etag, last_modified)`` for the request, or Nones to serve it normally"""
+    if not config('ENABLED') or request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+        return None, None
+    result = validators(request, *args, **kwargs)
+    if result is None:
+        return None, None
+    last_modified, state = result
+    page_state, stats_updated = _page_state(request)
+    digest = hashlib.md5(json.dumps([page_state, state], default=str).encode(), usedforsecurity=False)
+    last_modified = latest(last_modified, stats_updated)
+    return quote_etag(digest.hexdigest()), last_modified and int(last_modified.timestamp())
+
+
+def _not_modified(request, etag, last_modified):
+    if etag is None:
+        return None
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def _finish(response, etag, last_modified):
+    if etag is None or response.status_code not in (200, 304):
+        return response
+    response.headers.setdefault('ETag', etag)
+    if last_modified:
+        response.headers.setdefault('Last-Modified', http_date(last_modified))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_page(validators):
+    """
+    Decorator answering conditional GETs for a page view. ``validators`` is
+    called like the view and returns ``(last_modified, state)``; ``state``
+    is anything JSON-serializable that changes whenever the page would. It
+    may return None to always render, e.g. for a 404 or a redirect.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                etag, last_modified = await sync_to_async(_validate)(validators, request, args, kwargs)
+                response = _not_modified(request, etag, last_modified) or await view(request, *args, **kwargs)
+                return _finish(response, etag, last_modified)
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                etag, last_modified = _validate(validators, request, args, kwargs)
+                response = _not_modified(request, etag, last_modified) or view(request, *args, **kwargs)
+                return _finish(response, etag, last_modified)
+        return wrapper
+    return decorator
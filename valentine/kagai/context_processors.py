@@ -0,0 +1,27 @@
+from django.urls import reverse
+from django.utils.functional import SimpleLazyObject
+
+from . import events
+from .models import UserStats
+
+
+def live_events(request):
+    """URL of the live notification stream for main.js, when it is enabled"""
+    user = getattr(request, 'user', None)
+    if events.config('ENABLED') and user is not None and user.is_authenticated:
+        return {'kagai_events_url': reverse('kagai:events')}
+    return {}
+
+
+def user_stats(request):
+    """
+    The user's stats row for the navbar's unread badge: one primary key
+    lookup, shared with views that already loaded it as ``request.kagai_stats``
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    stats = getattr(request, 'kagai_stats', None)
+    if stats is None:
+        stats = SimpleLazyObject(lambda: UserStats.for_user(user))
+    return {'kagai_stats': stats}
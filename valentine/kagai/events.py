@@ -0,0 +1,217 @@
+"""
+Live notification events, delivered to browsers as Server-Sent Events.
+
+Views call ``publish`` inside their transaction; the event goes to the
+broker once the transaction commits, and ``kagai.async_views.events``
+streams it to every page the recipient has open. Each event carries
+``deltas`` for the dashboard counters so pages update their badges without
+reloading.
+
+Brokers are pluggable through the ``KAGAI_EVENTS`` setting:
+
+* ``InProcessBroker`` hands events to subscribers in the same process. It
+  is enough for a single ASGI worker.
+* ``CacheBroker`` keeps a short per-user event log in the shared cache
+  (Redis in production) that subscribers poll. Events then reach
+  subscribers in any worker process, and clients that reconnect can resume
+  from ``Last-Event-ID``.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'BROKER': 'kagai.events.InProcessBroker',
+    # Seconds of silence before a keep-alive comment is sent
+    'HEARTBEAT': 15,
+    # Seconds before a stream is closed; EventSource reconnects by itself
+    'MAX_AGE': 300,
+    # CacheBroker: seconds between polls and how long events are kept
+    'POLL_INTERVAL': 1.0,
+    'RETENTION': 120,
+}
+
+# Most events a reconnecting CacheBroker subscriber is sent to catch up
+MAX_BACKLOG = 100
+
+Event = namedtuple('Event', 'id type data')
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_EVENTS', {}).get(name, DEFAULTS[name])
+
+
+def format_event(event):
+    """Serialize an event in the text/event-stream format"""
+    return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n'
+
+
+class Broker:
+    """Interface implemented by every event broker"""
+
+    def publish(self, user_id, event_type, data):
+        """Deliver an event to ``user_id``'s subscribers"""
+        raise NotImplementedError
+
+    def subscribe(self, user_id, last_event_id=None, heartbeat=15):
+        """
+        Return an async iterator over ``user_id``'s events. It yields ``None``
+        after ``heartbeat`` seconds without events; call ``close()`` when done.
+        """
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """Fan events out to asyncio queues of subscribers in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._ids = itertools.count(1)
+
+    def publish(self, user_id, event_type, data):
+        event = Event(str(next(self._ids)), event_type, data)
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        # Views publish from worker threads; the queues belong to event loops
+        for subscription in subscribers:
+            subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, event)
+
+    def subscribe(self, user_id, last_event_id=None, heartbeat=15):
+        return InProcessSubscription(self, user_id, heartbeat)
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscribers[subscription.user_id].add(subscription)
+
+    def _remove(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+
+class InProcessSubscription:
+    def __init__(self, broker, user_id, heartbeat):
+        self.broker = broker
+        self.user_id = user_id
+        self.heartbeat = heartbeat
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        broker._add(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await asyncio.wait_for(self.queue.get(), self.heartbeat)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker._remove(self)
+
+
+class CacheBroker(Broker):
+    """
+    Per-user event log in the shared cache. Needs a cache whose ``incr`` is
+    atomic across processes, such as Redis.
+    """
+
+    def _seq_key(self, user_id):
+        return cache.make_key('events', user_id, 'seq')
+
+    def _event_key(self, user_id, seq):
+        return cache.make_key('events', user_id, seq)
+
+    def publish(self, user_id, event_type, data):
+        store = cache.get_cache()
+        key = self._seq_key(user_id)
+        store.add(key, 0, timeout=None)
+        seq = store.incr(key)
+        store.set(self._event_key(user_id, seq), (event_type, data), config('RETENTION'))
+
+    def subscribe(self, user_id, last_event_id=None, heartbeat=15):
+        return CacheSubscription(self, user_id, last_event_id, heartbeat)
+
+
+class CacheSubscription:
+    def __init__(self, broker, user_id, last_event_id, heartbeat):
+        self.broker = broker
+        self.user_id = user_id
+        self.heartbeat = heartbeat
+        self.last_seq = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+        self.pending = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        store = cache.get_cache()
+        seq_key = self.broker._seq_key(self.user_id)
+        if self.last_seq is None:
+            # New subscribers start from now
+            self.last_seq = await store.aget(seq_key, 0)
+
+        deadline = time.monotonic() + self.heartbeat
+        while not self.pending:
+            current = await store.aget(seq_key, 0)
+            if current < self.last_seq:
+                # The counter was evicted or reset; start over from it
+                self.last_seq = current
+            if current > self.last_seq:
+                keys = {
+                    self.broker._event_key(self.user_id, seq): seq
+                    for seq in range(max(self.last_seq, current - MAX_BACKLOG) + 1, current + 1)
+                }
+                found = await store.aget_many(list(keys))
+                # Expired events are skipped
+                self.pending = [Event(str(seq), *found[key]) for key, seq in keys.items() if key in found]
+                self.last_seq = current
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(config('POLL_INTERVAL'), remaining))
+        return self.pending.pop(0)
+
+    def close(self):
+        pass
+
+
+_broker = None
+
+
+def get_broker():
+    """Return the configured broker"""
+    global _broker
+    if _broker is None:
+        _broker = import_string(config('BROKER'))()
+    return _broker
+
+
+def publish(user_id, event_type, **data):
+    """Send an event to ``user_id`` once the current transaction commits"""
+    def send():
+        try:
+            get_broker().publish(user_id, event_type, data)
+        except Exception:
+            # Live updates are best effort; the next page load catches up
+            logger.exception('Could not publish %s event to user %s', event_type, user_id)
+    transaction.on_commit(send)
@@ -0,0 +1,216 @@
+"""
+Streaming exports of notes and connections as JSON Lines or CSV.
+
+Rows are read with ``values_list(...).iterator(chunk_size=CHUNK_SIZE)`` and
+encoded, optionally gzipped, into pieces of about ``BUFFER_SIZE`` bytes as
+the response is sent. No queryset is materialized, so memory stays flat
+whether there are ten rows or ten million. The export views, the
+``export_user_data`` command and the LoveNote admin's export actions all
+use ``stream``.
+
+Under ASGI the response gets an async iterator that pulls one piece at a
+time from a worker thread. Django would otherwise read a sync iterator into
+a list before sending anything.
+
+Settings come from ``KAGAI_EXPORTS``.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Case, F, Value, When
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+from .models import Connection, LoveNote
+
+DEFAULTS = {
+    # Rows fetched from the database at a time
+    'CHUNK_SIZE': 2000,
+    # Encoded bytes collected before a piece of the response is sent
+    'BUFFER_SIZE': 64 * 1024,
+}
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+NOTE_FIELDS = [
+    'id', 'box', 'sender', 'recipient', 'title', 'content', 'status', 'is_anonymous', 'is_favorite',
+    'created_at', 'sent_at', 'opened_at', 'emoji_reaction',
+]
+ADMIN_NOTE_FIELDS = [
+    'id', 'sender', 'recipient', 'title', 'content', 'status', 'is_anonymous',
+    'created_at', 'sent_at', 'opened_at', 'emoji_reaction',
+]
+CONNECTION_FIELDS = ['id', 'user', 'direction', 'status', 'created_at', 'updated_at']
+
+# Spreadsheet apps run cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_EXPORTS', {}).get(name, DEFAULTS[name])
+
+
+def _rows(*querysets):
+    """
+    Chain the rows of ``querysets`` without loading them. Each is bound to
+    the database it routes to now, since the rows are only read once the
+    view has returned and its replica routing has ended.
+    """
+    chunk_size = config('CHUNK_SIZE')
+    return chain.from_iterable(
+        queryset.using(queryset.db).iterator(chunk_size=chunk_size) for queryset in querysets
+    )
+
+
+# ==================== Datasets ====================
+
+def user_notes(user):
+    """``(fields, rows)`` of the notes ``user`` received and sent, newest first"""
+    querysets = []
+    for box, notes in (('received', LoveNote.objects.filter(recipient=user)),
+                       ('sent', LoveNote.objects.filter(sender=user))):
+        sender = F('sender__username')
+        if box == 'received':
+            # Never reveal who sent an anonymous note
+            sender = Case(When(is_anonymous=True, then=Value(None)), default=sender)
+        notes = (
+            notes.with_favorite(user)
+            .annotate(box=Value(box), sender_name=sender, recipient_name=F('recipient__username'))
+            # Follows the received/sent page indexes, so nothing is sorted
+            .order_by('-created_at', '-id')
+            .values_list(
+                'id', 'box', 'sender_name', 'recipient_name', 'title', 'content', 'status', 'is_anonymous',
+                'is_favorite', 'created_at', 'sent_at', 'opened_at', 'emoji_reaction',
+            )
+        )
+        querysets.append(notes)
+    return NOTE_FIELDS, _rows(*querysets)
+
+
+def user_connections(user):
+    """``(fields, rows)`` of ``user``'s connections with the other user's username"""
+    outgoing = (
+        Connection.objects.filter(user1=user)
+        .annotate(username=F('user2__username'), direction=Value('outgoing'))
+    )
+    incoming = (
+        Connection.objects.filter(user2=user)
+        .annotate(username=F('user1__username'), direction=Value('incoming'))
+    )
+    fields = ('id', 'username', 'direction', 'status', 'created_at', 'updated_at')
+    # Unordered: a sort would need every row before the first is sent
+    return CONNECTION_FIELDS, _rows(*(
+        connections.order_by().values_list(*fields) for connections in (outgoing, incoming)
+    ))
+
+
+def admin_notes(queryset):
+    """``(fields, rows)`` of every note in ``queryset``, for staff"""
+    notes = queryset.order_by('pk').values_list(
+        'id', 'sender__username', 'recipient__username', 'title', 'content', 'status', 'is_anonymous',
+        'created_at', 'sent_at', 'opened_at', 'emoji_reaction',
+    )
+    return ADMIN_NOTE_FIELDS, _rows(notes)
+
+
+DATASETS = {
+    'notes': user_notes,
+    'connections': user_connections,
+}
+
+
+# ==================== Encoding ====================
+
+def _jsonl(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def _csv_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _csv(fields, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+WRITERS = {
+    'jsonl': _jsonl,
+    'csv': _csv,
+}
+
+
+def stream(fields, rows, fmt='jsonl', compress=False):
+    """Encode ``rows`` in ``fmt`` and yield bytes pieces of about ``BUFFER_SIZE``"""
+    buffer_size = config('BUFFER_SIZE')
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    pending, size = [], 0
+    for text in WRITERS[fmt](fields, rows):
+        data = text.encode()
+        pending.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            piece = b''.join(pending)
+            pending, size = [], 0
+            piece = compressor.compress(piece) if compressor else piece
+            if piece:
+                yield piece
+    piece = b''.join(pending)
+    if compressor:
+        piece = compressor.compress(piece) + compressor.flush()
+    if piece:
+        yield piece
+
+
+async def _aiter(pieces):
+    """Pull ``pieces`` one at a time in the thread that runs the sync views"""
+    next_piece = sync_to_async(next)
+    try:
+        while (piece := await next_piece(pieces, None)) is not None:
+            yield piece
+    finally:
+        # Closes the database cursor in the thread that opened it
+        await sync_to_async(pieces.close)()
+
+
+def filename(name, fmt, compress=False):
+    return f'{name}.{fmt}.gz' if compress else f'{name}.{fmt}'
+
+
+def response(request, name, fields, rows, fmt='jsonl', compress=False):
+    """A download of ``rows`` streamed as ``filename(name, fmt, compress)``"""
+    pieces = stream(fields, rows, fmt, compress)
+    if isinstance(request, ASGIRequest):
+        pieces = _aiter(pieces)
+    response = StreamingHttpResponse(
+        pieces, content_type='application/gzip' if compress else f'{FORMATS[fmt]}; charset=utf-8',
+    )
+    response['Content-Disposition'] = content_disposition_header(True, filename(name, fmt, compress))
+    # Personal data; keep it out of shared caches and stop proxies buffering it
+    response['Cache-Control'] = 'private, no-store'
+    response['X-Accel-Buffering'] = 'no'
+    return response
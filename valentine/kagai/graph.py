@@ -0,0 +1,221 @@
+"""
+In-memory index of accepted connections.
+
+``Connection`` rows store each friendship once, in whichever direction it was
+requested, so asking the database for someone's friends takes an OR across
+both columns and friends-of-friends takes self-joins. Instead every process
+keeps the accepted connections as an undirected graph: one sorted
+``array('q')`` of neighbor ids per user. Degree, mutual-connection and
+"people you may know" queries then run in memory in microseconds.
+
+The graph is built lazily with one query on first use. The views and signal
+handlers apply every change to it once the transaction commits (``connect``,
+``disconnect``, ``remove_user``), and bump a generation counter in the kagai
+cache. A process that sees a generation it did not produce rebuilds on its
+next read, so other workers' writes reach it as long as the cache is shared
+(see ``kagai.cache``). ``MAX_AGE`` bounds the staleness otherwise; with the
+dummy cache backend the graph is rebuilt on every read.
+
+Settings come from ``KAGAI_GRAPH``.
+"""
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from . import cache, routers
+from .models import Connection
+
+DEFAULTS = {
+    # Rebuild a graph older than this many seconds even without a newer
+    # generation; None keeps it until a change is seen
+    'MAX_AGE': 300,
+    # People you may know on the dashboard
+    'SUGGESTIONS': 5,
+}
+
+GENERATION_KEY = 'kagai:graph:generation'
+
+_graph = None
+_lock = threading.RLock()
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_GRAPH', {}).get(name, DEFAULTS[name])
+
+
+def _contains(ids, user_id):
+    index = bisect_left(ids, user_id)
+    return index < len(ids) and ids[index] == user_id
+
+
+class ConnectionGraph:
+    """Undirected graph of accepted connections keyed by user id"""
+
+    def __init__(self, edges=(), generation=None):
+        neighbors = {}
+        for user1_id, user2_id in edges:
+            neighbors.setdefault(user1_id, []).append(user2_id)
+            neighbors.setdefault(user2_id, []).append(user1_id)
+        self._neighbors = {user_id: array('q', sorted(set(ids))) for user_id, ids in neighbors.items()}
+        self.generation = generation
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_database(cls, generation=None):
+        # Always read the primary: a lagging replica would leave out edges
+        # that no later generation bump brings back
+        with routers.pinned_to_primary():
+            edges = Connection.objects.filter(status='accepted').order_by().values_list('user1_id', 'user2_id')
+            return cls(edges.iterator(chunk_size=5000), generation)
+
+    def __len__(self):
+        return len(self._neighbors)
+
+    def __iter__(self):
+        """Ids of the users with at least one connection"""
+        return iter(self._neighbors)
+
+    @property
+    def edge_count(self):
+        return sum(len(ids) for ids in self._neighbors.values()) // 2
+
+    def neighbors(self, user_id):
+        """Sorted ids of ``user_id``'s connections"""
+        return self._neighbors.get(user_id, array('q'))
+
+    def degree(self, user_id):
+        return len(self._neighbors.get(user_id, ()))
+
+    def is_connected(self, user_a, user_b):
+        return _contains(self.neighbors(user_a), user_b)
+
+    def mutual(self, user_a, user_b):
+        """Sorted ids of the connections ``user_a`` and ``user_b`` share"""
+        small, large = sorted((self.neighbors(user_a), self.neighbors(user_b)), key=len)
+        # Binary search the longer list, so a popular user costs log(n)
+        return [user_id for user_id in small if _contains(large, user_id)]
+
+    def suggestions(self, user_id, limit=10):
+        """
+        People ``user_id`` is not connected to yet, with the number of
+        connections they share, most shared first: ``[(user_id, mutual), ...]``
+        """
+        own = self.neighbors(user_id)
+        counts = Counter()
+        for friend_id in own:
+            counts.update(self._neighbors.get(friend_id, ()))
+        candidates = (
+            (-count, candidate)
+            for candidate, count in counts.items()
+            if candidate != user_id and not _contains(own, candidate)
+        )
+        return [(candidate, -count) for count, candidate in heapq.nsmallest(limit, candidates)]
+
+    def add_edge(self, user_a, user_b):
+        for user_id, other in ((user_a, user_b), (user_b, user_a)):
+            ids = self._neighbors.setdefault(user_id, array('q'))
+            index = bisect_left(ids, other)
+            if index == len(ids) or ids[index] != other:
+                ids.insert(index, other)
+
+    def remove_edge(self, user_a, user_b):
+        for user_id, other in ((user_a, user_b), (user_b, user_a)):
+            ids = self._neighbors.get(user_id)
+            if ids is None:
+                continue
+            index = bisect_left(ids, other)
+            if index < len(ids) and ids[index] == other:
+                del ids[index]
+            if not ids:
+                del self._neighbors[user_id]
+
+    def remove_node(self, user_id):
+        for other in self._neighbors.pop(user_id, ()):
+            self.remove_edge(other, user_id)
+
+
+# ==================== Process-wide Graph ====================
+
+def _shared_generation():
+    return cache.get_cache().get(GENERATION_KEY)
+
+
+def _bump_generation():
+    shared = cache.get_cache()
+    # Same add-then-incr dance as the cache hit counters
+    shared.add(GENERATION_KEY, 0, timeout=None)
+    try:
+        return shared.incr(GENERATION_KEY)
+    except ValueError:
+        shared.set(GENERATION_KEY, 1, timeout=None)
+        return 1
+
+
+def _is_stale(graph, generation):
+    if graph is None or generation is None or graph.generation != generation:
+        return True
+    max_age = config('MAX_AGE')
+    return max_age is not None and time.monotonic() - graph.built_at > max_age
+
+
+def get_graph():
+    """This process's connection graph, rebuilt first if another process changed it"""
+    global _graph
+    generation = _shared_generation()
+    if not _is_stale(_graph, generation):
+        return _graph
+    with _lock:
+        generation = _shared_generation()
+        if _is_stale(_graph, generation):
+            if generation is None:
+                # Evicted or never set; start a generation others can follow
+                generation = _bump_generation()
+            _graph = ConnectionGraph.from_database(generation)
+        return _graph
+
+
+def _apply(change):
+    global _graph
+    with _lock:
+        generation = _bump_generation()
+        if _graph is not None and _graph.generation == generation - 1:
+            change(_graph)
+            _graph.generation = generation
+        else:
+            # Missed someone else's change; rebuild on the next read
+            _graph = None
+
+
+def connect(user1_id, user2_id):
+    """Add an accepted connection once the current transaction commits"""
+    transaction.on_commit(lambda: _apply(lambda graph: graph.add_edge(user1_id, user2_id)))
+
+
+def disconnect(user1_id, user2_id):
+    """Drop a connection once the current transaction commits"""
+    transaction.on_commit(lambda: _apply(lambda graph: graph.remove_edge(user1_id, user2_id)))
+
+
+def remove_user(user_id):
+    transaction.on_commit(lambda: _apply(lambda graph: graph.remove_node(user_id)))
+
+
+def invalidate():
+    """Make every process rebuild, e.g. after rows were bulk inserted"""
+    def rebuild_everywhere():
+        _bump_generation()
+        reset()
+    transaction.on_commit(rebuild_everywhere)
+
+
+def reset():
+    """Forget this process's graph"""
+    global _graph
+    with _lock:
+        _graph = None
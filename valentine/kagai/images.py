@@ -0,0 +1,137 @@
+"""
+Image processing.
+
+Avatar uploads are stored untouched by ``edit_profile`` and an ``ImageJob``
+row is queued; the ``process_image_jobs`` worker then calls
+``build_avatar_variants`` to produce square thumbnails in WebP and JPEG with
+all metadata stripped.
+
+The images under ``static/images`` are resized into several widths in
+AVIF, WebP and JPEG by ``build_image_derivatives``, which ``build_assets``
+runs for every distinct file; ``{% picture %}`` renders them.
+"""
+import hashlib
+import io
+import posixpath
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, features
+
+# name -> edge length in pixels
+AVATAR_VARIANTS = {
+    'thumb': 128,
+    'medium': 320,
+}
+
+FORMATS = {
+    'avif': {'format': 'AVIF', 'quality': 60},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 6},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+AVATAR_FORMATS = ('webp', 'jpeg')
+
+VARIANT_DIR = 'avatars/variants'
+
+# Widths of the static image derivatives; images are never upscaled, so
+# narrower originals also get a derivative at their own width
+STATIC_IMAGE_WIDTHS = (320, 640, 960, 1280)
+# In <picture> source order: smallest files first, JPEG as the fallback
+STATIC_IMAGE_FORMATS = ('avif', 'webp', 'jpeg')
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def _load(file):
+    image = Image.open(file)
+    # Apply the EXIF orientation before the EXIF block is dropped
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _flatten(image):
+    """JPEG has no alpha channel: composite onto white"""
+    if image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    # A fresh save without exif/icc_profile/info arguments strips metadata
+    (_flatten(image) if fmt == 'jpeg' else image).save(buffer, **FORMATS[fmt])
+    return buffer.getvalue()
+
+
+def build_avatar_variants(profile):
+    """
+    Render every avatar variant for ``profile`` and save it to storage.
+
+    Returns the mapping stored in ``UserProfile.avatar_variants``::
+
+        {'thumb': {'size': 128, 'webp': 'avatars/variants/...', 'jpeg': '...'}, ...}
+    """
+    with profile.avatar.open('rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    source = _load(io.BytesIO(data))
+
+    variants = {}
+    for name, edge in AVATAR_VARIANTS.items():
+        image = ImageOps.fit(source, (edge, edge), Image.Resampling.LANCZOS)
+        variants[name] = {'size': edge}
+        for fmt in AVATAR_FORMATS:
+            path = posixpath.join(VARIANT_DIR, str(profile.pk), f'{digest}-{name}.{fmt}')
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            variants[name][fmt] = default_storage.save(path, ContentFile(_encode(image, fmt)))
+    return variants
+
+
+def delete_avatar_variants(variants):
+    """Remove previously generated variant files"""
+    for variant in (variants or {}).values():
+        for fmt in AVATAR_FORMATS:
+            path = variant.get(fmt)
+            if path and default_storage.exists(path):
+                default_storage.delete(path)
+
+
+def static_image_formats():
+    """Derivative formats this Pillow build can encode (AVIF needs Pillow 11.3+)"""
+    return [fmt for fmt in STATIC_IMAGE_FORMATS if fmt != 'avif' or features.check('avif')]
+
+
+def build_image_derivatives(data, output_dir, prefix):
+    """
+    Resize the image ``data`` to each of ``STATIC_IMAGE_WIDTHS`` that fits
+    and encode every width in each format, writing
+    ``<output_dir>/<digest>-<width>.<format>``. Identical sources share a
+    digest and so one set of files.
+
+    Returns::
+
+        {'width': 959, 'height': 1280,
+         'variants': {'avif': [[320, '<prefix>/<digest>-320.avif'], ...], ...}}
+    """
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    source = _load(io.BytesIO(data))
+    original_width, original_height = source.size
+    widths = [width for width in STATIC_IMAGE_WIDTHS if width < original_width]
+    widths.append(min(original_width, STATIC_IMAGE_WIDTHS[-1]))
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    variants = {fmt: [] for fmt in static_image_formats()}
+    for width in widths:
+        height = round(original_height * width / original_width)
+        image = source.resize((width, height), Image.Resampling.LANCZOS) if width != original_width else source
+        for fmt in variants:
+            name = f'{digest}-{width}.{fmt}'
+            (output_dir / name).write_bytes(_encode(image, fmt))
+            variants[fmt].append([width, posixpath.join(prefix, name)])
+    return {'width': original_width, 'height': original_height, 'variants': variants}
+
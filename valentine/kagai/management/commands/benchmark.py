@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from kagai import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every kagai URL and save latency, query and memory figures as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per route (default: 50)')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per route first (default: 5)')
+        parser.add_argument('--user', help='Username to log in as (default: the user with most received notes)')
+        parser.add_argument(
+            '--base-url',
+            help='Benchmark a running server such as gunicorn instead of the in-process test client',
+        )
+        parser.add_argument('--route', action='append', help='Only benchmark routes with this label (repeatable)')
+        parser.add_argument('--memory', action='store_true', help='Also measure peak Python allocations per route')
+        parser.add_argument('--output', default='benchmark.json', help='Where to write results (default: benchmark.json)')
+        parser.add_argument('--compare', help='Earlier results file to compare against')
+        parser.add_argument(
+            '--max-regression', type=float,
+            help='With --compare, fail if any p95 grows by more than this percentage',
+        )
+        parser.add_argument(
+            '--sessions', action='store_true',
+            help='Compare the session strategies in SESSION_PROFILES on the authenticated read routes',
+        )
+
+    def handle(self, *args, **options):
+        missing = benchmark.missing_routes()
+        if missing:
+            self.stderr.write(self.style.WARNING(f"No benchmark route for: {', '.join(missing)}"))
+
+        routes = benchmark.ROUTES
+        if options['route']:
+            routes = [route for route in routes if route.label in options['route']]
+            if not routes:
+                raise CommandError('No routes match --route')
+
+        if options['sessions']:
+            return self.compare_sessions(routes, options)
+
+        try:
+            results = benchmark.run(
+                requests=options['requests'],
+                warmup=options['warmup'],
+                username=options['user'],
+                base_url=options['base_url'],
+                routes=routes,
+                measure_memory=options['memory'],
+                log=self.stdout.write,
+            )
+        except ObjectDoesNotExist as exc:
+            raise CommandError(str(exc))
+
+        failed = [label for label, result in results['routes'].items() if result['status'] >= 500]
+        if failed:
+            self.stderr.write(self.style.ERROR(f"Server errors from: {', '.join(failed)}"))
+
+        output = Path(options['output'])
+        output.write_text(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(results["routes"])} routes to {output}'))
+
+        if options['compare']:
+            baseline = json.loads(Path(options['compare']).read_text())
+            if baseline['meta']['mode'] != results['meta']['mode']:
+                self.stderr.write(self.style.WARNING(
+                    f"Comparing a {baseline['meta']['mode']} run with a {results['meta']['mode']} run"
+                ))
+            rows, regressions = benchmark.compare(baseline, results, options['max_regression'])
+            self.stdout.write(f"\n{'route':<32} {'p95 before':>11} {'p95 after':>11} {'change':>8} {'queries':>9}")
+            for label, old, new, change, old_queries, new_queries in rows:
+                self.stdout.write(
+                    f'{label:<32} {old:>9.2f}ms {new:>9.2f}ms {change:>+7.1f}% {old_queries}->{new_queries}'
+                )
+            if regressions:
+                raise CommandError(f"Performance regressions: {', '.join(regressions)}")
+
+    def compare_sessions(self, routes, options):
+        if options['compare'] or options['base_url']:
+            raise CommandError('--sessions runs in-process and cannot be combined with --compare or --base-url')
+        try:
+            results = benchmark.run_sessions(
+                routes=routes,
+                requests=options['requests'],
+                warmup=options['warmup'],
+                username=options['user'],
+                log=self.stdout.write,
+            )
+        except ObjectDoesNotExist as exc:
+            raise CommandError(str(exc))
+
+        strategies = list(results)
+        self.stdout.write('\n' + f"{'route':<32}" + ''.join(f'{name:>26}' for name in strategies))
+        self.stdout.write(f"{'':<32}" + f"{'p95 / queries / session':>26}" * len(strategies))
+        for label in results[strategies[0]]['routes']:
+            cells = []
+            for name in strategies:
+                result = results[name]['routes'][label]
+                cells.append(f"{result['p95_ms']:>9.2f}ms {result['queries']:>6} {result['session_queries']:>7}")
+            self.stdout.write(f'{label:<32}' + ''.join(f'{cell:>26}' for cell in cells))
+
+        output = Path(options['output'])
+        output.write_text(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(strategies)} session strategies to {output}'))
@@ -0,0 +1,57 @@
+import time
+import urllib.error
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from kagai import assets
+
+
+class Command(BaseCommand):
+    help = 'Vendor, bundle and minify the front-end assets into static/dist (see kagai/assets.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--offline', action='store_true',
+            help='Do not download missing vendored files; fail instead',
+        )
+        parser.add_argument(
+            '--refresh-vendor', action='store_true',
+            help='Download every vendored file again',
+        )
+        parser.add_argument(
+            '--collectstatic', action='store_true',
+            help='Run collectstatic afterwards to fingerprint and compress the output',
+        )
+
+    def handle(self, *args, **options):
+        vendor_dir, output_dir = assets.config('VENDOR_DIR'), assets.config('OUTPUT_DIR')
+        if vendor_dir is None or output_dir is None:
+            raise CommandError('Set KAGAI_ASSETS["VENDOR_DIR"] and KAGAI_ASSETS["OUTPUT_DIR"]')
+        started = time.perf_counter()
+
+        if not options['offline']:
+            try:
+                assets.fetch_vendor(vendor_dir, force=options['refresh_vendor'], log=self.stdout.write)
+            except (urllib.error.URLError, OSError) as exc:
+                raise CommandError(f'Could not download vendored assets: {exc}')
+            except assets.AssetError as exc:
+                raise CommandError(str(exc))
+
+        builder = assets.Builder(
+            vendor_dir, settings.STATICFILES_DIRS[0], output_dir, assets.config('ICON_SOURCES'),
+            log=self.stdout.write,
+        )
+        try:
+            manifest = builder.build()
+        except assets.AssetError as exc:
+            raise CommandError(str(exc))
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Built {len(manifest['bundles'])} bundles into {output_dir} in {elapsed:.1f}s"
+        ))
+
+        if options['collectstatic']:
+            call_command('collectstatic', interactive=False, verbosity=options['verbosity'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from kagai import cache
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters for the kagai caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'cache':<20} {'hits':>10} {'misses':>10} {'hit ratio':>10}")
+        for name, counts in cache.stats().items():
+            ratio = f"{counts['ratio']:.1%}" if counts['ratio'] is not None else '-'
+            self.stdout.write(f"{name:<20} {counts['hit']:>10} {counts['miss']:>10} {ratio:>10}")
+
+        if options['reset']:
+            cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
@@ -0,0 +1,44 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kagai import graph
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the in-memory connection graph, print its size and time degree, '
+        'mutual-connection and suggestion lookups'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=1000, help='Lookups timed per query (default: 1000)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        graph.reset()
+        connection_graph = graph.get_graph()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Built a graph of {len(connection_graph)} users and {connection_graph.edge_count} '
+            f'connections in {elapsed * 1000:.1f}ms'
+        )
+
+        user_ids = list(connection_graph)
+        if not user_ids:
+            raise CommandError('There are no accepted connections; try `manage.py seed_data` first')
+        rng = random.Random(options['seed'])
+        pairs = [(rng.choice(user_ids), rng.choice(user_ids)) for _ in range(options['samples'])]
+        queries = {
+            'degree': lambda a, b: connection_graph.degree(a),
+            'mutual': connection_graph.mutual,
+            'suggestions': lambda a, b: connection_graph.suggestions(a, limit=graph.config('SUGGESTIONS')),
+        }
+        for name, query in queries.items():
+            started = time.perf_counter()
+            for user_a, user_b in pairs:
+                query(user_a, user_b)
+            per_lookup = (time.perf_counter() - started) / len(pairs) * 1e6
+            self.stdout.write(f'{name:<12} {per_lookup:>8.1f}µs per lookup')
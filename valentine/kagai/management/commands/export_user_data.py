@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from kagai import exports
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a user's notes or connections to a file or stdout as JSON Lines or CSV, "
+        'in constant memory however many rows they have'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--dataset', choices=list(exports.DATASETS), default='notes')
+        parser.add_argument('--format', choices=list(exports.FORMATS), default='jsonl')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument(
+            '--output', '-o',
+            help='File to write (default: stdout, or a named file in the current directory with --gzip)',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {options["username"]!r}')
+
+        fmt, compress = options['format'], options['gzip']
+        fields, rows = exports.DATASETS[options['dataset']](user)
+        pieces = exports.stream(fields, rows, fmt, compress)
+        output = options['output']
+        if output is None and compress:
+            output = exports.filename(f'kagai-{user.username}-{options["dataset"]}', fmt, compress)
+
+        if output is None:
+            # Pieces end on whole rows, so each decodes on its own
+            for piece in pieces:
+                self.stdout.write(piece.decode(), ending='')
+            return
+        size = 0
+        with open(output, 'wb') as file:
+            for piece in pieces:
+                file.write(piece)
+                size += len(piece)
+        self.stderr.write(self.style.SUCCESS(f'Wrote {size} bytes to {output}'))
@@ -0,0 +1,83 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from kagai import cache
+from kagai.images import build_avatar_variants, delete_avatar_variants
+from kagai.models import ImageJob, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Build resized avatar variants for queued ImageJob rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the queue once and exit instead of polling',
+        )
+        parser.add_argument(
+            '--batch', type=int, default=10,
+            help='Number of jobs to claim at a time (default: 10)',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=2.0,
+            help='Seconds to wait between polls when the queue is empty (default: 2)',
+        )
+        parser.add_argument(
+            '--max-attempts', type=int, default=ImageJob.MAX_ATTEMPTS,
+            help=f'Give up on a job after this many attempts (default: {ImageJob.MAX_ATTEMPTS})',
+        )
+        parser.add_argument(
+            '--stale-after', type=int, default=600,
+            help='Requeue jobs left processing for this many seconds by a dead worker (default: 600)',
+        )
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(seconds=options['stale_after'])
+        processed = 0
+        while True:
+            jobs = ImageJob.claim(options['batch'], stale_after=stale_after)
+            for job in jobs:
+                self.process(job, options['max_attempts'])
+                processed += 1
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} image jobs'))
+
+    def process(self, job, max_attempts):
+        profile = job.profile
+        if profile.avatar.name != job.source:
+            # A newer upload replaced this one; its own job will handle it
+            self.finish(job, 'done', 'Superseded by a newer avatar')
+            return
+
+        try:
+            variants = build_avatar_variants(profile)
+        except Exception as exc:
+            status = 'failed' if job.attempts >= max_attempts else 'pending'
+            self.finish(job, status, f'{type(exc).__name__}: {exc}')
+            self.stderr.write(f'Job {job.pk} ({job.source}): {exc}')
+            return
+
+        with transaction.atomic():
+            # Only attach the variants if the avatar is still the one we resized
+            updated = UserProfile.objects.filter(pk=profile.pk, avatar=job.source).update(
+                avatar_variants=variants, updated_at=timezone.now()
+            )
+            if updated:
+                cache.invalidate_profile(profile.user_id)
+            self.finish(job, 'done')
+        if not updated:
+            delete_avatar_variants(variants)
+
+    def finish(self, job, status, error=''):
+        job.status = status
+        job.error = error
+        job.finished_at = timezone.now() if status != 'pending' else None
+        job.save(update_fields=['status', 'error', 'finished_at'])
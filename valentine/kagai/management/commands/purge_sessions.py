@@ -0,0 +1,55 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired sessions in small batches; unlike clearsessions this never '
+        'holds the SQLite write lock for long'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Sessions deleted per statement (default: 1000)',
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help='Seconds to wait between batches so other writers get the lock (default: 0)',
+        )
+        parser.add_argument(
+            '--every', type=int,
+            help='Keep running and purge again every this many seconds',
+        )
+
+    def handle(self, *args, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        while True:
+            if issubclass(store, DatabaseSessionStore):
+                deleted = self.purge(store.get_model_class(), options['batch_size'], options['pause'])
+                self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired sessions'))
+            else:
+                # Cookie and cache sessions expire by themselves
+                store.clear_expired()
+                self.stdout.write(f'Nothing to purge for {settings.SESSION_ENGINE}')
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def purge(self, model, batch_size, pause):
+        deleted = 0
+        now = timezone.now()
+        while True:
+            keys = list(
+                model.objects.filter(expire_date__lt=now).values_list('pk', flat=True)[:batch_size]
+            )
+            if not keys:
+                return deleted
+            deleted += model.objects.filter(pk__in=keys).delete()[0]
+            if pause:
+                time.sleep(pause)
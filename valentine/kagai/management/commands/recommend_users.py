@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from kagai import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the "people you may know" recommendations shown on browse_users '
+        'for users whose profile or connections changed since the last run'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Recompute every user, e.g. nightly, so scores of changed candidates catch up everywhere',
+        )
+
+    def handle(self, *args, **options):
+        count = recommendations.run(full=options['full'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f'Updated recommendations for {count} users'))
@@ -0,0 +1,196 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from kagai import cache, graph
+from kagai.models import (
+    UserProfile, LoveNote, Connection, Favorite, Notification, UserStats, Interest, UserInterest,
+    parse_interests,
+)
+from kagai.search import get_search_backend
+
+INTEREST_POOL = [
+    'Hiking', 'Cooking', 'Reading', 'Travel', 'Music', 'Movies', 'Photography', 'Yoga',
+    'Dancing', 'Gaming', 'Painting', 'Running', 'Cycling', 'Gardening', 'Coffee', 'Wine',
+    'Poetry', 'Board Games', 'Swimming', 'Camping', 'Baking', 'Football', 'Tennis', 'Jazz',
+    'Theatre', 'Fashion', 'Volunteering', 'Astronomy', 'Chess', 'Karaoke',
+]
+LOCATIONS = ['Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret', 'Thika', 'Nyeri', 'Malindi']
+WORDS = (
+    'love heart smile forever sunshine dream together moon stars sweet kiss hug dinner '
+    'dance song letter miss you always beautiful wonderful adventure coffee morning'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Seed synthetic users, profiles, notes, connections and favorites for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of users (default: 1000)')
+        parser.add_argument('--notes', type=int, default=20, help='Notes sent per user (default: 20)')
+        parser.add_argument('--connections', type=int, default=10, help='Connections per user (default: 10)')
+        parser.add_argument('--favorites', type=int, default=3, help='Favorites per user (default: 3)')
+        parser.add_argument('--days', type=int, default=365, help='Spread timestamps over this many days (default: 365)')
+        parser.add_argument('--prefix', default='bench', help='Username prefix of seeded users (default: bench)')
+        parser.add_argument('--password', default='benchmark123', help='Password for every seeded user')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT (default: 1000)')
+        parser.add_argument(
+            '--flush', action='store_true',
+            help='Delete previously seeded users (matching --prefix) first',
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        prefix = options['prefix']
+        self.batch_size = options['batch_size']
+        started = time.perf_counter()
+
+        seeded = User.objects.filter(username__startswith=prefix)
+        if options['flush']:
+            deleted, _ = seeded.delete()
+            self.stdout.write(f'Deleted {deleted} seeded rows')
+        elif seeded.exists():
+            raise CommandError(f'Users starting with "{prefix}" already exist; pass --flush to replace them')
+
+        with transaction.atomic():
+            users = self.seed_users(rng, prefix, options)
+            notes = self.seed_notes(rng, users, options)
+            connections = self.seed_connections(rng, users, options['connections'])
+            favorites = self.seed_favorites(rng, users, notes, options['favorites'])
+            self.seed_notifications(notes)
+
+            user_ids = [user.pk for user in users]
+            for i in range(0, len(user_ids), self.batch_size):
+                UserStats.rebuild(user_ids[i:i + self.batch_size])
+            get_search_backend().rebuild()
+            cache.invalidate_global_stats()
+            graph.invalidate()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(users)} users, {len(notes)} notes, {connections} connections '
+            f'and {favorites} favorites in {elapsed:.1f}s'
+        ))
+
+    def seed_users(self, rng, prefix, options):
+        now = timezone.now()
+        # Hashing is deliberately slow; every seeded user shares one hash
+        password = make_password(options['password'])
+        users = User.objects.bulk_create([
+            User(
+                username=f'{prefix}{i:06d}',
+                first_name=rng.choice(WORDS).title(),
+                last_name=rng.choice(WORDS).title(),
+                email=f'{prefix}{i:06d}@example.com',
+                password=password,
+                date_joined=now - timedelta(days=rng.uniform(0, options['days'])),
+            )
+            for i in range(options['users'])
+        ], batch_size=self.batch_size)
+
+        profiles = []
+        for user in users:
+            interests = ', '.join(rng.sample(INTEREST_POOL, rng.randint(2, 6)))
+            profiles.append(UserProfile(
+                user=user,
+                bio=' '.join(rng.choices(WORDS, k=rng.randint(5, 30))),
+                gender=rng.choice('MFO'),
+                location=rng.choice(LOCATIONS),
+                interests=interests,
+            ))
+        profiles = UserProfile.objects.bulk_create(profiles, batch_size=self.batch_size)
+
+        Interest.objects.bulk_create(
+            [Interest(slug=slugify(name), name=name) for name in INTEREST_POOL],
+            ignore_conflicts=True,
+        )
+        interest_ids = dict(Interest.objects.values_list('slug', 'id'))
+        UserInterest.objects.bulk_create([
+            UserInterest(profile=profile, interest_id=interest_ids[slug], position=position)
+            for profile in profiles
+            for position, (slug, _) in enumerate(parse_interests(profile.interests))
+        ], batch_size=self.batch_size)
+        return users
+
+    def seed_notes(self, rng, users, options):
+        if len(users) < 2:
+            return []
+        now = timezone.now()
+        notes = []
+        for sender in users:
+            for _ in range(options['notes']):
+                recipient = rng.choice(users)
+                while recipient is sender:
+                    recipient = rng.choice(users)
+                created_at = now - timedelta(days=rng.uniform(0, options['days']))
+                notes.append(LoveNote(
+                    sender=sender,
+                    recipient=recipient,
+                    title=' '.join(rng.choices(WORDS, k=3)).title(),
+                    content=' '.join(rng.choices(WORDS, k=rng.randint(10, 80))),
+                    status=rng.choices(['sent', 'opened', 'liked', 'draft'], weights=[5, 4, 1, 1])[0],
+                    is_anonymous=rng.random() < 0.1,
+                    sent_at=created_at,
+                ))
+                notes[-1].seeded_at = created_at
+        notes = LoveNote.objects.bulk_create(notes, batch_size=self.batch_size)
+
+        # created_at is auto_now_add, so backdate it in a second pass
+        for note in notes:
+            note.created_at = note.seeded_at
+        LoveNote.objects.bulk_update(notes, ['created_at'], batch_size=self.batch_size)
+        return notes
+
+    def seed_connections(self, rng, users, per_user):
+        per_user = min(per_user, len(users) - 1)
+        pairs = set()
+        connections = []
+        for user in users:
+            for other in rng.sample(users, per_user + 1):
+                key = frozenset((user.pk, other.pk))
+                if other is user or key in pairs:
+                    continue
+                pairs.add(key)
+                connections.append(Connection(
+                    user1=user, user2=other,
+                    status=rng.choices(['accepted', 'pending', 'blocked'], weights=[7, 3, 0.2])[0],
+                ))
+        Connection.objects.bulk_create(connections, batch_size=self.batch_size)
+        return len(connections)
+
+    def seed_favorites(self, rng, users, notes, per_user):
+        received = {}
+        for note in notes:
+            received.setdefault(note.recipient_id, []).append(note)
+        favorites = [
+            Favorite(user=user, note=note)
+            for user in users
+            for note in rng.sample(received.get(user.pk, []), min(per_user, len(received.get(user.pk, []))))
+        ]
+        Favorite.objects.bulk_create(favorites, batch_size=self.batch_size)
+        return len(favorites)
+
+    def seed_notifications(self, notes):
+        # One per delivered note, unread until the note is opened
+        notifications = Notification.objects.bulk_create([
+            Notification(
+                user_id=note.recipient_id,
+                kind='note',
+                actor_id=None if note.is_anonymous else note.sender_id,
+                note=note,
+                is_read=note.status != 'sent',
+            )
+            for note in notes
+            if note.status != 'draft'
+        ], batch_size=self.batch_size)
+        for notification, note in zip(notifications, (note for note in notes if note.status != 'draft')):
+            notification.created_at = note.created_at
+        Notification.objects.bulk_update(notifications, ['created_at'], batch_size=self.batch_size)
@@ -0,0 +1,66 @@
+import json
+from pathlib import Path
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from kagai import stress
+
+
+class Command(BaseCommand):
+    help = (
+        'Hit a copy of the SQLite database with concurrent readers and writers, '
+        'once with Django defaults and once with the tuned profile'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8, help='Reading threads (default: 8)')
+        parser.add_argument('--writers', type=int, default=2, help='Writing threads (default: 2)')
+        parser.add_argument('--seconds', type=float, default=5.0, help='Duration per profile (default: 5)')
+        parser.add_argument(
+            '--profile', action='append', choices=list(stress.profiles()),
+            help='Only run this profile (repeatable)',
+        )
+        parser.add_argument('--output', help='Also write the results to this JSON file')
+        parser.add_argument(
+            '--endpoints', action='store_true',
+            help='Instead race identical requests against the state-changing endpoints and check the data',
+        )
+        parser.add_argument('--threads', type=int, default=4, help='Racing threads with --endpoints (default: 4)')
+        parser.add_argument('--rounds', type=int, default=20, help='Rounds per endpoint with --endpoints (default: 20)')
+
+    def handle(self, *args, **options):
+        if options['endpoints']:
+            return self.hammer(options)
+        try:
+            results = stress.run(
+                readers=options['readers'],
+                writers=options['writers'],
+                seconds=options['seconds'],
+                names=options['profile'],
+                log=self.stdout.write,
+            )
+        except (ObjectDoesNotExist, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        if 'default' in results and 'tuned' in results and results['default']['per_second']:
+            speedup = results['tuned']['per_second'] / results['default']['per_second']
+            self.stdout.write(self.style.SUCCESS(f'Tuned profile: {speedup:.1f}x the throughput of the defaults'))
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+
+    def hammer(self, options):
+        try:
+            results = stress.hammer(
+                threads=options['threads'], rounds=options['rounds'], log=self.stdout.write,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+        broken = [name for name, result in results.items() if result['problems'] or result['errors']]
+        if broken:
+            raise CommandError(f'Races found in: {", ".join(broken)}')
+        self.stdout.write(self.style.SUCCESS('Every endpoint stayed consistent'))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from kagai import routers
+from kagai.stress import copy_database
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the SQLite primary into the SQLite replica file, standing in for '
+        'replication when trying the read replica locally'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--every', type=float,
+            help='Keep running and copy again every this many seconds, like a lagging replica',
+        )
+
+    def handle(self, *args, **options):
+        alias = routers.replica_alias()
+        if not alias:
+            raise CommandError('No replica configured; set DATABASE_REPLICA_URL')
+        replica = connections[alias]
+        if connections['default'].vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('Only SQLite replicas are copied; other databases replicate by themselves')
+
+        while True:
+            replica.close()
+            copy_database(replica.settings_dict['NAME'])
+            self.stdout.write(self.style.SUCCESS(f'Copied the primary into {replica.settings_dict["NAME"]}'))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
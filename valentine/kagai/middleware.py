@@ -0,0 +1,175 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import routers
+from .querystats import QueryRecorder
+
+logger = logging.getLogger('kagai.perf')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+QUERY_STATS_DEFAULTS = {
+    'ENABLED': False,
+    'SERVER_TIMING': True,
+    'MAX_QUERIES': 30,
+    'MAX_DB_TIME_MS': 100,
+    'MAX_DUPLICATES': 5,
+    'SLOW_REQUEST_MS': 500,
+}
+
+
+class QueryStatsMiddleware:
+    """
+    Count the SQL queries, database time and duplicate query fingerprints of
+    each request.
+
+    Adds a ``Server-Timing`` header and logs one JSON line to ``kagai.perf``
+    when a request crosses any of the ``KAGAI_QUERY_STATS`` thresholds.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = {**QUERY_STATS_DEFAULTS, **getattr(settings, 'KAGAI_QUERY_STATS', {})}
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with recorder.record():
+            response = self.get_response(request)
+        return self.report(request, response, recorder, start)
+
+    async def __acall__(self, request):
+        # The async ORM runs queries on the request's sync thread, so the
+        # recorder has to be installed on that thread's connection
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        stack = ExitStack()
+        await sync_to_async(stack.enter_context)(recorder.record())
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.report(request, response, recorder, start)
+
+    def report(self, request, response, recorder, start):
+        total_ms = (time.perf_counter() - start) * 1000
+        db_ms = recorder.duration * 1000
+
+        if self.config['SERVER_TIMING']:
+            timing = f'db;dur={db_ms:.1f};desc="{recorder.count} queries", total;dur={total_ms:.1f}'
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = f'{existing}, {timing}' if existing else timing
+
+        duplicates = recorder.duplicates(threshold=self.config['MAX_DUPLICATES'])
+        reasons = []
+        if recorder.count > self.config['MAX_QUERIES']:
+            reasons.append('queries')
+        if db_ms > self.config['MAX_DB_TIME_MS']:
+            reasons.append('db_time')
+        if duplicates:
+            reasons.append('duplicates')
+        if total_ms > self.config['SLOW_REQUEST_MS']:
+            reasons.append('slow')
+
+        if reasons:
+            match = getattr(request, 'resolver_match', None)
+            logger.warning(json.dumps({
+                'event': 'slow_request',
+                'reasons': reasons,
+                'method': request.method,
+                'path': request.path,
+                'view': match.view_name if match else None,
+                'status': response.status_code,
+                'total_ms': round(total_ms, 1),
+                'db_ms': round(db_ms, 1),
+                'queries': recorder.count,
+                'duplicates': [{'sql': sql, 'count': n} for sql, n in duplicates.items()],
+            }))
+
+        return response
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise's middleware is sync-only, which would make Django run every
+    async view below it through ``async_to_sync`` on a thread. Static files
+    are served the same way; everything else is passed straight through.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+class ReplicaPinMiddleware:
+    """
+    Read-your-writes for replica reads: once a browser sends a request that
+    can write (anything but GET/HEAD/OPTIONS), a cookie keeps its reads on
+    the primary for ``PIN_SECONDS``. Unused without a replica.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if not routers.replica_alias():
+            raise MiddlewareNotUsed
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with routers.pinned_to_primary(self.is_pinned(request)):
+            response = self.get_response(request)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        with routers.pinned_to_primary(self.is_pinned(request)):
+            response = await self.get_response(request)
+        return self.pin(request, response)
+
+    def is_pinned(self, request):
+        return routers.config('PIN_COOKIE') in request.COOKIES or request.method not in SAFE_METHODS
+
+    def pin(self, request, response):
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(
+                routers.config('PIN_COOKIE'), '1',
+                max_age=routers.config('PIN_SECONDS'),
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
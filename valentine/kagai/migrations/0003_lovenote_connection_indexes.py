@@ -0,0 +1,60 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0002_userstats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='connection',
+            name='user1',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='connections_initiated', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='connection',
+            name='user2',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='connections_received', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='lovenote',
+            name='recipient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_notes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='lovenote',
+            name='sender',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_notes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['user1', 'status'], name='kagai_conn_user1_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['user2', 'status'], name='kagai_conn_user2_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['recipient', 'status', '-created_at'], name='kagai_note_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['recipient', '-created_at'], name='kagai_note_received_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['sender', '-created_at'], name='kagai_note_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['status'], name='kagai_note_status_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+def clear_user_stats(apps, schema_editor):
+    # Existing rows have no totals yet; they are rebuilt on next access
+    apps.get_model('kagai', 'UserStats').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0003_lovenote_connection_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstats',
+            name='total_received_notes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='total_sent_notes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(clear_user_stats, migrations.RunPython.noop),
+    ]
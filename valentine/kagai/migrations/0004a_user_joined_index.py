@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0004_userstats_totals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Keyset pagination in browse_users seeks on (date_joined, id). The
+        # index is on auth_user, a table of another app, so it is raw SQL
+        # that the migration state does not track. IF NOT EXISTS: databases
+        # migrated before it moved here got it from 0004.
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS kagai_user_joined_idx ON auth_user (date_joined, id);',
+            'DROP INDEX IF EXISTS kagai_user_joined_idx;',
+        ),
+    ]
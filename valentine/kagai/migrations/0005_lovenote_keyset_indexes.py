@@ -0,0 +1,31 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0004a_user_joined_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='lovenote',
+            name='kagai_note_received_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='lovenote',
+            name='kagai_note_sent_idx',
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['recipient', '-created_at', '-id'], name='kagai_note_received_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lovenote',
+            index=models.Index(fields=['sender', '-created_at', '-id'], name='kagai_note_sent_page_idx'),
+        ),
+    ]
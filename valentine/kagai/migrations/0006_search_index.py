@@ -0,0 +1,49 @@
+from django.db import migrations, OperationalError
+
+
+def create_fts_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS kagai_user_fts USING fts5('
+            'username, first_name, last_name, bio, location, interests, gender UNINDEXED, '
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS kagai_note_fts USING fts5('
+            'title, content, sender_id UNINDEXED, recipient_id UNINDEXED, '
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+    except OperationalError:
+        # SQLite built without FTS5; kagai.search falls back to LIKE queries
+        return
+    schema_editor.execute(
+        'INSERT INTO kagai_user_fts '
+        '(rowid, username, first_name, last_name, bio, location, interests, gender) '
+        'SELECT u.id, u.username, u.first_name, u.last_name, '
+        "COALESCE(p.bio, ''), COALESCE(p.location, ''), COALESCE(p.interests, ''), COALESCE(p.gender, '') "
+        'FROM auth_user u LEFT JOIN kagai_userprofile p ON p.user_id = u.id'
+    )
+    schema_editor.execute(
+        'INSERT INTO kagai_note_fts (rowid, title, content, sender_id, recipient_id) '
+        'SELECT id, title, content, sender_id, recipient_id FROM kagai_lovenote'
+    )
+
+
+def drop_fts_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS kagai_user_fts')
+    schema_editor.execute('DROP TABLE IF EXISTS kagai_note_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0005_lovenote_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_tables, drop_fts_tables),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0006_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Interest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserInterest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('interest', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='profile_interests', to='kagai.interest')),
+                ('profile', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='profile_interests', to='kagai.userprofile')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='interest_tags',
+            field=models.ManyToManyField(blank=True, related_name='profiles', through='kagai.UserInterest', to='kagai.interest'),
+        ),
+        migrations.AddIndex(
+            model_name='userinterest',
+            index=models.Index(fields=['interest', 'profile'], name='kagai_interest_profile_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userinterest',
+            unique_together={('profile', 'interest')},
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations
+from django.utils.text import slugify
+
+
+def parse_interests(text):
+    # Frozen copy of kagai.models.parse_interests
+    seen = {}
+    for part in (text or '').split(','):
+        name = ' '.join(part.split())[:50]
+        slug = slugify(name)[:50]
+        if slug and slug not in seen:
+            seen[slug] = name
+    return list(seen.items())[:20]
+
+
+def populate_interests(apps, schema_editor):
+    UserProfile = apps.get_model('kagai', 'UserProfile')
+    Interest = apps.get_model('kagai', 'Interest')
+    UserInterest = apps.get_model('kagai', 'UserInterest')
+
+    parsed = {}
+    names = {}
+    profiles = UserProfile.objects.exclude(interests='').values_list('id', 'interests')
+    for profile_id, text in profiles.iterator(chunk_size=2000):
+        pairs = parse_interests(text)
+        parsed[profile_id] = [slug for slug, _ in pairs]
+        for slug, name in pairs:
+            names.setdefault(slug, name)
+
+    Interest.objects.bulk_create(
+        [Interest(slug=slug, name=name) for slug, name in names.items()],
+        batch_size=1000, ignore_conflicts=True,
+    )
+    ids = dict(Interest.objects.values_list('slug', 'id'))
+    UserInterest.objects.bulk_create(
+        [
+            UserInterest(profile_id=profile_id, interest_id=ids[slug], position=position)
+            for profile_id, slugs in parsed.items()
+            for position, slug in enumerate(slugs)
+        ],
+        batch_size=1000, ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0007_interests'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_interests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+COUNTERS = [
+    'sent_notes', 'received_notes', 'connections', 'pending_requests',
+    'total_sent_notes', 'total_received_notes', 'unread_notifications',
+]
+
+
+def compute(apps, user_ids):
+    # Frozen copy of kagai.models.UserStats.compute
+    LoveNote = apps.get_model('kagai', 'LoveNote')
+    Connection = apps.get_model('kagai', 'Connection')
+    Notification = apps.get_model('kagai', 'Notification')
+    UserStats = apps.get_model('kagai', 'UserStats')
+
+    counters = {user_id: dict.fromkeys(COUNTERS, 0) for user_id in user_ids}
+    for field, queryset, column in [
+        ('sent_notes', LoveNote.objects.filter(sender_id__in=user_ids, status='sent'), 'sender_id'),
+        ('received_notes', LoveNote.objects.filter(recipient_id__in=user_ids, status='sent'), 'recipient_id'),
+        ('total_sent_notes', LoveNote.objects.filter(sender_id__in=user_ids), 'sender_id'),
+        ('total_received_notes', LoveNote.objects.filter(recipient_id__in=user_ids), 'recipient_id'),
+        ('connections', Connection.objects.filter(user1_id__in=user_ids, status='accepted'), 'user1_id'),
+        ('connections', Connection.objects.filter(user2_id__in=user_ids, status='accepted'), 'user2_id'),
+        ('pending_requests', Connection.objects.filter(user2_id__in=user_ids, status='pending'), 'user2_id'),
+        ('unread_notifications', Notification.objects.filter(user_id__in=user_ids, is_read=False), 'user_id'),
+    ]:
+        rows = queryset.values_list(column).annotate(total=models.Count('id')).order_by()
+        for user_id, total in rows:
+            counters[user_id][field] += total
+    return [UserStats(user_id=user_id, **values) for user_id, values in counters.items()]
+
+
+def backfill_user_stats(apps, schema_editor):
+    # Rows were only built on first access until now, and 0004 cleared them;
+    # build every missing one so no page has to
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    UserStats = apps.get_model('kagai', 'UserStats')
+
+    # Listed up front: SQLite reads would see the rows written in between
+    missing = list(
+        User.objects.exclude(pk__in=UserStats.objects.values('pk')).order_by('pk').values_list('pk', flat=True)
+    )
+    for start in range(0, len(missing), 500):
+        UserStats.objects.bulk_create(compute(apps, missing[start:start + 500]), ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kagai', '0011_recommendations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_user_stats, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,42 @@
-from django.db import models
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.utils.text import slugify
+
+from . import routers
+
+
+MAX_INTERESTS = 20
+
+
+def _inserted(instance):
+    """
+    Mark ``instance``, inserted with raw SQL, as saved and send ``post_save``
+    as ``Model.save()`` would, so the handlers in ``kagai.signals`` (cache
+    invalidation, the connection graph, recommendations) still run.
+    """
+    instance._state.adding = False
+    instance._state.db = connection.alias
+    post_save.send(
+        sender=type(instance), instance=instance, created=True, update_fields=None, raw=False,
+        using=connection.alias,
+    )
+    return instance
+
+
+def parse_interests(text):
+    """Split a comma-separated interests string into unique (slug, name) pairs"""
+    seen = {}
+    for part in (text or '').split(','):
+        name = ' '.join(part.split())[:50]
+        slug = slugify(name)[:50]
+        if slug and slug not in seen:
+            seen[slug] = name
+    return list(seen.items())[:MAX_INTERESTS]
 
 
 class UserProfile(models.Model):
@@ -14,10 +50,14 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(blank=True, null=True, max_length=500)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    avatar_variants = models.JSONField(default=dict, blank=True, help_text="Resized copies built by ImageJob")
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES, blank=True)
     date_of_birth = models.DateField(blank=True, null=True)
     location = models.CharField(max_length=100, blank=True)
     interests = models.CharField(max_length=500, blank=True, help_text="Comma-separated interests")
+    interest_tags = models.ManyToManyField(
+        'Interest', through='UserInterest', related_name='profiles', blank=True
+    )
     website = models.URLField(blank=True, null=True)
     phone = models.CharField(max_length=15, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -29,6 +69,81 @@ class UserProfile(models.Model):
     
     def __str__(self):
         return f"{self.user.username}'s Profile"
+    
+    def avatar_url(self, variant='thumb', fmt='jpeg'):
+        """URL of a resized avatar, or the original upload until the worker has built it"""
+        if not self.avatar:
+            return None
+        path = self.avatar_variants.get(variant, {}).get(fmt)
+        return self.avatar.storage.url(path) if path else self.avatar.url
+    
+    def set_interests(self, text):
+        """Store the raw interests string and replace the profile's interest tags"""
+        self.interests = text
+        pairs = parse_interests(text)
+        
+        Interest.objects.bulk_create(
+            [Interest(slug=slug, name=name) for slug, name in pairs], ignore_conflicts=True
+        )
+        ids = dict(Interest.objects.filter(slug__in=[slug for slug, _ in pairs]).values_list('slug', 'id'))
+        
+        UserInterest.objects.filter(profile=self).delete()
+        UserInterest.objects.bulk_create([
+            UserInterest(profile=self, interest_id=ids[slug], position=position)
+            for position, (slug, _) in enumerate(pairs)
+        ])
+
+
+class Interest(models.Model):
+    """An interest tag shared between profiles"""
+    slug = models.SlugField(max_length=50, unique=True)
+    name = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def __str__(self):
+        return self.name
+
+
+class UserInterest(models.Model):
+    """Through table linking profiles to their interest tags"""
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='profile_interests', db_index=False)
+    interest = models.ForeignKey(Interest, on_delete=models.CASCADE, related_name='profile_interests', db_index=False)
+    position = models.PositiveSmallIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('profile', 'interest')
+        indexes = [
+            # "Users who like X": seek on the tag, read profile ids from the index
+            models.Index(fields=['interest', 'profile'], name='kagai_interest_profile_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.profile.user.username} likes {self.interest.name}"
+
+
+class LoveNoteQuerySet(models.QuerySet):
+    """Query helpers that load everything a note listing renders up front"""
+    
+    def with_people(self):
+        """Join the sender and recipient along with their profiles"""
+        return self.select_related('sender__profile', 'recipient__profile')
+    
+    def with_favorite(self, user):
+        """Annotate ``is_favorite`` for ``user`` with a correlated EXISTS"""
+        return self.annotate(
+            is_favorite=models.Exists(Favorite.objects.filter(user=user, note=models.OuterRef('pk')))
+        )
+    
+    def for_inbox(self, user):
+        """Notes received by ``user``, ready to render"""
+        return self.filter(recipient=user).with_people().with_favorite(user)
+    
+    def for_outbox(self, user):
+        """Notes sent by ``user``, ready to render"""
+        return self.filter(sender=user).with_people().with_favorite(user)
 
 
 class LoveNote(models.Model):
@@ -40,8 +155,8 @@ class LoveNote(models.Model):
         ('liked', 'Liked'),
     ]
     
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_notes')
-    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_notes')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_notes', db_index=False)
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_notes', db_index=False)
     title = models.CharField(max_length=200, blank=True)
     content = models.TextField(max_length=2000)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='draft')
@@ -51,9 +166,18 @@ class LoveNote(models.Model):
     opened_at = models.DateTimeField(blank=True, null=True)
     emoji_reaction = models.CharField(max_length=10, blank=True)
     
+    objects = LoveNoteQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-created_at']
         unique_together = []
+        indexes = [
+            # These lead with the foreign key, replacing its single-column index
+            models.Index(fields=['recipient', 'status', '-created_at'], name='kagai_note_inbox_idx'),
+            models.Index(fields=['recipient', '-created_at', '-id'], name='kagai_note_received_page_idx'),
+            models.Index(fields=['sender', '-created_at', '-id'], name='kagai_note_sent_page_idx'),
+            models.Index(fields=['status'], name='kagai_note_status_idx'),
+        ]
     
     def __str__(self):
         return f"Note from {self.sender.username} to {self.recipient.username}"
@@ -67,8 +191,8 @@ class Connection(models.Model):
         ('blocked', 'Blocked'),
     ]
     
-    user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='connections_initiated')
-    user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='connections_received')
+    user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='connections_initiated', db_index=False)
+    user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='connections_received', db_index=False)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -76,9 +200,66 @@ class Connection(models.Model):
     class Meta:
         unique_together = ('user1', 'user2')
         ordering = ['-created_at']
+        indexes = [
+            # The unique (user1, user2) index already serves pair lookups,
+            # so the per-column foreign key indexes are disabled above
+            models.Index(fields=['user1', 'status'], name='kagai_conn_user1_status_idx'),
+            models.Index(fields=['user2', 'status'], name='kagai_conn_user2_status_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user1.username} <> {self.user2.username} ({self.status})"
+    
+    @classmethod
+    def between(cls, user_a, user_b):
+        """Return the connection between two users in either direction, or None"""
+        # The pair is unique, so skip the default ordering and its sort step
+        pair = models.Q(user1=user_a, user2=user_b) | models.Q(user1=user_b, user2=user_a)
+        return next(iter(cls.objects.filter(pair).order_by()[:1]), None)
+    
+    @classmethod
+    async def abetween(cls, user_a, user_b):
+        """Async version of ``between``"""
+        pair = models.Q(user1=user_a, user2=user_b) | models.Q(user1=user_b, user2=user_a)
+        return await cls.objects.filter(pair).order_by().afirst()
+    
+    @classmethod
+    def request(cls, sender, recipient):
+        """
+        Create a pending connection from ``sender`` to ``recipient`` unless the
+        two are already connected either way. A single INSERT ... ON CONFLICT
+        DO NOTHING, so concurrent requests cannot both succeed or fail on the
+        unique constraint. Returns the new connection, or None.
+        """
+        now = timezone.now()
+        stamp = connection.ops.adapt_datetimefield_value(now)
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user1_id, user2_id, status, created_at, updated_at) '
+                'SELECT %s, %s, %s, %s, %s '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE user1_id = %s AND user2_id = %s) '
+                'ON CONFLICT (user1_id, user2_id) DO NOTHING RETURNING id',
+                [sender.pk, recipient.pk, 'pending', stamp, stamp, recipient.pk, sender.pk],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return _inserted(
+            cls(id=row[0], user1=sender, user2=recipient, status='pending', created_at=now, updated_at=now)
+        )
+    
+    @classmethod
+    def transition(cls, connection_id, from_status, to_status, **filters):
+        """
+        Move a connection from ``from_status`` to ``to_status`` with one
+        conditional UPDATE. Returns False when it was no longer in
+        ``from_status`` (e.g. a concurrent request got there first).
+        """
+        return bool(
+            cls.objects.filter(pk=connection_id, status=from_status, **filters)
+            .update(status=to_status, updated_at=timezone.now())
+        )
 
 
 class Favorite(models.Model):
@@ -93,3 +274,333 @@ class Favorite(models.Model):
     
     def __str__(self):
         return f"{self.user.username} favorited a note"
+    
+    @classmethod
+    def add(cls, user, note):
+        """
+        Favorite ``note`` for ``user`` with one INSERT ... ON CONFLICT DO
+        NOTHING. Returns False if it already was a favorite.
+        """
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {cls._meta.db_table} (user_id, note_id, created_at) VALUES (%s, %s, %s) '
+                'ON CONFLICT (user_id, note_id) DO NOTHING RETURNING id',
+                [user.pk, note.pk, connection.ops.adapt_datetimefield_value(now)],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        _inserted(cls(id=row[0], user=user, note=note, created_at=now))
+        return True
+    
+    @classmethod
+    def add_many(cls, user, note_ids):
+        """
+        Favorite the notes with ``note_ids`` for ``user`` with one INSERT ...
+        ON CONFLICT DO NOTHING. Returns the ids of the notes that were not
+        favorites already.
+        """
+        if not note_ids:
+            return set()
+        now = timezone.now()
+        created_at = connection.ops.adapt_datetimefield_value(now)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {cls._meta.db_table} (user_id, note_id, created_at) VALUES '
+                + ', '.join(['(%s, %s, %s)'] * len(note_ids))
+                + ' ON CONFLICT (user_id, note_id) DO NOTHING RETURNING id, note_id',
+                [value for note_id in note_ids for value in (user.pk, note_id, created_at)],
+            )
+            rows = cursor.fetchall()
+        for pk, note_id in rows:
+            _inserted(cls(id=pk, user=user, note_id=note_id, created_at=now))
+        return {note_id for _, note_id in rows}
+
+
+class UserStats(models.Model):
+    """Denormalized per-user counters shown on the dashboard"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    sent_notes = models.IntegerField(default=0)
+    received_notes = models.IntegerField(default=0)
+    connections = models.IntegerField(default=0)
+    pending_requests = models.IntegerField(default=0)
+    total_sent_notes = models.IntegerField(default=0)
+    total_received_notes = models.IntegerField(default=0)
+    unread_notifications = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    COUNTERS = [
+        'sent_notes', 'received_notes', 'connections', 'pending_requests',
+        'total_sent_notes', 'total_received_notes', 'unread_notifications',
+    ]
+    
+    class Meta:
+        verbose_name_plural = 'user stats'
+    
+    def __str__(self):
+        return f"{self.user.username}'s Stats"
+    
+    @classmethod
+    def compute(cls, user_ids):
+        """Recompute counters from the source tables for the given user ids"""
+        # Always count on the primary: totals from a lagging replica would be
+        # upserted and from then on only moved by deltas
+        with routers.pinned_to_primary():
+            user_ids = list(user_ids)
+            counters = {user_id: dict.fromkeys(cls.COUNTERS, 0) for user_id in user_ids}
+        
+            sent = (LoveNote.objects.filter(sender_id__in=user_ids, status='sent')
+                    .values_list('sender_id').annotate(total=models.Count('id')).order_by())
+            received = (LoveNote.objects.filter(recipient_id__in=user_ids, status='sent')
+                        .values_list('recipient_id').annotate(total=models.Count('id')).order_by())
+            total_sent = (LoveNote.objects.filter(sender_id__in=user_ids)
+                          .values_list('sender_id').annotate(total=models.Count('id')).order_by())
+            total_received = (LoveNote.objects.filter(recipient_id__in=user_ids)
+                              .values_list('recipient_id').annotate(total=models.Count('id')).order_by())
+            initiated = (Connection.objects.filter(user1_id__in=user_ids, status='accepted')
+                         .values_list('user1_id').annotate(total=models.Count('id')).order_by())
+            accepted = (Connection.objects.filter(user2_id__in=user_ids, status='accepted')
+                        .values_list('user2_id').annotate(total=models.Count('id')).order_by())
+            pending = (Connection.objects.filter(user2_id__in=user_ids, status='pending')
+                       .values_list('user2_id').annotate(total=models.Count('id')).order_by())
+            unread = (Notification.objects.filter(user_id__in=user_ids, is_read=False)
+                      .values_list('user_id').annotate(total=models.Count('id')).order_by())
+        
+            for field, rows in [
+                ('sent_notes', sent),
+                ('received_notes', received),
+                ('total_sent_notes', total_sent),
+                ('total_received_notes', total_received),
+                ('connections', initiated),
+                ('connections', accepted),
+                ('pending_requests', pending),
+                ('unread_notifications', unread),
+            ]:
+                for user_id, total in rows:
+                    counters[user_id][field] += total
+        
+            return [cls(user_id=user_id, **values) for user_id, values in counters.items()]
+    
+    @classmethod
+    def rebuild(cls, user_ids):
+        """Recompute and upsert the stats rows for the given user ids"""
+        return cls.objects.bulk_create(
+            cls.compute(user_ids),
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=[*cls.COUNTERS, 'updated_at'],
+        )
+    
+    @classmethod
+    def for_user(cls, user):
+        """Fetch a user's stats row, building it from scratch if it is missing"""
+        try:
+            return cls.objects.get(pk=user.pk)
+        except cls.DoesNotExist:
+            # Not read back: a replica may not have the new row yet
+            return cls.rebuild([user.pk])[0]
+    
+    @classmethod
+    async def afor_user(cls, user):
+        """Async version of ``for_user``"""
+        try:
+            return await cls.objects.aget(pk=user.pk)
+        except cls.DoesNotExist:
+            return await sync_to_async(cls.for_user)(user)
+    
+    @classmethod
+    def bump(cls, user, **deltas):
+        """
+        Apply counter deltas (e.g. ``sent_notes=1``) to a user's stats row.
+
+        Must be called inside the same transaction as the write it accounts
+        for. A missing row is rebuilt from the source tables instead, which
+        already reflect that write.
+        """
+        updates = {field: models.F(field) + delta for field, delta in deltas.items()}
+        updates['updated_at'] = timezone.now()
+        if not cls.objects.filter(pk=user.pk).update(**updates):
+            cls.rebuild([user.pk])
+    
+    @classmethod
+    def bump_many(cls, user_ids, **deltas):
+        """Apply the same counter deltas to several users with one UPDATE"""
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        updates = {field: models.F(field) + delta for field, delta in deltas.items()}
+        updates['updated_at'] = timezone.now()
+        if cls.objects.filter(pk__in=user_ids).update(**updates) < len(user_ids):
+            existing = cls.objects.filter(pk__in=user_ids).values_list('pk', flat=True)
+            cls.rebuild(user_ids - set(existing))
+
+
+class Notification(models.Model):
+    """An inbox entry about something another user did"""
+    KIND_CHOICES = [
+        ('note', 'Love note'),
+        ('connection_request', 'Connection request'),
+        ('connection_accepted', 'Connection accepted'),
+        ('favorite', 'Favorite'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_index=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Left empty for anonymous notes
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    note = models.ForeignKey(LoveNote, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    connection = models.ForeignKey(Connection, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    read_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='kagai_notif_inbox_idx'),
+            # Only unread rows, which is all that mark-read and recounts touch
+            models.Index(fields=['user', 'id'], condition=models.Q(is_read=False), name='kagai_notif_unread_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.user_id}"
+    
+    @classmethod
+    def notify(cls, user, kind, actor=None, note=None, connection=None):
+        """
+        Create a notification and count it as unread. Call it inside the
+        transaction of the write it reports.
+        """
+        notification = cls.objects.create(user=user, kind=kind, actor=actor, note=note, connection=connection)
+        UserStats.bump(user, unread_notifications=1)
+        return notification
+    
+    @classmethod
+    def notify_many(cls, notifications):
+        """
+        ``notify`` for a batch of unsaved notifications: one INSERT, and one
+        counter UPDATE per distinct number of notifications a user gets.
+        """
+        notifications = cls.objects.bulk_create(notifications)
+        per_user = Counter(notification.user_id for notification in notifications)
+        for count in set(per_user.values()):
+            UserStats.bump_many(
+                [user_id for user_id, n in per_user.items() if n == count], unread_notifications=count,
+            )
+        return notifications
+    
+    @classmethod
+    def mark_read(cls, user, ids=None, **filters):
+        """
+        Mark ``user``'s unread notifications (optionally only ``ids`` or those
+        matching ``filters``) as read with a single UPDATE. Returns how many
+        changed.
+        """
+        notifications = cls.objects.filter(user=user, is_read=False, **filters)
+        if ids is not None:
+            notifications = notifications.filter(id__in=ids)
+        # No savepoint: callers are usually inside their own transaction already
+        with transaction.atomic(savepoint=False):
+            count = notifications.update(is_read=True, read_at=timezone.now())
+            if count:
+                UserStats.bump(user, unread_notifications=-count)
+        return count
+
+
+class ImageJob(models.Model):
+    """Queued avatar processing, claimed by the process_image_jobs worker"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    MAX_ATTEMPTS = 3
+    
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='image_jobs')
+    source = models.CharField(max_length=255, help_text="Avatar file name the job was queued for")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='kagai_imagejob_queue_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Image job {self.pk} for {self.source} ({self.status})"
+    
+    @classmethod
+    def claim(cls, limit=10, stale_after=None):
+        """
+        Atomically move up to ``limit`` pending jobs to processing and return
+        them. Each claim is a conditional UPDATE, so concurrent workers never
+        pick up the same job. Jobs stuck in processing for longer than
+        ``stale_after`` (a timedelta) are treated as pending again.
+        """
+        now = timezone.now()
+        if stale_after is not None:
+            cls.objects.filter(status='processing', started_at__lt=now - stale_after).update(status='pending')
+        
+        claimed = []
+        candidates = cls.objects.filter(status='pending').values_list('pk', flat=True)[:limit]
+        for pk in list(candidates):
+            if cls.objects.filter(pk=pk, status='pending').update(
+                status='processing', started_at=now, attempts=models.F('attempts') + 1
+            ):
+                claimed.append(pk)
+        return list(cls.objects.filter(pk__in=claimed).select_related('profile'))
+
+
+class Recommendation(models.Model):
+    """
+    Precomputed "people you may know" for browse_users, written by the
+    recommend_users command. Rows of one user are replaced together.
+    """
+    # The (user, rank) unique index serves the per-user lookup
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recommendations', db_index=False)
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recommended_to')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    shared_interests = models.PositiveSmallIntegerField(default=0)
+    shared_connections = models.PositiveSmallIntegerField(default=0)
+    same_location = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['user', 'rank']
+        unique_together = ('user', 'rank')
+    
+    def __str__(self):
+        return f"{self.candidate_id} for {self.user_id} (#{self.rank})"
+
+
+class RecommendationQueue(models.Model):
+    """Users whose recommendations are out of date since the last recommend_users run"""
+    # Deleting a user deletes their connections first, whose signals queue
+    # the user again; no constraint, so such rows wait harmlessly for the
+    # next run to drop them
+    user = models.OneToOneField(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, primary_key=True, related_name='+',
+    )
+    queued_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"Recommendations for {self.user_id} queued at {self.queued_at}"
+    
+    @classmethod
+    def enqueue(cls, user_ids):
+        """
+        Queue ``user_ids`` for the next run. Users already queued get a new
+        ``queued_at``, so a run that started before this change keeps them.
+        """
+        cls.objects.bulk_create(
+            [cls(user_id=user_id) for user_id in set(user_ids)],
+            update_conflicts=True, unique_fields=['user'], update_fields=['queued_at'],
+        )
@@ -0,0 +1,203 @@
+"""
+Keyset (seek) pagination.
+
+Instead of OFFSET, each page filters on the sort key of the last row of the
+previous page, so fetching page 1000 costs the same index seek as page 1.
+The position is handed to clients as an opaque, signed cursor token.
+
+``EstimatedCountPaginator`` is the numbered-page alternative for the admin,
+whose changelists cannot use cursors: it avoids the exact ``COUNT(*)`` that
+makes big tables slow to list.
+"""
+import datetime
+from functools import reduce
+from operator import or_
+
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'kagai.pagination.cursor'
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor token is malformed or has been tampered with"""
+
+
+def encode_cursor(values):
+    """Turn a tuple of sort key values into an opaque token"""
+    values = [v.isoformat() if isinstance(v, (datetime.date, datetime.datetime)) else v for v in values]
+    return signing.dumps(values, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token):
+    """Turn a token produced by ``encode_cursor`` back into sort key values"""
+    try:
+        values = signing.loads(token, salt=CURSOR_SALT)
+    except signing.BadSignature as exc:
+        raise InvalidCursor('Invalid cursor') from exc
+    if not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor')
+    return values
+
+
+class KeysetPage:
+    """A single page of results plus the cursor for the page after it"""
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Paginate ``queryset`` on ``ordering``, e.g. ``('-created_at', '-id')``.
+
+    The last ordering field must be unique (normally the primary key) so that
+    every row has a distinct position.
+    """
+
+    def __init__(self, queryset, ordering, per_page=20):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [field.lstrip('-') for field in self.ordering]
+
+    def _after(self, values):
+        """Build the filter selecting rows strictly after ``values``"""
+        if len(values) != len(self.ordering):
+            raise InvalidCursor('Cursor does not match the sort order')
+        clauses = []
+        for i, key in enumerate(self.ordering):
+            lookup = 'lt' if key.startswith('-') else 'gt'
+            clause = {self.fields[j]: values[j] for j in range(i)}
+            clause[f'{self.fields[i]}__{lookup}'] = values[i]
+            clauses.append(Q(**clause))
+        return reduce(or_, clauses)
+
+    def _position(self, obj):
+        values = []
+        for field in self.fields:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def _queryset(self, cursor):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self._after(decode_cursor(cursor)))
+        # Fetch one extra row to learn whether another page follows
+        return queryset[:self.per_page + 1]
+
+    def _page(self, rows):
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = encode_cursor(self._position(rows[-1]))
+        return KeysetPage(rows, next_cursor)
+
+    def page(self, cursor=None):
+        """Return the page following ``cursor`` (or the first page)"""
+        return self._page(list(self._queryset(cursor)))
+
+    async def apage(self, cursor=None):
+        """Async version of ``page``"""
+        return self._page([row async for row in self._queryset(cursor)])
+
+
+def ranked_page(search, queryset, cursor=None, per_page=20):
+    """
+    Page through results whose order comes from a ranking function rather
+    than a column, such as full-text search relevance.
+
+    ``search(limit, offset)`` returns ids in rank order; they are loaded from
+    ``queryset`` with a single primary-key lookup. The cursor carries the
+    offset into the ranked list.
+    """
+    offset = _ranked_offset(cursor)
+    ids, next_cursor = _ranked_ids(search(limit=per_page + 1, offset=offset), offset, per_page)
+    objects = queryset.in_bulk(ids)
+    return KeysetPage([objects[pk] for pk in ids if pk in objects], next_cursor)
+
+
+async def aranked_page(search, queryset, cursor=None, per_page=20):
+    """Async version of ``ranked_page``; ``search`` is a coroutine function"""
+    offset = _ranked_offset(cursor)
+    ids, next_cursor = _ranked_ids(await search(limit=per_page + 1, offset=offset), offset, per_page)
+    objects = await queryset.ain_bulk(ids)
+    return KeysetPage([objects[pk] for pk in ids if pk in objects], next_cursor)
+
+
+def _ranked_offset(cursor):
+    if not cursor:
+        return 0
+    values = decode_cursor(cursor)
+    if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+        raise InvalidCursor('Cursor does not match the sort order')
+    return values[0]
+
+
+def _ranked_ids(ids, offset, per_page):
+    next_cursor = None
+    if len(ids) > per_page:
+        ids = ids[:per_page]
+        next_cursor = encode_cursor([offset + per_page])
+    return ids, next_cursor
+
+
+def estimate_count(model, using='default'):
+    """Rows in ``model``'s table going by the database's own bookkeeping, or None if unknown"""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Kept up to date by autovacuum; -1 until the table is analyzed
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            # Two seeks to the ends of the rowid B-tree; separate subqueries,
+            # as SQLite only skips the scan for a lone MIN() or MAX(). Deleted
+            # rows make this an overestimate.
+            table = connection.ops.quote_name(table)
+            cursor.execute(f'SELECT (SELECT MAX(rowid) FROM {table}) - (SELECT MIN(rowid) FROM {table}) + 1')
+            return cursor.fetchone()[0] or 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Numbered pages without an exact ``COUNT(*)``, which reads every row.
+
+    An unfiltered list larger than ``count_limit`` takes its count from
+    ``estimate_count``; anything else is counted, but only up to
+    ``count_limit`` rows. Pages past that are not offered, so narrow the
+    filters to reach them.
+    """
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.count_limit:
+                return estimate
+        return queryset.order_by()[:self.count_limit].count()
@@ -0,0 +1,52 @@
+"""
+Per-request SQL accounting.
+
+``QueryRecorder`` is installed with ``connection.execute_wrapper`` and
+records the count, time and a fingerprint of every query. Queries sharing a
+fingerprint differ only in their parameters, so a fingerprint repeated many
+times within one request is the signature of an N+1 loop.
+"""
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+
+from django.db import connections
+
+# Collapse "IN (%s, %s, ...)" so batches of different sizes share a fingerprint
+IN_LIST_RE = re.compile(r'IN \((?:%s(?:, )?)+\)')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    """Normalize a parametrized SQL string into a stable fingerprint"""
+    sql = IN_LIST_RE.sub('IN (...)', sql)
+    return NUMBER_RE.sub('N', sql)
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self, threshold=2):
+        """Return ``{fingerprint: count}`` for fingerprints seen at least ``threshold`` times"""
+        return {sql: n for sql, n in self.fingerprints.most_common() if n >= threshold}
+
+    @contextmanager
+    def record(self, aliases=None):
+        """Record every query run on ``aliases`` (default: all databases) inside the block"""
+        with ExitStack() as stack:
+            for alias in aliases or connections:
+                stack.enter_context(connections[alias].execute_wrapper(self))
+            yield self
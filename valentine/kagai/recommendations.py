@@ -0,0 +1,241 @@
+"""
+Offline "people you may know" scoring for browse_users.
+
+``run`` (the ``recommend_users`` command) scores every active user as a
+candidate for each user whose recommendations are out of date, and stores
+the best ``TOP_K`` in ``Recommendation``; browse_users then reads them back
+with one indexed query. A candidate scores for shared interests (Jaccard
+overlap), living in the same place and shared connections, weighted by
+``WEIGHTS``. Users already connected to, requested or blocked either way are
+never recommended.
+
+Scoring runs over ``BATCH_SIZE`` users at a time as NumPy array operations
+against every candidate, so a batch costs a few milliseconds and memory
+grows with ``BATCH_SIZE`` × the number of users. Interests are kept as
+sparse per-user and per-interest lists, not a users × interests matrix.
+Profile and connection changes queue the users involved in
+``RecommendationQueue`` (see ``kagai.signals``); a normal run only
+recomputes those. Others may still
+list a changed user with an old score until their own next recompute, so
+schedule an occasional ``--full`` run as well.
+
+Settings come from ``KAGAI_RECOMMENDATIONS``.
+"""
+import time
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .graph import ConnectionGraph
+from .models import Connection, Recommendation, RecommendationQueue, UserInterest
+
+DEFAULTS = {
+    # Recommendations stored per user
+    'TOP_K': 50,
+    # Users scored together
+    'BATCH_SIZE': 128,
+    'WEIGHTS': {'interests': 1.0, 'location': 0.5, 'connections': 1.0},
+}
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_RECOMMENDATIONS', {}).get(name, DEFAULTS[name])
+
+
+class Features:
+    """Interests, locations and connections of every active user, as arrays indexed by position"""
+
+    def __init__(self):
+        users = User.objects.filter(is_active=True).order_by('id').values_list('id', 'profile__location')
+        ids, locations = [], []
+        location_codes = {}
+        for user_id, location in users.iterator(chunk_size=5000):
+            ids.append(user_id)
+            location = (location or '').strip().lower()
+            # -1 never matches, not even another blank location
+            locations.append(location_codes.setdefault(location, len(location_codes)) if location else -1)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.locations = np.array(locations, dtype=np.int32)
+
+        tags = UserInterest.objects.order_by().values_list('profile__user_id', 'interest_id')
+        tags = np.array(list(tags.iterator(chunk_size=5000)), dtype=np.int64).reshape(-1, 2)
+        rows, known = self.positions(tags[:, 0])
+        rows = rows[known]
+        interest_ids, columns = np.unique(tags[known, 1], return_inverse=True)
+        # CSR style: the interests of the user at position p are
+        # user_interests[user_starts[p]:user_starts[p + 1]], and the users
+        # holding interest i are interest_users[interest_starts[i]:interest_starts[i + 1]]
+        self.user_interests, self.user_starts = _grouped(columns, rows, len(self.ids))
+        self.interest_users, self.interest_starts = _grouped(rows, columns, len(interest_ids))
+        self.interest_counts = np.diff(self.user_starts).astype(np.float32)
+
+        self.graph = ConnectionGraph.from_database()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, user_ids):
+        """Positions of ``user_ids`` in ``ids``, and a mask of the ones found"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, user_ids).clip(max=max(len(self.ids) - 1, 0))
+        found = self.ids[positions] == user_ids if len(self.ids) else np.zeros(len(user_ids), dtype=bool)
+        return positions, found
+
+
+def _grouped(values, keys, size):
+    """``values`` sorted by ``keys`` (0 to ``size`` - 1), and where each key's run starts"""
+    order = np.argsort(keys, kind='stable')
+    starts = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=starts[1:])
+    return values[order], starts
+
+
+def _shared_interests(features, batch):
+    """``len(batch)`` × users matrix counting the interests each pair shares"""
+    shared = np.zeros((len(batch), len(features)), dtype=np.float32)
+    for row, position in enumerate(batch):
+        interests = features.user_interests[features.user_starts[position]:features.user_starts[position + 1]]
+        if not len(interests):
+            continue
+        holders = np.concatenate([
+            features.interest_users[features.interest_starts[interest]:features.interest_starts[interest + 1]]
+            for interest in interests
+        ])
+        shared[row] = np.bincount(holders, minlength=len(features))
+    return shared
+
+
+def _shared_connections(features, batch):
+    """``len(batch)`` × users matrix counting the connections each pair shares"""
+    shared = np.zeros((len(batch), len(features)), dtype=np.float32)
+    for row, user_id in enumerate(features.ids[batch]):
+        friends = features.graph.neighbors(int(user_id))
+        if not friends:
+            continue
+        # The graph's neighbor arrays are int64 already; no copy needed
+        reachable = np.concatenate([
+            np.frombuffer(features.graph.neighbors(friend), dtype=np.int64) for friend in friends
+        ])
+        positions, found = features.positions(reachable)
+        shared[row] = np.bincount(positions[found], minlength=len(features))
+    return shared
+
+
+def _excluded(features, batch):
+    """Row and column positions of pairs that must not be recommended"""
+    batch_ids = features.ids[batch]
+    pairs = Connection.objects.filter(Q(user1_id__in=batch_ids.tolist()) | Q(user2_id__in=batch_ids.tolist()))
+    pairs = np.array(list(pairs.order_by().values_list('user1_id', 'user2_id')), dtype=np.int64).reshape(-1, 2)
+    # Each pair excludes in both directions; keep the sides in this batch
+    pairs = np.concatenate([pairs, pairs[:, ::-1]])
+    rows = np.searchsorted(batch_ids, pairs[:, 0]).clip(max=len(batch_ids) - 1)
+    columns, found = features.positions(pairs[:, 1])
+    keep = (batch_ids[rows] == pairs[:, 0]) & found
+    return rows[keep], columns[keep]
+
+
+def score(features, batch, top_k):
+    """
+    Score every user as a candidate for each position in ``batch`` (sorted)
+    and return ``(user_id, [(candidate_id, score, shared_interests,
+    shared_connections, same_location), ...])`` for each, best first.
+    """
+    weights = config('WEIGHTS')
+    shared_interests = _shared_interests(features, batch)
+    union = features.interest_counts[batch][:, None] + features.interest_counts[None, :] - shared_interests
+    scores = np.divide(shared_interests, union, out=np.zeros_like(union), where=union > 0)
+    scores *= weights['interests']
+
+    here = features.locations[batch][:, None]
+    same_location = (here == features.locations[None, :]) & (here >= 0)
+    scores += weights['location'] * same_location
+
+    shared_connections = _shared_connections(features, batch)
+    scores += weights['connections'] * np.log1p(shared_connections)
+
+    scores[np.arange(len(batch)), batch] = -np.inf
+    scores[_excluded(features, batch)] = -np.inf
+
+    top_k = min(top_k, len(features))
+    best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    # Highest score first, ties to the lower user id
+    order = np.lexsort((features.ids[best], -best_scores), axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+
+    results = []
+    for row, position in enumerate(batch):
+        picks = []
+        for column in best[row]:
+            value = scores[row, column]
+            if value <= 0:
+                break
+            picks.append((
+                int(features.ids[column]), float(value), int(shared_interests[row, column]),
+                int(shared_connections[row, column]), bool(same_location[row, column]),
+            ))
+        results.append((int(features.ids[position]), picks))
+    return results
+
+
+def store(results):
+    """Replace the stored recommendations of the users in ``results``"""
+    Recommendation.objects.filter(user_id__in=[user_id for user_id, _ in results]).delete()
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    # A plain executemany; building model instances for bulk_create took
+    # five times as long as the inserts themselves
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {Recommendation._meta.db_table} '
+            '(user_id, candidate_id, rank, score, shared_interests, shared_connections, same_location, created_at) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+            [
+                (user_id, candidate_id, rank, value, interests, connections, same_location, created_at)
+                for user_id, picks in results
+                for rank, (candidate_id, value, interests, connections, same_location) in enumerate(picks, 1)
+            ],
+        )
+
+
+def run(full=False, log=None):
+    """
+    Recompute the recommendations of queued users, or of everyone with
+    ``full`` (also the default before the first run). Returns the number of
+    users recomputed.
+    """
+    log = log or (lambda message: None)
+    started_at = timezone.now()
+    queued = RecommendationQueue.objects.filter(queued_at__lte=started_at)
+    full = full or not Recommendation.objects.exists()
+    user_ids = None if full else list(queued.values_list('user_id', flat=True))
+    if user_ids == []:
+        log('No users queued')
+        return 0
+
+    started = time.perf_counter()
+    features = Features()
+    log(f'Loaded {len(features)} users in {time.perf_counter() - started:.2f}s')
+    if full:
+        positions = np.arange(len(features))
+    else:
+        positions, found = features.positions(sorted(user_ids))
+        positions = positions[found]
+
+    top_k, batch_size = config('TOP_K'), config('BATCH_SIZE')
+    for offset in range(0, len(positions), batch_size):
+        batch = positions[offset:offset + batch_size]
+        results = score(features, batch, top_k)
+        with transaction.atomic():
+            store(results)
+            # Changes queued after the run started wait for the next one
+            queued.filter(user_id__in=[user_id for user_id, _ in results]).delete()
+        log(f'Scored {offset + len(batch)}/{len(positions)} users')
+
+    # Inactive or deleted users have nothing to recompute
+    queued.delete()
+    log(f'Recomputed {len(positions)} users in {time.perf_counter() - started:.2f}s')
+    return len(positions)
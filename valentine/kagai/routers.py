@@ -0,0 +1,112 @@
+"""
+Database routing between the primary and an optional read replica.
+
+Everything reads from and writes to the primary unless a view opts in with
+``@read_from_replica``; its queries (template rendering included) then read
+from the replica alias named in ``KAGAI_REPLICA``. Replicas lag behind, so
+after a request that may have written, ``kagai.middleware.ReplicaPinMiddleware``
+sets a short-lived cookie that keeps that browser's reads on the primary
+until its own writes have had time to replicate (read-your-writes). The
+session and the logged-in user are always loaded from the primary, so a
+login that has not replicated yet still authenticates.
+
+With no replica configured the router sends everything to ``default``.
+"""
+import contextvars
+import functools
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Whether the current request may read from the replica; a context variable
+# so async views and the threads their queries run on see the same value
+_replica_reads = contextvars.ContextVar('kagai_replica_reads', default=False)
+_pinned = contextvars.ContextVar('kagai_replica_pinned', default=False)
+
+DEFAULTS = {
+    # Database alias of the replica; None sends everything to the primary
+    'ALIAS': None,
+    # Seconds a browser keeps reading from the primary after it wrote;
+    # comfortably more than the usual replication lag
+    'PIN_SECONDS': 10,
+    'PIN_COOKIE': 'kagai_primary',
+}
+
+
+def config(name):
+    return getattr(settings, 'KAGAI_REPLICA', {}).get(name, DEFAULTS[name])
+
+
+def replica_alias():
+    """The replica's database alias, or ``None`` when there is none"""
+    return config('ALIAS')
+
+
+@contextmanager
+def replica_reads():
+    """Let reads in this block go to the replica"""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def pinned_to_primary(pinned=True):
+    """Keep every read in this block on the primary"""
+    token = _pinned.set(pinned)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def read_from_replica(view):
+    """
+    Decorator for read-only views whose queries may go to the replica. The
+    request's user (and with it the session) is resolved on the primary
+    first; both load lazily and would otherwise be read from the replica.
+    """
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            request.user = await request.auser()
+            with replica_reads():
+                return await view(request, *args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # Evaluates the lazy user while reads still go to the primary
+            request.user.is_authenticated
+            with replica_reads():
+                return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    """Send opted-in reads to the replica and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if alias and _replica_reads.get() and not _pinned.get():
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db and instance._state.db != replica_alias():
+            # Saving an object loaded with .using(); the default router would
+            # send it back where it came from
+            return instance._state.db
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        return db != replica_alias()
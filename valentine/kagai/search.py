@@ -0,0 +1,341 @@
+"""
+Full-text search over users and love notes.
+
+Views talk to a small backend interface so the storage can change without
+touching them. ``SQLiteFTSBackend`` keeps FTS5 virtual tables in sync through
+the signal handlers in ``kagai.signals``; ``LikeSearchBackend`` is a portable
+fallback built on ``icontains`` lookups. A Postgres ``tsvector`` backend only
+needs to implement the same methods.
+
+The backend is chosen with the ``KAGAI_SEARCH_BACKEND`` setting.
+"""
+import contextvars
+import re
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, OperationalError, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import UserProfile, LoveNote, Interest, UserInterest
+
+DEFAULT_BACKEND = 'kagai.search.SQLiteFTSBackend'
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    """Split a raw query string into search terms"""
+    return TOKEN_RE.findall(query.lower())[:10]
+
+
+class SearchBackend:
+    """Interface implemented by every search backend"""
+
+    def is_available(self):
+        return True
+
+    def index_user(self, user):
+        """Add or refresh a user (and their profile) in the index"""
+
+    def remove_user(self, user_id):
+        """Drop a user from the index"""
+
+    def index_note(self, note):
+        """Add or refresh a love note in the index"""
+
+    def remove_note(self, note_id):
+        """Drop a love note from the index"""
+
+    def index_notes(self, notes):
+        """Add or refresh several love notes; backends may batch this"""
+        for note in notes:
+            self.index_note(note)
+
+    def remove_notes(self, note_ids):
+        """Drop several love notes from the index; backends may batch this"""
+        for note_id in note_ids:
+            self.remove_note(note_id)
+
+    def rebuild(self):
+        """Reindex everything from the source tables"""
+
+    def search_users(self, query, exclude_id=None, gender=None, interest=None, limit=20, offset=0):
+        """
+        Return ids of users matching ``query``, best match first, optionally
+        only those with ``gender`` or the interest whose slug is ``interest``
+        """
+        raise NotImplementedError
+
+    def search_notes(self, user, query, box='received', limit=20, offset=0):
+        """Return ids of ``user``'s received or sent notes matching ``query``, best match first"""
+        raise NotImplementedError
+
+    def user_filter(self, query):
+        """A ``Q`` on ``User`` for every user matching ``query``, e.g. for the admin"""
+        raise NotImplementedError
+
+    def note_filter(self, query):
+        """A ``Q`` on ``LoveNote`` for every note matching ``query``, whoever it belongs to"""
+        raise NotImplementedError
+
+
+class LikeSearchBackend(SearchBackend):
+    """Unindexed fallback using ``icontains`` lookups; works on any database"""
+
+    def search_users(self, query, exclude_id=None, gender=None, interest=None, limit=20, offset=0):
+        users = User.objects.filter(self.user_filter(query))
+        if exclude_id is not None:
+            users = users.exclude(id=exclude_id)
+        if gender:
+            users = users.filter(profile__gender=gender)
+        if interest:
+            users = users.filter(profile__profile_interests__interest__slug=interest)
+        return list(users.order_by('username').values_list('id', flat=True)[offset:offset + limit])
+
+    def search_notes(self, user, query, box='received', limit=20, offset=0):
+        notes = LoveNote.objects.filter(**{'sender' if box == 'sent' else 'recipient': user})
+        notes = notes.filter(self.note_filter(query))
+        return list(notes.order_by('-created_at', '-id').values_list('id', flat=True)[offset:offset + limit])
+
+    def user_filter(self, query):
+        q = Q()
+        for term in tokenize(query):
+            q &= (
+                Q(username__icontains=term) | Q(first_name__icontains=term) |
+                Q(last_name__icontains=term) | Q(profile__bio__icontains=term) |
+                Q(profile__location__icontains=term) | Q(profile__interests__icontains=term)
+            )
+        return q
+
+    def note_filter(self, query):
+        q = Q()
+        for term in tokenize(query):
+            q &= Q(title__icontains=term) | Q(content__icontains=term)
+        return q
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """
+    SQLite FTS5 backend.
+
+    ``kagai_user_fts`` and ``kagai_note_fts`` are created by migration
+    0006_search_index and keyed by the user / note primary key (the FTS rowid).
+    Matching is prefix-based on every term and results are ordered by bm25.
+    Filters on owner, gender and interest join the matches to the base
+    tables by primary key or unique index; the UNINDEXED columns of the FTS
+    tables would be read row by row from their content tables instead.
+    """
+    USER_TABLE = 'kagai_user_fts'
+    NOTE_TABLE = 'kagai_note_fts'
+
+    # bm25 column weights: username, first_name, last_name, bio, location, interests
+    USER_WEIGHTS = (10.0, 5.0, 5.0, 1.0, 2.0, 3.0)
+    # title, content
+    NOTE_WEIGHTS = (3.0, 1.0)
+
+    _available = None
+
+    def is_available(self):
+        if SQLiteFTSBackend._available is None:
+            if connection.vendor != 'sqlite':
+                SQLiteFTSBackend._available = False
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN (%s, %s)",
+                        [self.USER_TABLE, self.NOTE_TABLE],
+                    )
+                    SQLiteFTSBackend._available = cursor.fetchone()[0] == 2
+        return SQLiteFTSBackend._available
+
+    @staticmethod
+    def match_expression(query):
+        """Build an FTS5 MATCH expression doing a prefix match on every term"""
+        terms = tokenize(query)
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def index_user(self, user):
+        profile = UserProfile.objects.filter(user=user).first()
+        # One transaction, so concurrent saves of the same user cannot both
+        # delete and then both insert the same rowid
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.USER_TABLE} WHERE rowid = %s', [user.pk])
+            cursor.execute(
+                f'INSERT INTO {self.USER_TABLE} '
+                '(rowid, username, first_name, last_name, bio, location, interests, gender) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                [
+                    user.pk, user.username, user.first_name, user.last_name,
+                    (profile.bio or '') if profile else '',
+                    profile.location if profile else '',
+                    profile.interests if profile else '',
+                    profile.gender if profile else '',
+                ],
+            )
+
+    def remove_user(self, user_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.USER_TABLE} WHERE rowid = %s', [user_id])
+
+    def index_note(self, note):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.NOTE_TABLE} WHERE rowid = %s', [note.pk])
+            cursor.execute(
+                f'INSERT INTO {self.NOTE_TABLE} (rowid, title, content, sender_id, recipient_id) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                [note.pk, note.title, note.content, note.sender_id, note.recipient_id],
+            )
+
+    def remove_note(self, note_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.NOTE_TABLE} WHERE rowid = %s', [note_id])
+
+    def index_notes(self, notes):
+        if not notes:
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.remove_notes([note.pk for note in notes])
+            cursor.executemany(
+                f'INSERT INTO {self.NOTE_TABLE} (rowid, title, content, sender_id, recipient_id) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                [[note.pk, note.title, note.content, note.sender_id, note.recipient_id] for note in notes],
+            )
+
+    def remove_notes(self, note_ids):
+        if not note_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(note_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.NOTE_TABLE} WHERE rowid IN ({placeholders})', list(note_ids))
+
+    def rebuild(self):
+        user_table = User._meta.db_table
+        profile_table = UserProfile._meta.db_table
+        note_table = LoveNote._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.USER_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {self.USER_TABLE} '
+                '(rowid, username, first_name, last_name, bio, location, interests, gender) '
+                'SELECT u.id, u.username, u.first_name, u.last_name, '
+                "COALESCE(p.bio, ''), COALESCE(p.location, ''), COALESCE(p.interests, ''), "
+                "COALESCE(p.gender, '') "
+                f'FROM {user_table} u LEFT JOIN {profile_table} p ON p.user_id = u.id'
+            )
+            cursor.execute(f'DELETE FROM {self.NOTE_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {self.NOTE_TABLE} (rowid, title, content, sender_id, recipient_id) '
+                f'SELECT id, title, content, sender_id, recipient_id FROM {note_table}'
+            )
+            # Merge the b-tree segments left behind by the bulk insert
+            cursor.execute(f"INSERT INTO {self.USER_TABLE}({self.USER_TABLE}) VALUES ('optimize')")
+            cursor.execute(f"INSERT INTO {self.NOTE_TABLE}({self.NOTE_TABLE}) VALUES ('optimize')")
+
+    def search_users(self, query, exclude_id=None, gender=None, interest=None, limit=20, offset=0):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        table = self.USER_TABLE
+        sql = [f'SELECT {table}.rowid FROM {table}']
+        where = [f'{table} MATCH %s']
+        params = [expression]
+        if gender or interest:
+            sql.append(f'JOIN {UserProfile._meta.db_table} p ON p.user_id = {table}.rowid')
+        if interest:
+            sql.append(
+                f'JOIN {UserInterest._meta.db_table} ui ON ui.profile_id = p.id '
+                f'JOIN {Interest._meta.db_table} i ON i.id = ui.interest_id'
+            )
+            where.append('i.slug = %s')
+            params.append(interest)
+        if gender:
+            where.append('p.gender = %s')
+            params.append(gender)
+        if exclude_id is not None:
+            where.append(f'{table}.rowid != %s')
+            params.append(exclude_id)
+        weights = ', '.join(str(w) for w in self.USER_WEIGHTS)
+        sql.append('WHERE ' + ' AND '.join(where))
+        sql.append(f'ORDER BY bm25({table}, {weights}) LIMIT %s OFFSET %s')
+        params += [limit, offset]
+        return self._fetch_ids(' '.join(sql), params)
+
+    def search_notes(self, user, query, box='received', limit=20, offset=0):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        table = self.NOTE_TABLE
+        owner = 'sender_id' if box == 'sent' else 'recipient_id'
+        weights = ', '.join(str(w) for w in self.NOTE_WEIGHTS)
+        return self._fetch_ids(
+            f'SELECT {table}.rowid FROM {table} JOIN {LoveNote._meta.db_table} n ON n.id = {table}.rowid '
+            f'WHERE {table} MATCH %s AND n.{owner} = %s '
+            f'ORDER BY bm25({table}, {weights}) LIMIT %s OFFSET %s',
+            [expression, user.pk, limit, offset],
+        )
+
+    def user_filter(self, query):
+        return self._match_filter(self.USER_TABLE, query)
+
+    def note_filter(self, query):
+        return self._match_filter(self.NOTE_TABLE, query)
+
+    def _match_filter(self, table, query):
+        expression = self.match_expression(query)
+        if not expression:
+            return Q(pk__in=[])
+        # Quoted terms only, so FTS5 cannot reject the expression
+        return Q(pk__in=RawSQL(f'SELECT rowid FROM {table} WHERE {table} MATCH %s', [expression]))
+
+    def _fetch_ids(self, sql, params):
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(sql, params)
+            except OperationalError:
+                # Malformed MATCH expressions are reported as errors by FTS5
+                return []
+            return [row[0] for row in cursor.fetchall()]
+
+
+_backend = None
+
+
+def get_search_backend():
+    """Return the configured search backend, falling back to LIKE queries"""
+    global _backend
+    if _backend is None:
+        backend = import_string(getattr(settings, 'KAGAI_SEARCH_BACKEND', DEFAULT_BACKEND))()
+        _backend = backend if backend.is_available() else LikeSearchBackend()
+    return _backend
+
+
+# Note ids collected by ``bulk_removals`` instead of being removed one by one
+_pending_removals = contextvars.ContextVar('kagai_search_pending_removals', default=None)
+
+
+def remove_note(note_id):
+    """Drop a note from the index now, or at the end of the enclosing ``bulk_removals``"""
+    pending = _pending_removals.get()
+    if pending is None:
+        get_search_backend().remove_note(note_id)
+    else:
+        pending.append(note_id)
+
+
+@contextmanager
+def bulk_removals():
+    """
+    Batch the index removals that deleting many notes triggers (one per note
+    through ``post_delete``) into a single statement when the block ends
+    """
+    pending = []
+    token = _pending_removals.set(pending)
+    try:
+        yield
+    finally:
+        _pending_removals.reset(token)
+    get_search_backend().remove_notes(pending)
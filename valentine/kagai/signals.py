@@ -0,0 +1,126 @@
+"""
+Signal handlers keeping derived data in sync with the kagai models.
+
+Connected in ``KagaiConfig.ready``.
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import cache, graph
+from .models import UserProfile, LoveNote, Connection, Favorite, RecommendationQueue
+from .search import get_search_backend, remove_note
+
+
+# ==================== Search Index ====================
+
+@receiver(post_save, sender=User, dispatch_uid='kagai_search_user_saved')
+def index_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    # e.g. the last_login update on every login leaves the indexed names alone
+    if raw or (update_fields and not {'username', 'first_name', 'last_name'} & set(update_fields)):
+        return
+    get_search_backend().index_user(instance)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='kagai_search_user_deleted')
+def unindex_user(sender, instance, **kwargs):
+    get_search_backend().remove_user(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile, dispatch_uid='kagai_search_profile_saved')
+def index_profile(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_user(instance.user)
+
+
+@receiver(post_save, sender=LoveNote, dispatch_uid='kagai_search_note_saved')
+def index_note(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Status changes (e.g. marking a note opened) leave the indexed text alone
+    if raw or (update_fields and not {'title', 'content'} & set(update_fields)):
+        return
+    get_search_backend().index_note(instance)
+
+
+@receiver(post_delete, sender=LoveNote, dispatch_uid='kagai_search_note_deleted')
+def unindex_note(sender, instance, **kwargs):
+    remove_note(instance.pk)
+
+
+# ==================== Cache Invalidation ====================
+
+@receiver(post_save, sender=User, dispatch_uid='kagai_cache_user_saved')
+def invalidate_user_caches(sender, instance, created, **kwargs):
+    cache.invalidate_profile(instance.pk)
+    if created:
+        cache.invalidate_global_stats()
+
+
+@receiver(post_delete, sender=User, dispatch_uid='kagai_cache_user_deleted')
+def invalidate_deleted_user_caches(sender, instance, **kwargs):
+    cache.invalidate_profile(instance.pk)
+    cache.invalidate_global_stats()
+
+
+@receiver(post_save, sender=UserProfile, dispatch_uid='kagai_cache_profile_saved')
+@receiver(post_delete, sender=UserProfile, dispatch_uid='kagai_cache_profile_deleted')
+def invalidate_profile_caches(sender, instance, **kwargs):
+    cache.invalidate_profile(instance.user_id)
+
+
+@receiver(post_save, sender=LoveNote, dispatch_uid='kagai_cache_note_saved')
+@receiver(post_delete, sender=LoveNote, dispatch_uid='kagai_cache_note_deleted')
+def invalidate_note_caches(sender, instance, **kwargs):
+    cache.invalidate_global_stats()
+    cache.invalidate_dashboard(instance.sender_id, instance.recipient_id)
+
+
+@receiver(post_save, sender=Connection, dispatch_uid='kagai_cache_connection_saved')
+@receiver(post_delete, sender=Connection, dispatch_uid='kagai_cache_connection_deleted')
+def invalidate_connection_caches(sender, instance, **kwargs):
+    cache.invalidate_dashboard(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_save, sender=Favorite, dispatch_uid='kagai_cache_favorite_saved')
+@receiver(post_delete, sender=Favorite, dispatch_uid='kagai_cache_favorite_deleted')
+def invalidate_favorite_caches(sender, instance, **kwargs):
+    cache.invalidate_dashboard(instance.user_id)
+
+
+# ==================== Connection Graph ====================
+
+@receiver(post_save, sender=Connection, dispatch_uid='kagai_graph_connection_saved')
+def update_graph(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    if instance.status == 'accepted':
+        graph.connect(instance.user1_id, instance.user2_id)
+    elif not created:
+        # e.g. an accepted connection was blocked; a new request was never
+        # an edge and need not make other processes rebuild
+        graph.disconnect(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_delete, sender=Connection, dispatch_uid='kagai_graph_connection_deleted')
+def remove_from_graph(sender, instance, **kwargs):
+    if instance.status == 'accepted':
+        graph.disconnect(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='kagai_graph_user_deleted')
+def remove_user_from_graph(sender, instance, **kwargs):
+    graph.remove_user(instance.pk)
+
+
+# ==================== Recommendations ====================
+
+@receiver(post_save, sender=UserProfile, dispatch_uid='kagai_recommendations_profile_saved')
+def queue_profile_recommendations(sender, instance, raw=False, **kwargs):
+    if not raw:
+        RecommendationQueue.enqueue([instance.user_id])
+
+
+@receiver(post_save, sender=Connection, dispatch_uid='kagai_recommendations_connection_saved')
+@receiver(post_delete, sender=Connection, dispatch_uid='kagai_recommendations_connection_deleted')
+def queue_connection_recommendations(sender, instance, raw=False, **kwargs):
+    if not raw:
+        RecommendationQueue.enqueue([instance.user1_id, instance.user2_id])
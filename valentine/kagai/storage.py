@@ -0,0 +1,9 @@
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """
+    Fingerprinted, gzip and Brotli compressed static files (Brotli needs
+    ``pip install Brotli``). WhiteNoise serves the fingerprinted names with
+    an immutable, far-future ``Cache-Control``.
+    """
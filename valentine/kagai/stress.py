@@ -0,0 +1,375 @@
+"""
+Concurrent read/write stress test for the SQLite database.
+
+``run`` copies the database to a scratch file and hits it from several
+threads at once, one thread per simulated gunicorn worker. Readers load an
+inbox page the way ``my_notes`` does; writers toggle a favorite and bump the
+recipient's counter the way ``toggle_favorite`` does. After each request the
+thread lets its connection go the way Django's ``request_finished`` handler
+does, so ``CONN_MAX_AGE`` matters as it would in production.
+
+Each database profile in ``profiles()`` runs against a fresh copy:
+``default`` is Django's out-of-the-box SQLite setup, ``tuned`` the
+``SQLITE_TUNED_OPTIONS`` profile from settings.
+
+``hammer`` drives the state-changing endpoints instead: every thread sends
+the same request at the same moment, like a double click, round after
+round, and the data is checked for consistency afterwards.
+
+Use both through the ``stress_db`` management command.
+"""
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F, Q
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from .models import UserProfile, LoveNote, Connection, Favorite, UserStats
+
+# Users and notes the workers pick from
+SAMPLE_SIZE = 200
+
+
+def profiles():
+    """Database settings to compare, keyed by name"""
+    return {
+        # A copy of a WAL database stays in WAL mode unless told otherwise
+        'default': {
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': False,
+            'OPTIONS': {'init_command': 'PRAGMA journal_mode=DELETE'},
+        },
+        'tuned': {
+            'CONN_MAX_AGE': 600,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': dict(settings.SQLITE_TUNED_OPTIONS),
+        },
+    }
+
+
+def copy_database(path):
+    """Copy the default database, committed WAL pages included, to ``path``"""
+    connection.ensure_connection()
+    target = sqlite3.connect(path)
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
+
+
+def read(alias, user_id):
+    notes = LoveNote.objects.using(alias).filter(recipient_id=user_id).with_people().order_by('-created_at')
+    list(notes[:20])
+    UserStats.objects.using(alias).filter(pk=user_id).first()
+
+
+def write(alias, user_id, note):
+    with transaction.atomic(using=alias):
+        favorite, created = Favorite.objects.using(alias).get_or_create(user_id=user_id, note_id=note[0])
+        if not created:
+            favorite.delete()
+        else:
+            UserStats.objects.using(alias).filter(pk=note[1]).update(
+                unread_notifications=F('unread_notifications') + 1
+            )
+
+
+def worker(alias, settings_dict, kind, user_ids, notes, deadline, results):
+    # A connection of this thread's own, like each gunicorn worker has
+    connections[alias] = connections['default'].__class__(settings_dict, alias)
+    rng = random.Random()
+    timings, errors = [], 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if kind == 'read':
+                read(alias, rng.choice(user_ids))
+            else:
+                write(alias, rng.choice(user_ids), rng.choice(notes))
+        except OperationalError:
+            # "database is locked"
+            errors += 1
+        else:
+            timings.append((time.perf_counter() - start) * 1000)
+        connections[alias].close_if_unusable_or_obsolete()
+    connections[alias].close()
+    del connections[alias]
+    results.append((kind, timings, errors))
+
+
+def summarize(timings, errors, elapsed):
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(statistics.median(timings), 3) if timings else None,
+        'p95_ms': round(statistics.quantiles(timings, n=20)[-1], 3) if len(timings) > 1 else None,
+    }
+
+
+def run_profile(name, overrides, source, readers, writers, seconds):
+    alias = f'stress_{name}'
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'stress.sqlite3'
+        copy_database(path)
+        settings_dict = {**connections['default'].settings_dict, **overrides, 'NAME': str(path)}
+        user_ids, notes = source
+        results = []
+        deadline = time.monotonic() + seconds
+        threads = [
+            threading.Thread(target=worker, args=(alias, settings_dict, kind, user_ids, notes, deadline, results))
+            for kind in ['read'] * readers + ['write'] * writers
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+    summary = {}
+    for kind in ('read', 'write'):
+        timings = [t for k, samples, _ in results if k == kind for t in samples]
+        errors = sum(e for k, _, e in results if k == kind)
+        summary[kind] = summarize(timings, errors, elapsed)
+    summary['per_second'] = round(summary['read']['per_second'] + summary['write']['per_second'], 1)
+    return summary
+
+
+def run(readers=8, writers=2, seconds=5.0, names=None, log=None):
+    """
+    Stress every profile in turn and return ``{profile: summary}`` with
+    throughput, latency and locking errors for reads and writes.
+    """
+    log = log or (lambda message: None)
+    if connection.vendor != 'sqlite':
+        raise ValueError('The stress test only applies to SQLite databases')
+    user_ids = list(UserStats.objects.order_by('pk').values_list('pk', flat=True)[:SAMPLE_SIZE])
+    notes = list(LoveNote.objects.order_by('pk').values_list('pk', 'sender_id')[:SAMPLE_SIZE])
+    if not user_ids or not notes:
+        raise LoveNote.DoesNotExist('Nothing to stress; run seed_data first')
+
+    results = {}
+    for name, overrides in profiles().items():
+        if names and name not in names:
+            continue
+        results[name] = result = run_profile(name, overrides, (user_ids, notes), readers, writers, seconds)
+        log(
+            f"{name:<8} {result['per_second']:>8.1f} req/s  "
+            f"reads p95 {result['read']['p95_ms'] or 0:>7.2f}ms  writes p95 {result['write']['p95_ms'] or 0:>7.2f}ms  "
+            f"locked {result['read']['errors'] + result['write']['errors']}"
+        )
+    return results
+
+
+# ==================== Endpoint Races ====================
+
+@contextmanager
+def scratch_default(path):
+    """
+    Point this thread's default connection at the database copy in ``path``,
+    tuned as in production whether or not ``KAGAI_SQLITE_TUNING`` is set
+    """
+    original = connections['default']
+    scratch = original.__class__(
+        {**original.settings_dict, 'NAME': str(path), 'OPTIONS': dict(settings.SQLITE_TUNED_OPTIONS)}, 'default',
+    )
+    connections['default'] = scratch
+    try:
+        yield
+    finally:
+        scratch.close()
+        connections['default'] = original
+
+
+class Scenario:
+    """Concurrent requests to one endpoint and the checks run afterwards"""
+    name = None
+
+    def setup(self):
+        """Create the users and rows the requests act on"""
+        self.users = []
+        for name in ('hammer_alice', 'hammer_bob'):
+            user = User.objects.create_user(name)
+            UserProfile.objects.create(user=user)
+            self.users.append(user)
+        UserStats.rebuild([user.pk for user in self.users])
+
+    def prepare_round(self, number):
+        """Reset state before a round, if the endpoint only acts once"""
+
+    def request(self, client, number):
+        """Send one request; returns the response"""
+        raise NotImplementedError
+
+    def check(self, requests):
+        """Return a list of problems found in the data"""
+        problems = []
+        for stats in UserStats.compute([user.pk for user in self.users]):
+            row = UserStats.objects.get(pk=stats.user_id)
+            for field in UserStats.COUNTERS:
+                if getattr(row, field) != getattr(stats, field):
+                    problems.append(
+                        f'user {stats.user_id}: {field} is {getattr(row, field)}, expected {getattr(stats, field)}'
+                    )
+        return problems
+
+
+class ToggleFavorite(Scenario):
+    name = 'toggle_favorite'
+
+    def setup(self):
+        super().setup()
+        bob, alice = self.users[1], self.users[0]
+        self.note = LoveNote.objects.create(sender=bob, recipient=alice, content='Hammer', status='sent')
+        UserStats.rebuild([alice.pk, bob.pk])
+        self.login = alice
+
+    def request(self, client, number):
+        return client.post(reverse('kagai:toggle_favorite', args=[self.note.pk]))
+
+    def check(self, requests):
+        problems = super().check(requests)
+        favorites = Favorite.objects.filter(note=self.note).count()
+        # Every click flips the favorite, so the final state is the parity
+        if favorites != requests % 2:
+            problems.append(f'{favorites} favorites after {requests} toggles')
+        return problems
+
+
+class SendConnectionRequest(Scenario):
+    name = 'send_connection_request'
+
+    def setup(self):
+        super().setup()
+        self.login = self.users[0]
+
+    def prepare_round(self, number):
+        Connection.objects.filter(Q(user1__in=self.users) | Q(user2__in=self.users)).delete()
+        UserStats.rebuild([user.pk for user in self.users])
+
+    def request(self, client, number):
+        return client.get(reverse('kagai:send_connection_request', args=[self.users[1].username]))
+
+    def check(self, requests):
+        problems = super().check(requests)
+        if Connection.objects.filter(user1__in=self.users, user2__in=self.users).count() != 1:
+            problems.append('the pair does not have exactly one connection')
+        return problems
+
+
+class AcceptConnection(Scenario):
+    name = 'accept_connection'
+
+    def setup(self):
+        super().setup()
+        self.login = self.users[1]
+
+    def prepare_round(self, number):
+        Connection.objects.filter(user1__in=self.users).delete()
+        self.connection = Connection.objects.create(user1=self.users[0], user2=self.users[1])
+        UserStats.rebuild([user.pk for user in self.users])
+
+    def request(self, client, number):
+        return client.get(reverse('kagai:accept_connection', args=[self.connection.pk]))
+
+    def check(self, requests):
+        problems = super().check(requests)
+        if not Connection.objects.filter(pk=self.connection.pk, status='accepted').exists():
+            problems.append('the connection was not accepted')
+        return problems
+
+
+SCENARIOS = [ToggleFavorite, SendConnectionRequest, AcceptConnection]
+
+
+def hammer_worker(path, scenario, barrier, rounds, results):
+    timings, errors = [], 0
+    try:
+        with scratch_default(path):
+            client = Client(raise_request_exception=False)
+            client.force_login(scenario.login)
+            for number in range(rounds):
+                barrier.wait()
+                start = time.perf_counter()
+                response = scenario.request(client, number)
+                if response.status_code >= 500:
+                    errors += 1
+                else:
+                    timings.append((time.perf_counter() - start) * 1000)
+                # Let the main thread reset state before the next round
+                barrier.wait()
+    except Exception:
+        # Release the other threads instead of leaving them at the barrier
+        barrier.abort()
+        raise
+    results.append((timings, errors))
+
+
+def run_scenario(scenario_class, threads, rounds):
+    scenario = scenario_class()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'hammer.sqlite3'
+        copy_database(path)
+        barrier = threading.Barrier(threads + 1, timeout=60)
+        results = []
+        with scratch_default(path):
+            scenario.setup()
+            workers = [
+                threading.Thread(target=hammer_worker, args=(path, scenario, barrier, rounds, results))
+                for _ in range(threads)
+            ]
+            for worker_thread in workers:
+                worker_thread.start()
+            elapsed = 0.0
+            for number in range(rounds):
+                scenario.prepare_round(number)
+                barrier.wait()
+                start = time.monotonic()
+                barrier.wait()
+                elapsed += time.monotonic() - start
+            for worker_thread in workers:
+                worker_thread.join()
+            requests = sum(len(timings) for timings, _ in results)
+            problems = scenario.check(requests)
+
+    timings = [t for samples, _ in results for t in samples]
+    summary = summarize(timings, sum(errors for _, errors in results), elapsed)
+    summary['problems'] = problems
+    return summary
+
+
+def hammer(threads=4, rounds=20, names=None, log=None):
+    """
+    Race ``threads`` identical requests against each endpoint in
+    ``SCENARIOS`` for ``rounds`` rounds on a copy of the database. Returns
+    ``{scenario: summary}``; a summary lists any ``problems`` found in the
+    data afterwards and counts server errors as ``errors``.
+    """
+    log = log or (lambda message: None)
+    if connection.vendor != 'sqlite':
+        raise ValueError('The stress test only applies to SQLite databases')
+
+    results = {}
+    # DEBUG would log every query and turn database errors into debug pages
+    with override_settings(DEBUG=False, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for scenario_class in SCENARIOS:
+            if names and scenario_class.name not in names:
+                continue
+            results[scenario_class.name] = result = run_scenario(scenario_class, threads, rounds)
+            log(
+                f"{scenario_class.name:<24} {result['per_second']:>8.1f} req/s  "
+                f"p95 {result['p95_ms'] or 0:>7.2f}ms  errors {result['errors']}  "
+                f"{'; '.join(result['problems']) or 'consistent'}"
+            )
+    return results
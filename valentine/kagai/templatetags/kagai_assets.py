@@ -0,0 +1,63 @@
+from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+from kagai import assets
+
+register = template.Library()
+
+
+def _url(source):
+    return source if source.startswith('https://') else static(source)
+
+
+@register.simple_tag
+def asset_styles(bundle):
+    """
+    Stylesheets of an asset bundle::
+
+        {% asset_styles 'app' %}
+
+    Once ``build_assets`` has run, bundles with critical CSS inline it and
+    load the full stylesheet without blocking rendering, after preload hints
+    for it and the icon fonts the page shell uses. Before that, the source stylesheets and CDN
+    links are used.
+    """
+    manifest = assets.load_manifest()
+    if manifest is None:
+        return format_html_join(
+            '\n', '<link rel="stylesheet" href="{}">', ((_url(s),) for s in assets.fallback_sources(bundle, 'css'))
+        )
+
+    entry = manifest['bundles'][bundle]
+    href = static(entry['css'])
+    if 'critical' not in entry:
+        return format_html('<link rel="stylesheet" href="{}">', href)
+
+    preload = format_html_join(
+        '\n', '<link rel="preload" href="{}" as="{}" type="{}" crossorigin>',
+        ((static(item['path']), item['as'], item['type']) for item in entry['preload']),
+    )
+    return format_html(
+        '{}\n<link rel="preload" href="{}" as="style">\n'
+        '<style>{}</style>\n'
+        '<link rel="stylesheet" href="{}" media="print" onload="this.media=\'all\'">\n'
+        '<noscript><link rel="stylesheet" href="{}"></noscript>',
+        preload, href,
+        # Generated from our own stylesheets at build time; only a closing
+        # tag could break out of the <style> element
+        mark_safe(entry['critical_css'].replace('</', '<\\/')),
+        href, href,
+    )
+
+
+@register.simple_tag
+def asset_scripts(bundle):
+    """Deferred scripts of an asset bundle: ``{% asset_scripts 'app' %}``"""
+    manifest = assets.load_manifest()
+    if manifest is None:
+        sources = [_url(source) for source in assets.fallback_sources(bundle, 'js')]
+    else:
+        sources = [static(manifest['bundles'][bundle]['js'])]
+    return format_html_join('\n', '<script src="{}" defer></script>', ((source,) for source in sources))
@@ -0,0 +1,39 @@
+from django import template
+
+from kagai import cache
+
+register = template.Library()
+
+
+class FragmentNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        key = cache.make_key(name, *(var.resolve(context) for var in self.vary_on))
+        return cache.get_or_set(name, key, lambda: self.nodelist.render(context))
+
+
+@register.tag('fragment')
+def do_fragment(parser, token):
+    """
+    Cache a rendered template fragment through kagai.cache::
+
+        {% fragment 'user_card' user_obj.id %} ... {% endfragment %}
+
+    The name must be one of the fragment names in kagai.cache so that the
+    signal handlers know which keys to invalidate.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires a fragment name")
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        [parser.compile_filter(bit) for bit in bits[2:]],
+    )
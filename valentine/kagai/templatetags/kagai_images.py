@@ -0,0 +1,102 @@
+from functools import lru_cache
+
+from django import template
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from PIL import Image
+
+from kagai import assets
+from kagai.images import AVATAR_VARIANTS, MIME_TYPES
+
+register = template.Library()
+
+
+def _srcset(profile, fmt):
+    storage = profile.avatar.storage
+    return ', '.join(
+        f"{storage.url(variant[fmt])} {variant['size']}w"
+        for variant in sorted(profile.avatar_variants.values(), key=lambda v: v['size'])
+        if variant.get(fmt)
+    )
+
+
+@register.inclusion_tag('includes/avatar.html')
+def avatar(profile, variant, alt='', css_class='', sizes=None, loading='lazy'):
+    """
+    Render a profile avatar as a ``<picture>`` with WebP and JPEG sources::
+
+        {% avatar user_obj.profile 'thumb' user_obj.username 'avatar-md' '100px' %}
+
+    ``variant`` picks the fallback ``src`` and intrinsic size; browsers choose
+    from every built variant through ``srcset``/``sizes``. Pass
+    ``loading='eager'`` for above-the-fold images. Until the image worker has
+    processed an upload the original file is used.
+    """
+    edge = AVATAR_VARIANTS[variant]
+    ready = bool(profile.avatar and profile.avatar_variants.get(variant))
+    return {
+        'profile': profile,
+        'ready': ready,
+        'src': profile.avatar_url(variant) if profile.avatar else None,
+        'webp_srcset': _srcset(profile, 'webp') if ready else '',
+        'jpeg_srcset': _srcset(profile, 'jpeg') if ready else '',
+        'sizes': sizes or f'{edge}px',
+        'edge': edge,
+        'alt': alt,
+        'css_class': css_class,
+        'loading': loading,
+    }
+
+
+@lru_cache(maxsize=None)
+def _source_size(name):
+    """Dimensions of an unprocessed static image, read from its header"""
+    path = finders.find(name)
+    if path is None:
+        return None, None
+    with Image.open(path) as image:
+        return image.size
+
+
+@register.inclusion_tag('includes/picture.html')
+def picture(name, alt='', sizes='100vw', css_class='', style='', loading='lazy', fetchpriority=None):
+    """
+    Render a static image as a ``<picture>`` with AVIF, WebP and JPEG
+    sources at every width ``build_assets`` produced::
+
+        {% picture 'images/becky.jpeg' 'Lucy' sizes='(max-width: 440px) 90vw, 400px' %}
+
+    ``sizes`` should describe the rendered width so phones download the
+    narrow files. Width and height are always set, so the layout does not
+    shift while the image loads. Use ``loading='eager'`` (and
+    ``fetchpriority='high'``) for the main above-the-fold image. Before the
+    first build the original file is used.
+    """
+    manifest = assets.load_manifest()
+    digest = manifest['images'].get(name) if manifest else None
+    context = {
+        'alt': alt,
+        'css_class': css_class,
+        'style': style,
+        'loading': loading,
+        'fetchpriority': fetchpriority,
+        'sizes': sizes,
+    }
+    if digest is None:
+        width, height = _source_size(name)
+        return {**context, 'src': static(name), 'width': width, 'height': height, 'sources': []}
+
+    image_set = manifest['image_sets'][digest]
+    srcsets = {
+        fmt: ', '.join(f'{static(path)} {width}w' for width, path in files)
+        for fmt, files in image_set['variants'].items()
+    }
+    return {
+        **context,
+        'src': static(image_set['variants']['jpeg'][-1][1]),
+        'srcset': srcsets.pop('jpeg'),
+        'width': image_set['width'],
+        'height': image_set['height'],
+        'sources': [{'type': MIME_TYPES[fmt], 'srcset': srcset} for fmt, srcset in srcsets.items()],
+    }
+
@@ -0,0 +1,52 @@
+"""
+Query budget helpers for tests.
+
+Usable from Django ``TestCase`` methods and plain pytest functions alike::
+
+    with assert_max_queries(6):
+        client.get(url)
+
+    assert_view_query_budget(client, reverse('kagai:my_notes'), 8)
+"""
+from contextlib import contextmanager
+
+from .querystats import QueryRecorder
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _report(recorder):
+    lines = [f'{n}x {sql}' for sql, n in recorder.fingerprints.most_common()]
+    return '\n'.join(lines)
+
+
+@contextmanager
+def assert_max_queries(limit, max_duplicates=None, aliases=None):
+    """
+    Fail if the block runs more than ``limit`` queries, or, when
+    ``max_duplicates`` is given, repeats any query fingerprint more often
+    than that (the N+1 pattern).
+    """
+    recorder = QueryRecorder()
+    with recorder.record(aliases):
+        yield recorder
+
+    if recorder.count > limit:
+        raise QueryBudgetExceeded(
+            f'{recorder.count} queries executed, budget is {limit}:\n{_report(recorder)}'
+        )
+    if max_duplicates is not None:
+        duplicates = recorder.duplicates(threshold=max_duplicates + 1)
+        if duplicates:
+            raise QueryBudgetExceeded(
+                f'Query repeated more than {max_duplicates} times:\n{_report(recorder)}'
+            )
+
+
+def assert_view_query_budget(client, url, limit, method='get', max_duplicates=1, **kwargs):
+    """Request ``url`` with ``client`` and check it stays within its query budget"""
+    with assert_max_queries(limit, max_duplicates=max_duplicates):
+        response = getattr(client, method)(url, **kwargs)
+    return response
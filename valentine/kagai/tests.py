@@ -1,3 +1,2136 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import io
+import json
+import shutil
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import Q
+from django.template import Context, Template
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    assets, async_views, benchmark, events, exports, graph, recommendations, routers, search, stress, views,
+    cache as kagai_cache, urls as kagai_urls,
+)
+from .models import (
+    UserProfile, LoveNote, Connection, Favorite, UserStats, ImageJob, Notification, Recommendation,
+    RecommendationQueue, Interest, UserInterest,
+)
+from .pagination import EstimatedCountPaginator, InvalidCursor, KeysetPaginator, encode_cursor
+from .testing import QueryBudgetExceeded, assert_max_queries, assert_view_query_budget
+
+
+def make_user(username):
+    user = User.objects.create_user(username=username, password='password123')
+    UserProfile.objects.create(user=user)
+    return user
+
+
+class UserStatsTests(TestCase):
+    """The denormalized counters match COUNT queries after every write path"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.carol = make_user('carol')
+        UserStats.rebuild([cls.alice.pk, cls.bob.pk, cls.carol.pk])
+
+    def setUp(self):
+        cache.clear()
+
+    def assertCounted(self, *users):
+        for user in users:
+            notes = LoveNote.objects
+            connections = Connection.objects
+            expected = {
+                'sent_notes': notes.filter(sender=user, status='sent').count(),
+                'received_notes': notes.filter(recipient=user, status='sent').count(),
+                'total_sent_notes': notes.filter(sender=user).count(),
+                'total_received_notes': notes.filter(recipient=user).count(),
+                'connections': connections.filter(Q(user1=user) | Q(user2=user), status='accepted').count(),
+                'pending_requests': connections.filter(user2=user, status='pending').count(),
+                'unread_notifications': Notification.objects.filter(user=user, is_read=False).count(),
+            }
+            stats = UserStats.objects.get(pk=user.pk)
+            self.assertEqual({field: getattr(stats, field) for field in expected}, expected, user.username)
+
+    def send(self, sender, recipient, content='Hello'):
+        self.client.force_login(sender)
+        self.client.post(reverse('kagai:send_note', args=[recipient.username]), {'content': content})
+        return LoveNote.objects.filter(sender=sender, recipient=recipient).latest('id')
+
+    def test_sending_and_opening_notes(self):
+        self.send(self.alice, self.bob)
+        note = self.send(self.alice, self.bob, 'Again')
+        self.send(self.bob, self.alice)
+        self.assertCounted(self.alice, self.bob)
+
+        self.client.force_login(self.bob)
+        self.client.get(reverse('kagai:view_note', args=[note.id]))
+        self.assertEqual(UserStats.objects.get(pk=self.bob.pk).received_notes, 1)
+        self.assertCounted(self.alice, self.bob)
+
+    def test_bulk_send_and_delete(self):
+        self.client.force_login(self.alice)
+        self.client.post(
+            reverse('kagai:bulk_send_notes'),
+            {'recipients': ['bob', 'carol'], 'content': 'Hi'}, content_type='application/json',
+        )
+        self.assertEqual(UserStats.objects.get(pk=self.alice.pk).sent_notes, 2)
+        self.assertCounted(self.alice, self.bob, self.carol)
+        ids = list(LoveNote.objects.filter(recipient=self.bob).values_list('id', flat=True))
+        self.client.post(reverse('kagai:bulk_delete_notes'), {'ids': ids}, content_type='application/json')
+        self.assertCounted(self.alice, self.bob, self.carol)
+
+    def test_connection_lifecycle(self):
+        self.client.force_login(self.alice)
+        self.client.post(reverse('kagai:send_connection_request', args=['bob']))
+        self.client.post(reverse('kagai:send_connection_request', args=['carol']))
+        self.assertCounted(self.alice, self.bob, self.carol)
+
+        to_bob = Connection.objects.get(user2=self.bob)
+        self.client.force_login(self.bob)
+        self.client.post(reverse('kagai:accept_connection', args=[to_bob.id]))
+        self.assertEqual(UserStats.objects.get(pk=self.bob.pk).connections, 1)
+        self.assertCounted(self.alice, self.bob)
+
+        self.client.force_login(self.carol)
+        self.client.post(reverse('kagai:reject_connection', args=[Connection.objects.get(user2=self.carol).id]))
+        self.assertCounted(self.alice, self.carol)
+
+        self.client.force_login(self.alice)
+        self.client.post(reverse('kagai:remove_connection', args=[to_bob.id]))
+        self.assertFalse(Connection.objects.filter(pk=to_bob.pk).exists())
+        self.assertCounted(self.alice, self.bob, self.carol)
+
+    def test_missing_rows_are_rebuilt(self):
+        LoveNote.objects.create(sender=self.alice, recipient=self.bob, content='Hi', status='sent')
+        UserStats.objects.filter(pk__in=[self.alice.pk, self.bob.pk]).delete()
+        self.assertEqual(UserStats.for_user(self.alice).sent_notes, 1)
+        # A bump on a missing row rebuilds it from the write it accounts for
+        LoveNote.objects.create(sender=self.carol, recipient=self.bob, content='Hey', status='sent')
+        UserStats.bump(self.bob, received_notes=1, total_received_notes=1)
+        self.assertCounted(self.alice, self.bob)
+
+    def test_rebuild_command(self):
+        self.send(self.alice, self.bob)
+        UserStats.objects.update(sent_notes=7, connections=-3)
+        UserStats.objects.filter(pk=self.carol.pk).delete()
+        call_command('rebuild_user_stats', batch_size=2, stdout=io.StringIO())
+        self.assertCounted(self.alice, self.bob, self.carol)
+
+
+class SearchTests(TestCase):
+    """Full-text search of users and notes, its index upkeep and the LIKE fallback"""
+
+    @classmethod
+    def setUpTestData(cls):
+        people = {
+            'jazzfan': ('F', 'Music lover', 'Jazz'),
+            'alice': ('F', 'Into jazz and hiking', 'Jazz, Hiking'),
+            'bob': ('M', 'Jazz on weekends', 'Hiking'),
+            'carol': ('F', 'Chess player', 'Chess'),
+        }
+        for username, (gender, bio, interests) in people.items():
+            user = make_user(username)
+            user.profile.gender = gender
+            user.profile.bio = bio
+            user.profile.set_interests(interests)
+            user.profile.save()
+            setattr(cls, username, user)
+        cls.titled = LoveNote.objects.create(
+            sender=cls.bob, recipient=cls.alice, title='Roses', content='For you', status='sent',
+        )
+        cls.mentioned = LoveNote.objects.create(
+            sender=cls.carol, recipient=cls.alice, title='Hi', content='I grew roses for you', status='sent',
+        )
+        cls.elsewhere = LoveNote.objects.create(
+            sender=cls.alice, recipient=cls.bob, title='Roses', content='Roses again', status='sent',
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.backend = search.get_search_backend()
+        self.assertIsInstance(self.backend, search.SQLiteFTSBackend)
+
+    def usernames(self, ids):
+        names = dict(User.objects.filter(id__in=ids).values_list('id', 'username'))
+        return [names[user_id] for user_id in ids]
+
+    def test_users_ranked_by_bm25(self):
+        # A username hit outweighs the same word in a bio
+        self.assertEqual(self.usernames(self.backend.search_users('jazz'))[0], 'jazzfan')
+        self.assertEqual(set(self.usernames(self.backend.search_users('jaz'))), {'jazzfan', 'alice', 'bob'})
+        # Every term must match; alice also has both as interests
+        self.assertEqual(self.usernames(self.backend.search_users('jazz hiking')), ['alice', 'bob'])
+        self.assertEqual(self.backend.search_users('!!!'), [])
+
+    def test_user_filters(self):
+        backend = self.backend
+        self.assertEqual(set(self.usernames(backend.search_users('jazz', gender='F'))), {'jazzfan', 'alice'})
+        self.assertEqual(set(self.usernames(backend.search_users('jazz', interest='hiking'))), {'alice', 'bob'})
+        self.assertEqual(self.usernames(backend.search_users('jazz', gender='M', interest='hiking')), ['bob'])
+        self.assertEqual(
+            self.usernames(backend.search_users('jazz', exclude_id=self.alice.pk, gender='F', interest='jazz')), ['jazzfan'],
+        )
+        self.assertEqual(len(backend.search_users('jazz', limit=1, offset=2)), 1)
+
+    def test_notes_ranked_within_the_owners_box(self):
+        self.assertEqual(self.backend.search_notes(self.alice, 'roses'), [self.titled.id, self.mentioned.id])
+        self.assertEqual(self.backend.search_notes(self.alice, 'roses', box='sent'), [self.elsewhere.id])
+        self.assertEqual(self.backend.search_notes(self.carol, 'roses'), [])
+
+    def test_join_filters_use_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.search_users('jazz', exclude_id=self.alice.pk, gender='F', interest='jazz')
+            self.backend.search_notes(self.alice, 'roses')
+        for query in queries.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {query["sql"]}')
+                plan = [row[3] for row in cursor.fetchall()]
+            self.assertFalse([step for step in plan if step.startswith('SCAN') and 'VIRTUAL TABLE' not in step], plan)
+
+    def test_browse_search_applies_the_interest_filter(self):
+        self.client.force_login(self.carol)
+        response = self.client.get(reverse('kagai:browse_users_json'), {'q': 'jazz', 'interest': 'hiking'})
+        data = response.json()
+        self.assertEqual({user['username'] for user in data['results']}, {'alice', 'bob'})
+        self.assertIsNone(data['next_cursor'])
+
+        # The best match, jazzfan, does not list hiking; the page still fills
+        with mock.patch('kagai.views.USERS_PER_PAGE', 1):
+            data = self.client.get(reverse('kagai:browse_users_json'), {'q': 'jazz', 'interest': 'hiking'}).json()
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_signals_keep_the_index_current(self):
+        self.carol.profile.bio = 'Saxophone nights'
+        self.carol.profile.save()
+        self.assertEqual(self.usernames(self.backend.search_users('saxophone')), ['carol'])
+        self.assertEqual(self.backend.search_users('chess player'), [])
+
+        self.carol.username = 'caroline'
+        self.carol.save()
+        self.assertEqual(self.usernames(self.backend.search_users('caroline')), ['caroline'])
+
+        self.titled.content = 'Tulips'
+        self.titled.save()
+        self.assertEqual(self.backend.search_notes(self.alice, 'tulips'), [self.titled.id])
+        self.mentioned.delete()
+        self.assertEqual(self.backend.search_notes(self.alice, 'roses'), [self.titled.id])
+
+        self.carol.delete()
+        self.assertEqual(self.backend.search_users('saxophone'), [])
+
+    def test_logins_do_not_reindex(self):
+        with mock.patch.object(search.SQLiteFTSBackend, 'index_user') as index_user:
+            self.client.login(username='alice', password='password123')
+            self.alice.save(update_fields=['last_login'])
+            index_user.assert_not_called()
+            self.alice.save(update_fields=['first_name'])
+            index_user.assert_called_once()
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.backend.USER_TABLE}')
+            cursor.execute(f'DELETE FROM {self.backend.NOTE_TABLE}')
+        self.assertEqual(self.backend.search_users('jazz'), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.usernames(self.backend.search_users('jazz'))[0], 'jazzfan')
+        self.assertEqual(self.backend.search_notes(self.alice, 'roses'), [self.titled.id, self.mentioned.id])
+
+    def test_like_fallback(self):
+        with mock.patch.object(search.SQLiteFTSBackend, 'is_available', return_value=False):
+            search._backend = None
+            self.addCleanup(setattr, search, '_backend', None)
+            backend = search.get_search_backend()
+        self.assertIsInstance(backend, search.LikeSearchBackend)
+        # Ordered by username and newest first instead of by relevance
+        self.assertEqual(self.usernames(backend.search_users('jazz')), ['alice', 'bob', 'jazzfan'])
+        self.assertEqual(self.usernames(backend.search_users('jazz', gender='F', interest='hiking')), ['alice'])
+        self.assertEqual(backend.search_notes(self.alice, 'roses'), [self.mentioned.id, self.titled.id])
+        self.assertEqual(backend.search_notes(self.alice, 'roses', box='sent'), [self.elsewhere.id])
+
+
+class InterestTests(TestCase):
+    """Normalized interest tags, the browse filter and the shared-interests sort"""
+
+    @classmethod
+    def setUpTestData(cls):
+        people = {
+            'alice': 'Jazz, Hiking, Chess',
+            'bob': 'jazz, hiking, chess, Poetry',
+            'carol': 'Hiking, Chess',
+            'dave': 'Chess, Jazz',
+            'erin': 'Hiking',
+            'frank': 'Knitting',
+            'gina': '',
+        }
+        for username, interests in people.items():
+            user = make_user(username)
+            user.profile.set_interests(interests)
+            user.profile.save()
+            setattr(cls, username, user)
+
+    def setUp(self):
+        cache.clear()
+
+    def tags(self, user):
+        return [
+            (tag.interest.slug, tag.interest.name)
+            for tag in user.profile.profile_interests.select_related('interest').order_by('position')
+        ]
+
+    def browse(self, **params):
+        response = self.client.get(reverse('kagai:browse_users_json'), params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [user['username'] for user in data['results']], data['next_cursor']
+
+    def test_set_interests(self):
+        profile = self.gina.profile
+        profile.set_interests('  Rock   &  Roll ,jazz,, JAZZ, ' + ', '.join(f'Tag {i}' for i in range(30)))
+        # The raw string is kept as typed
+        self.assertTrue(profile.interests.startswith('  Rock   &  Roll ,jazz'))
+        tags = self.tags(self.gina)
+        self.assertEqual(tags[:2], [('rock-roll', 'Rock & Roll'), ('jazz', 'Jazz')])
+        self.assertEqual(len(tags), 20)
+        # Tags are shared; the first spelling names them
+        self.assertEqual(Interest.objects.filter(slug='jazz').count(), 1)
+
+        profile.set_interests('Chess')
+        self.assertEqual(self.tags(self.gina), [('chess', 'Chess')])
+
+    def test_migration_parses_existing_strings(self):
+        migration = importlib.import_module('kagai.migrations.0008_populate_interests')
+        UserProfile.objects.filter(user=self.frank).update(interests='Knitting, , knitting,Board   Games')
+        UserInterest.objects.all().delete()
+        Interest.objects.all().delete()
+
+        migration.populate_interests(django_apps, None)
+        self.assertEqual(self.tags(self.frank), [('knitting', 'Knitting'), ('board-games', 'Board Games')])
+        self.assertEqual(
+            self.tags(self.bob), [('jazz', 'Jazz'), ('hiking', 'Hiking'), ('chess', 'Chess'), ('poetry', 'Poetry')],
+        )
+        self.assertEqual(self.tags(self.gina), [])
+        self.assertEqual(Interest.objects.count(), 6)
+
+    def test_interest_filter(self):
+        self.client.force_login(self.alice)
+        users, _ = self.browse(interest='jazz', sort='username')
+        self.assertEqual(users, ['bob', 'dave'])
+        self.assertEqual(self.browse(interest='unknown')[0], [])
+
+    def test_shared_interests_sort_pages_by_cursor(self):
+        self.client.force_login(self.alice)
+        pages, cursor = [], None
+        with mock.patch('kagai.views.USERS_PER_PAGE', 2):
+            while True:
+                users, cursor = self.browse(sort='overlap', **({'cursor': cursor} if cursor else {}))
+                pages.append(users)
+                if cursor is None:
+                    break
+        # Most shared first, ties newest first; no shared interest, no listing
+        self.assertEqual(pages, [['bob', 'dave'], ['carol', 'erin']])
+
+        response = self.client.get(reverse('kagai:browse_users_json'), {'sort': 'overlap', 'cursor': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_shared_interests_sort_without_interests_falls_back(self):
+        self.client.force_login(self.gina)
+        response = self.client.get(reverse('kagai:browse_users'), {'sort': 'overlap'})
+        self.assertEqual(response.context['sort'], '-created_at')
+        self.assertEqual(len(response.context['users']), 6)
+
+
+class FragmentCacheTests(TestCase):
+    """Fragment caching, its hit/miss counters and on-commit invalidation"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.note = LoveNote.objects.create(sender=cls.alice, recipient=cls.bob, content='Hi', status='sent')
+
+    def setUp(self):
+        kagai_cache.get_cache().clear()
+
+    def render(self, name, user_id, value):
+        template = Template('{% load kagai_cache %}{% fragment name user_id %}{{ value }}{% endfragment %}')
+        return template.render(Context({'name': name, 'user_id': user_id, 'value': value}))
+
+    def cached(self, name, user_id):
+        return kagai_cache.get_cache().get(kagai_cache.make_key(name, user_id))
+
+    def fill(self):
+        """Cache every fragment of both users and the global stats"""
+        for user in (self.alice, self.bob):
+            for name in (*kagai_cache.PROFILE_FRAGMENTS, *kagai_cache.DASHBOARD_FRAGMENTS):
+                self.render(name, user.pk, 'cached')
+        kagai_cache.get_or_set(kagai_cache.GLOBAL_STATS, kagai_cache.make_key(kagai_cache.GLOBAL_STATS), dict)
+
+    def assertEvicted(self, *fragments):
+        for name, user in fragments:
+            self.assertIsNone(self.cached(name, user.pk), f'{name} of {user.username}')
+
+    def assertKept(self, *fragments):
+        for name, user in fragments:
+            self.assertEqual(self.cached(name, user.pk), 'cached', f'{name} of {user.username}')
+
+    def test_hits_and_misses(self):
+        self.assertEqual(self.render('user_card', self.alice.pk, 'first'), 'first')
+        self.assertEqual(self.render('user_card', self.alice.pk, 'second'), 'first')
+        self.assertEqual(self.render('user_card', self.bob.pk, 'third'), 'third')
+        stats = kagai_cache.stats()
+        self.assertEqual((stats['user_card']['hit'], stats['user_card']['miss']), (1, 2))
+        self.assertAlmostEqual(stats['user_card']['ratio'], 1 / 3)
+        self.assertEqual(stats['dashboard_notes'], {'hit': 0, 'miss': 0, 'ratio': None})
+
+        kagai_cache.reset_stats()
+        self.assertEqual(kagai_cache.stats()['user_card']['miss'], 0)
+
+    @override_settings(KAGAI_CACHE={'STATS': False})
+    def test_counters_can_be_disabled(self):
+        self.render('user_card', self.alice.pk, 'first')
+        self.assertEqual(kagai_cache.stats()['user_card']['miss'], 0)
+
+    def test_evictions_wait_for_the_commit(self):
+        self.fill()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.alice.profile.save()
+            self.assertKept(('user_card', self.alice))
+        for callback in callbacks:
+            callback()
+        self.assertEvicted(('user_card', self.alice))
+
+    def test_profile_saves_evict_profile_fragments(self):
+        for instance in (self.alice, self.alice.profile):
+            self.fill()
+            with self.captureOnCommitCallbacks(execute=True):
+                instance.save()
+            self.assertEvicted(('user_card', self.alice), ('profile_details', self.alice))
+            self.assertKept(('user_card', self.bob), ('dashboard_stats', self.alice))
+
+    def test_note_saves_evict_both_dashboards(self):
+        for change in (self.note.save, self.note.delete):
+            self.fill()
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.assertEvicted(*(
+                (name, user) for name in kagai_cache.DASHBOARD_FRAGMENTS for user in (self.alice, self.bob)
+            ))
+            self.assertIsNone(kagai_cache.get_cache().get(kagai_cache.make_key(kagai_cache.GLOBAL_STATS)))
+            self.assertKept(('user_card', self.alice), ('profile_details', self.bob))
+
+    def test_connection_and_favorite_saves_evict_dashboards(self):
+        # The race-free Connection.request and Favorite.add insert with raw SQL
+        creates = [
+            (lambda: Connection.objects.create(user1=self.alice, user2=self.bob),
+             lambda: Favorite.objects.create(user=self.bob, note=self.note)),
+            (lambda: Connection.request(self.alice, self.bob), lambda: Favorite.add(self.bob, self.note)),
+        ]
+        for create_connection, create_favorite in creates:
+            Connection.objects.all().delete()
+            Favorite.objects.all().delete()
+            self.fill()
+            with self.captureOnCommitCallbacks(execute=True):
+                create_connection()
+            self.assertEvicted(('dashboard_stats', self.alice), ('dashboard_stats', self.bob))
+
+            self.fill()
+            with self.captureOnCommitCallbacks(execute=True):
+                create_favorite()
+            self.assertEvicted(('dashboard_notes', self.bob))
+            self.assertKept(('dashboard_notes', self.alice))
+
+    def test_profile_page_shows_a_saved_bio(self):
+        self.client.force_login(self.bob)
+        self.client.get(reverse('kagai:profile', args=['alice']))
+        self.assertIsNotNone(self.cached('profile_details', self.alice.pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.profile.bio = 'Collects vinyl'
+            self.alice.profile.save()
+        self.assertContains(self.client.get(reverse('kagai:profile', args=['alice'])), 'Collects vinyl')
+
+
+class QueryPlanTests(TestCase):
+    """
+    Run EXPLAIN QUERY PLAN over every query a view issues against the kagai
+    tables and fail if SQLite falls back to a full table scan or has to sort
+    the rows in a temporary B-tree.
+    """
+
+    # Scans that are bounded by design, spelled out in full so any other
+    # SCAN step, including one over an aliased or subquery table, fails
+    ALLOWED_SCANS = {
+        # browse_users walks the (date_joined, id) index in order and stops at the page size
+        'SCAN auth_user USING INDEX kagai_user_joined_idx',
+        # EstimatedCountPaginator counts a LIMIT-capped subquery of indexed matches
+        'SCAN subquery',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.carol = make_user('carol')
+        cls.note = LoveNote.objects.create(
+            sender=cls.bob, recipient=cls.alice, content='Hello', status='sent'
+        )
+        LoveNote.objects.create(sender=cls.alice, recipient=cls.bob, content='Hi', status='opened')
+        Connection.objects.create(user1=cls.bob, user2=cls.alice, status='accepted')
+        Connection.objects.create(user1=cls.carol, user2=cls.alice)
+        Favorite.objects.create(user=cls.alice, note=cls.note)
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plan assertions are written against SQLite')
+        cache.clear()
+        # Loading the connection graph scans every accepted connection once
+        # per process; build it up front so only per-request queries count
+        graph.reset()
+        graph.get_graph()
+        self.client.force_login(self.alice)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedQueries(self, queries, allow_sort=False):
+        checked = 0
+        for query in queries:
+            sql = query['sql']
+            if '"kagai_' not in sql or not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            checked += 1
+            for detail in self.explain(sql):
+                # A full-text MATCH shows up as a scan of the FTS5 virtual table's index
+                if detail.startswith('SCAN') and 'VIRTUAL TABLE INDEX' not in detail:
+                    if detail not in self.ALLOWED_SCANS:
+                        self.fail(f'Full scan "{detail}" in:\n{sql}')
+                if 'TEMP B-TREE' in detail and not allow_sort:
+                    self.fail(f'Temporary sort "{detail}" in:\n{sql}')
+        return checked
+
+    def assertViewIndexed(self, url, method='get', allow_sort=False, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400)
+        self.assertGreater(self.assertIndexedQueries(ctx.captured_queries, allow_sort), 0)
+
+    def test_home(self):
+        self.client.logout()
+        self.assertViewIndexed(reverse('kagai:home'))
+
+    def test_dashboard(self):
+        self.assertViewIndexed(reverse('kagai:dashboard'))
+
+    def test_profile(self):
+        self.assertViewIndexed(reverse('kagai:profile', args=['bob']))
+
+    def test_view_note(self):
+        self.assertViewIndexed(reverse('kagai:view_note', args=[self.note.id]))
+
+    def test_my_notes(self):
+        self.assertViewIndexed(reverse('kagai:my_notes'))
+
+    def test_send_connection_request(self):
+        self.assertViewIndexed(reverse('kagai:send_connection_request', args=['carol']))
+
+    def test_toggle_favorite(self):
+        self.assertViewIndexed(reverse('kagai:toggle_favorite', args=[self.note.id]), method='post')
+
+    def test_user_stats_rebuild(self):
+        with CaptureQueriesContext(connection) as ctx:
+            UserStats.compute([self.alice.id, self.bob.id])
+        self.assertEqual(self.assertIndexedQueries(ctx.captured_queries), 8)
+
+    def test_browse_users(self):
+        self.assertViewIndexed(reverse('kagai:browse_users'))
+
+    def test_notifications(self):
+        Notification.notify(self.alice, 'note', actor=self.bob, note=self.note)
+        self.assertViewIndexed(reverse('kagai:notifications'))
+
+    def test_admin_search(self):
+        User.objects.create_superuser('admin', password='password123')
+        self.client.login(username='admin', password='password123')
+        for model in ('lovenote', 'favorite', 'connection', 'notification', 'userprofile', 'userstats'):
+            with self.subTest(model=model):
+                # Matches from several indexes are sorted, but only the matches
+                self.assertViewIndexed(reverse(f'admin:kagai_{model}_changelist') + '?q=bob', allow_sort=True)
+
+    def test_export_data(self):
+        with CaptureQueriesContext(connection) as ctx:
+            for dataset in ('notes', 'connections'):
+                b''.join(self.client.get(reverse('kagai:export_data', args=[dataset])).streaming_content)
+        self.assertEqual(self.assertIndexedQueries(ctx.captured_queries), 4)
+
+
+class KeysetPaginationTests(TestCase):
+    """Cursor pages cover every row once, in order, and bad cursors never 500"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        notes = [
+            LoveNote.objects.create(sender=cls.bob, recipient=cls.alice, content=f'Note {i}')
+            for i in range(7)
+        ]
+        # Three notes share a timestamp so only the id breaks the tie
+        tied = timezone.now() - timedelta(days=1)
+        LoveNote.objects.filter(id__in=[note.id for note in notes[2:5]]).update(created_at=tied)
+        cls.expected = list(
+            LoveNote.objects.filter(recipient=cls.alice).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        for i in range(5):
+            make_user(f'user{i}')
+        UserStats.rebuild([cls.alice.pk, cls.bob.pk])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def paginator(self):
+        return KeysetPaginator(LoveNote.objects.filter(recipient=self.alice), ('-created_at', '-id'), per_page=3)
+
+    def test_next_cursors_walk_every_row_once_in_order(self):
+        paginator = self.paginator()
+        first = paginator.page()
+        self.assertTrue(first.has_next)
+        seen, page = [note.id for note in first], first
+        while page.has_next:
+            page = paginator.page(page.next_cursor)
+            seen.extend(note.id for note in page)
+        self.assertEqual(seen, self.expected)
+        self.assertIsNone(page.next_cursor)
+        # Without a cursor the paginator is back on the first page
+        self.assertEqual([note.id for note in paginator.page()], self.expected[:3])
+
+    def test_cursor_inside_a_tie_resumes_after_it(self):
+        paginator = self.paginator()
+        second = paginator.page(paginator.page().next_cursor)
+        # The first page ends inside the tied run; the second picks up the rest of it
+        self.assertEqual([note.id for note in second], self.expected[3:6])
+
+    def test_invalid_cursors_raise_invalid_cursor(self):
+        paginator = self.paginator()
+        token = paginator.page().next_cursor
+        tampered = token[:-1] + ('B' if token.endswith('A') else 'A')
+        for cursor in ('garbage', tampered, encode_cursor([1]), encode_cursor({'id': 1})):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                paginator.page(cursor)
+
+    def test_html_pages_fall_back_to_the_first_page(self):
+        pages = (('kagai:my_notes', 'received'), ('kagai:my_notes', 'sent'), ('kagai:browse_users', 'cursor'))
+        for name, param in pages:
+            with self.subTest(name=name, param=param):
+                response = self.client.get(reverse(name), {param: 'tampered'}, follow=True)
+                self.assertRedirects(response, reverse(name))
+                self.assertContains(response, 'That page link is no longer valid')
+
+    def test_json_endpoints_reject_invalid_cursors(self):
+        for name in ('kagai:my_notes_json', 'kagai:browse_users_json'):
+            with self.subTest(name=name):
+                response = self.client.get(reverse(name), {'cursor': 'tampered'})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+    def follow_json(self, name, key, **params):
+        seen, cursor = [], None
+        while True:
+            data = self.client.get(reverse(name), {**params, **({'cursor': cursor} if cursor else {})}).json()
+            seen.extend(item[key] for item in data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return seen
+
+    @mock.patch('kagai.views.NOTES_PER_PAGE', 3)
+    def test_notes_json_next_links(self):
+        self.assertEqual(self.follow_json('kagai:my_notes_json', 'id', box='received'), self.expected)
+        self.assertEqual(self.follow_json('kagai:my_notes_json', 'id', box='sent'), [])
+
+    @mock.patch('kagai.views.USERS_PER_PAGE', 2)
+    def test_browse_json_next_links(self):
+        # Give the newest accounts all the same join date to exercise the id tiebreak
+        User.objects.filter(username__in=['user2', 'user3', 'user4']).update(date_joined=timezone.now())
+        expected = list(
+            User.objects.exclude(id=self.alice.id).order_by('-date_joined', '-id').values_list('username', flat=True)
+        )
+        self.assertEqual(self.follow_json('kagai:browse_users_json', 'username', sort='-created_at'), expected)
+        self.assertEqual(
+            self.follow_json('kagai:browse_users_json', 'username', sort='username'),
+            sorted(expected),
+        )
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Each view must run a fixed number of queries however many rows it lists;
+    a repeated query fingerprint means a lazy relation is loaded in a loop.
+    """
+    NOTES = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        others = [make_user(f'user{i}') for i in range(cls.NOTES)]
+        for other in others:
+            LoveNote.objects.create(sender=other, recipient=cls.alice, content='Hello', status='sent')
+            LoveNote.objects.create(sender=cls.alice, recipient=other, content='Hi', status='sent')
+            Connection.objects.create(user1=other, user2=cls.alice)
+        UserStats.rebuild(User.objects.values_list('id', flat=True))
+        cls.note = LoveNote.objects.filter(recipient=cls.alice).first()
+        Favorite.objects.create(user=cls.alice, note=cls.note)
+        # Neighbours alice is not connected to yet, so browse_users lists
+        # recommendations
+        for i in range(3):
+            make_user(f'neighbour{i}')
+        UserProfile.objects.update(location='Nairobi')
+        recommendations.run(full=True)
+
+    def setUp(self):
+        cache.clear()
+        graph.reset()
+        graph.get_graph()
+        self.client.force_login(self.alice)
+
+    def test_dashboard(self):
+        assert_view_query_budget(self.client, reverse('kagai:dashboard'), 5)
+
+    # Full renders of the conditional pages include one validator query for
+    # their ETag (see kagai.conditional)
+    def test_my_notes(self):
+        assert_view_query_budget(self.client, reverse('kagai:my_notes'), 6)
+
+    def test_my_notes_json(self):
+        assert_view_query_budget(self.client, reverse('kagai:my_notes_json'), 3)
+
+    def test_browse_users(self):
+        assert_view_query_budget(self.client, reverse('kagai:browse_users'), 5)
+        assert_view_query_budget(self.client, reverse('kagai:browse_users') + '?sort=-created_at', 5)
+
+    def test_profile(self):
+        assert_view_query_budget(self.client, reverse('kagai:profile', args=['user0']), 8)
+
+    def test_view_note(self):
+        assert_view_query_budget(self.client, reverse('kagai:view_note', args=[self.note.id]), 11)
+
+    def test_not_modified(self):
+        # Session, user, validators and the navbar stats; nothing is rendered
+        self.client.get(reverse('kagai:view_note', args=[self.note.id]))
+        for url in (
+            reverse('kagai:dashboard'), reverse('kagai:my_notes'),
+            reverse('kagai:profile', args=['user0']), reverse('kagai:view_note', args=[self.note.id]),
+        ):
+            etag = self.client.get(url)['ETag']
+            response = assert_view_query_budget(self.client, url, 4, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+
+    def test_query_stats_middleware(self):
+        # Off unless asked for; the middleware is set up with the first request
+        stats = {**settings.KAGAI_QUERY_STATS, 'ENABLED': True, 'MAX_QUERIES': 1}
+        client = Client()
+        client.force_login(self.alice)
+        with override_settings(KAGAI_QUERY_STATS=stats), self.assertLogs('kagai.perf', 'WARNING') as logs:
+            response = client.get(reverse('kagai:dashboard'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", total;dur=[\d.]+$')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['event'], record['view']), ('slow_request', 'kagai:dashboard'))
+        self.assertIn('queries', record['reasons'])
+
+    def test_budget_failure_lists_queries(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with assert_max_queries(1):
+                list(LoveNote.objects.all())
+                list(Connection.objects.all())
+
+
+class ImagePipelineTests(TestCase):
+    """Avatar uploads are queued and resized by the process_image_jobs worker"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = make_user('alice')
+        self.client.force_login(self.user)
+
+    def upload(self, size=(800, 600), mode='RGB'):
+        buffer = io.BytesIO()
+        Image.new(mode, size, 'red').save(buffer, format='PNG')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('kagai:edit_profile'), {
+                'avatar': SimpleUploadedFile('me.png', buffer.getvalue(), content_type='image/png'),
+            })
+        return UserProfile.objects.get(user=self.user)
+
+    def test_upload_queues_job_and_worker_builds_variants(self):
+        profile = self.upload()
+        job = ImageJob.objects.get(profile=profile)
+        self.assertEqual((job.status, job.source), ('pending', profile.avatar.name))
+        self.assertEqual(profile.avatar_variants, {})
+
+        call_command('process_image_jobs', '--once', stdout=io.StringIO())
+
+        job.refresh_from_db()
+        profile.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(set(profile.avatar_variants), {'thumb', 'medium'})
+        with profile.avatar.storage.open(profile.avatar_variants['thumb']['webp']) as file:
+            image = Image.open(file)
+            self.assertEqual((image.format, image.size), ('WEBP', (128, 128)))
+        with profile.avatar.storage.open(profile.avatar_variants['medium']['jpeg']) as file:
+            image = Image.open(file)
+            self.assertEqual((image.format, image.size), ('JPEG', (320, 320)))
+            self.assertNotIn('exif', image.info)
+
+        html = Template("{% load kagai_images %}{% avatar profile 'thumb' 'alice' %}").render(
+            Context({'profile': profile})
+        )
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('128w', html)
+        self.assertIn('320w', html)
+
+    def test_superseded_job_is_skipped(self):
+        self.upload()
+        profile = self.upload(size=(50, 50), mode='RGBA')
+        call_command('process_image_jobs', '--once', stdout=io.StringIO())
+
+        jobs = ImageJob.objects.filter(profile=profile).order_by('id')
+        self.assertEqual([job.status for job in jobs], ['done', 'done'])
+        self.assertEqual(jobs[0].error, 'Superseded by a newer avatar')
+        profile.refresh_from_db()
+        with profile.avatar.storage.open(profile.avatar_variants['thumb']['jpeg']) as file:
+            self.assertEqual(Image.open(file).size, (128, 128))
+        self.assertEqual(len(profile.avatar_variants), 2)
+
+
+class BenchmarkTests(TestCase):
+    """The benchmark covers every route and runs against seeded data"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', users=20, notes=5, connections=2, favorites=1, stdout=io.StringIO())
+
+    def test_every_route_is_benchmarked(self):
+        self.assertEqual(benchmark.missing_routes(), [])
+
+    def test_run(self):
+        results = benchmark.run(requests=2, warmup=1)
+        self.assertEqual(len(results['routes']), len([route for route in benchmark.ROUTES if not route.stream]))
+        for label, result in results['routes'].items():
+            self.assertLess(result['status'], 400, label)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertIsNotNone(result['queries'])
+        self.assertEqual(results['meta']['rows']['users'], 20)
+        # Writes were rolled back
+        self.assertEqual(LoveNote.objects.count(), 100)
+
+
+class AsyncURLConf:
+    """kagai.urls with the async read views swapped in, as KAGAI_ASYNC_VIEWS does"""
+    urlpatterns = [path('', include(([
+        path(str(pattern.pattern), getattr(async_views, pattern.name, pattern.callback), name=pattern.name)
+        for pattern in kagai_urls.urlpatterns
+    ], 'kagai')))]
+
+
+@override_settings(ROOT_URLCONF=AsyncURLConf)
+class AsyncViewTests(TestCase):
+    """The async views render without touching the database lazily"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.alice.profile.set_interests('Hiking, Jazz')
+        cls.bob.profile.set_interests('Jazz')
+        cls.note = LoveNote.objects.create(sender=cls.bob, recipient=cls.alice, title='Hey', content='Hello', status='sent')
+        LoveNote.objects.create(sender=cls.alice, recipient=cls.bob, content='Hi', status='sent')
+        Connection.objects.create(user1=cls.bob, user2=cls.alice, status='accepted')
+        UserStats.rebuild([cls.alice.id, cls.bob.id])
+
+    def setUp(self):
+        cache.clear()
+        # Make the first search look the backend up from inside the event loop
+        search._backend = None
+
+    async def test_read_views(self):
+        await self.async_client.aforce_login(self.alice)
+        urls = [
+            reverse('kagai:dashboard'),
+            reverse('kagai:profile', args=['bob']),
+            reverse('kagai:browse_users'),
+            reverse('kagai:browse_users') + '?sort=overlap',
+            reverse('kagai:browse_users') + '?q=bob',
+            reverse('kagai:my_notes'),
+            reverse('kagai:my_notes') + '?q=hello',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = await self.async_client.get(url)
+                self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(reverse('kagai:browse_users') + '?sort=overlap')
+        self.assertEqual([user.username for user in response.context['users']], ['bob'])
+
+    async def test_view_note_marks_opened(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('kagai:view_note', args=[self.note.id]))
+        self.assertContains(response, 'Hello')
+        await self.note.arefresh_from_db()
+        self.assertEqual(self.note.status, 'opened')
+        stats = await UserStats.objects.aget(pk=self.alice.pk)
+        self.assertEqual(stats.received_notes, 0)
+
+    async def test_invalid_cursor_redirects(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('kagai:my_notes') + '?received=bogus')
+        self.assertRedirects(response, reverse('kagai:my_notes'), fetch_redirect_response=False)
+
+
+class RecordingBroker(events.Broker):
+    published = []
+
+    def publish(self, user_id, event_type, data):
+        self.published.append((user_id, event_type, data))
+
+
+class EventTests(TestCase):
+    """Live notifications: publishing from views, brokers and the SSE stream"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+
+    def setUp(self):
+        cache.clear()
+        events._broker = None
+        self.addCleanup(setattr, events, '_broker', None)
+
+    @override_settings(KAGAI_EVENTS={'BROKER': 'kagai.tests.RecordingBroker'})
+    def test_views_publish_after_commit(self):
+        RecordingBroker.published = []
+        self.client.force_login(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('kagai:send_note', args=['alice']), {'content': 'Hi', 'is_anonymous': 'on'})
+            self.client.get(reverse('kagai:send_connection_request', args=['alice']))
+        connection = Connection.objects.get()
+
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('kagai:accept_connection', args=[connection.id]))
+
+        self.assertEqual([(user_id, event_type) for user_id, event_type, _ in RecordingBroker.published], [
+            (self.alice.id, 'note'), (self.alice.id, 'connection_request'),
+            (self.alice.id, 'notifications_read'), (self.bob.id, 'connection_accepted'),
+        ])
+        note_event = RecordingBroker.published[0][2]
+        self.assertIsNone(note_event['sender'])
+        self.assertEqual(note_event['deltas']['received_notes'], 1)
+
+    async def test_in_process_broker(self):
+        broker = events.InProcessBroker()
+        subscription = broker.subscribe(self.alice.id, heartbeat=0.05)
+        # Views publish from another thread
+        await sync_to_async(broker.publish, thread_sensitive=False)(self.alice.id, 'note', {'id': 1})
+        event = await anext(subscription)
+        self.assertEqual((event.type, event.data), ('note', {'id': 1}))
+        self.assertIsNone(await anext(subscription))
+        subscription.close()
+        self.assertEqual(dict(broker._subscribers), {})
+
+    async def test_cache_broker_resumes_from_last_event_id(self):
+        broker = events.CacheBroker()
+        await sync_to_async(broker.publish)(self.alice.id, 'note', {'id': 1})
+        await sync_to_async(broker.publish)(self.alice.id, 'note', {'id': 2})
+        subscription = broker.subscribe(self.alice.id, last_event_id='1', heartbeat=0.05)
+        event = await anext(subscription)
+        self.assertEqual((event.id, event.data), ('2', {'id': 2}))
+        self.assertIsNone(await anext(subscription))
+
+    @override_settings(KAGAI_EVENTS={'ENABLED': True})
+    async def test_stream(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('kagai:events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+
+        events.get_broker().publish(self.alice.id, 'note', {'id': 7})
+        chunk = (await anext(stream)).decode()
+        self.assertIn('event: note\n', chunk)
+        self.assertIn('data: {"id": 7}\n', chunk)
+
+        # A client disconnect cancels the pending read, which unsubscribes
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.01)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+        self.assertEqual(dict(events.get_broker()._subscribers), {})
+
+
+    async def test_stream_needs_events_enabled(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('kagai:events'))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(KAGAI_EVENTS={'ENABLED': True, 'MAX_AGE': 3})
+    def test_stream_is_not_served_over_wsgi(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('kagai:events'))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.streaming)
+
+
+class NotificationTests(TestCase):
+    """Notifications from note, connection and favorite events, and the unread counter"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+
+    def setUp(self):
+        cache.clear()
+
+    def unread(self, user):
+        return UserStats.objects.get(pk=user.pk).unread_notifications
+
+    def assertCounterMatchesRows(self, user):
+        self.assertEqual(self.unread(user), Notification.objects.filter(user=user, is_read=False).count())
+
+    def test_events_create_notifications(self):
+        self.client.force_login(self.bob)
+        self.client.post(reverse('kagai:send_note', args=['alice']), {'content': 'Hi', 'is_anonymous': 'on'})
+        self.client.get(reverse('kagai:send_connection_request', args=['alice']))
+        note = LoveNote.objects.get()
+
+        self.client.force_login(self.alice)
+        self.client.post(reverse('kagai:toggle_favorite', args=[note.id]))
+        self.assertEqual(
+            sorted(Notification.objects.filter(user=self.alice).values_list('kind', 'actor')),
+            [('connection_request', self.bob.id), ('note', None)],
+        )
+        self.assertEqual(self.unread(self.alice), 2)
+        self.assertEqual(Notification.objects.get(user=self.bob).kind, 'favorite')
+
+        # Accepting the request and reading the note clear their notifications
+        self.client.get(reverse('kagai:accept_connection', args=[Connection.objects.get().id]))
+        self.client.get(reverse('kagai:view_note', args=[note.id]))
+        self.assertEqual(self.unread(self.alice), 0)
+        self.assertEqual(self.unread(self.bob), 2)
+        for user in (self.alice, self.bob):
+            self.assertCounterMatchesRows(user)
+
+        UserStats.rebuild([self.alice.id, self.bob.id])
+        self.assertEqual(self.unread(self.bob), 2)
+
+    def test_mark_read_is_one_update(self):
+        notifications = [Notification.notify(self.alice, 'favorite', actor=self.bob) for _ in range(5)]
+        self.client.force_login(self.alice)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                reverse('kagai:mark_notifications_read'),
+                {'ids': [n.id for n in notifications[:3]] + [999999]},
+                content_type='application/json',
+            )
+        self.assertEqual(response.json(), {'marked': 3})
+        updates = [q['sql'] for q in ctx.captured_queries if 'UPDATE "kagai_notification"' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.unread(self.alice), 2)
+
+        # Already read ids are not counted twice
+        response = self.client.post(reverse('kagai:mark_notifications_read'), {'ids': [notifications[0].id]})
+        self.assertRedirects(response, reverse('kagai:notifications'), fetch_redirect_response=False)
+        self.assertEqual(self.unread(self.alice), 2)
+
+        self.client.post(reverse('kagai:mark_all_notifications_read'))
+        self.assertEqual(self.unread(self.alice), 0)
+        self.assertCounterMatchesRows(self.alice)
+
+    def test_mark_read_ignores_other_users(self):
+        notification = Notification.notify(self.bob, 'favorite', actor=self.alice)
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            reverse('kagai:mark_notifications_read'), {'ids': [notification.id]}, content_type='application/json',
+        )
+        self.assertEqual(response.json(), {'marked': 0})
+        self.assertEqual(self.unread(self.bob), 1)
+
+    def test_invalid_ids(self):
+        self.client.force_login(self.alice)
+        for body in ({'ids': ['x']}, {'ids': [True]}, {'ids': [1.5]}, {'ids': 7}, [1, 2], 'nope'):
+            with self.subTest(body=body):
+                response = self.client.post(
+                    reverse('kagai:mark_notifications_read'), body, content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 400)
+
+    def test_badge_is_one_indexed_read(self):
+        Notification.notify(self.alice, 'favorite', actor=self.bob)
+        self.client.force_login(self.alice)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('kagai:browse_users'))
+        self.assertContains(response, 'data-live-badge="unread_notifications">1<')
+        badge_queries = [q['sql'] for q in ctx.captured_queries if 'unread_notifications' in q['sql']]
+        self.assertEqual(len(badge_queries), 1)
+        self.assertIn('WHERE "kagai_userstats"."user_id" =', badge_queries[0])
+
+
+class AssetPipelineTests(TestCase):
+    """build_assets: icon subsetting, critical CSS, image derivatives and the template tags"""
+
+    FONT_AWESOME = (
+        '.fa{font-family:"Font Awesome 6 Free"}'
+        '.fa-heart:before{content:"\\f004"}'
+        '.fa-heart-crack:before,.fa-heart-broken:before{content:"\\f7a9"}'
+        '.fa-zebra:before{content:"\\f000"}'
+        '@font-face{font-family:"Font Awesome 6 Free";src:url(../webfonts/fa-solid-900.woff2)}'
+    )
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(assets.load_manifest.cache_clear)
+        assets.load_manifest.cache_clear()
+
+    def test_icon_css_keeps_used_icons(self):
+        css, codepoints = assets.icon_css(self.FONT_AWESOME, {'fa-heart', 'fa-heart-broken'})
+        self.assertIn('.fa-heart:before', css)
+        self.assertIn('.fa-heart-broken:before{', css)
+        self.assertNotIn('fa-heart-crack', css)
+        self.assertNotIn('fa-zebra', css)
+        self.assertNotIn('@font-face', css)
+        self.assertEqual(codepoints, {0xf004, 0xf7a9})
+
+    def test_critical_css(self):
+        css = (
+            ':root{--x:1}body{margin:0}.navbar{display:flex}.card{border:0}'
+            '.navbar .nav-link:hover{color:red}.modal .nav-link{color:blue}'
+            '@media (min-width:992px){.navbar{gap:1px}.card{gap:2px}}@keyframes pulse{0%{opacity:0}}'
+        )
+        critical = assets.critical_css(css, {'navbar', 'nav-link'}, set(), {'body', 'a'})
+        self.assertEqual(
+            critical,
+            ':root{--x:1}body{margin:0}.navbar{display:flex}.navbar .nav-link:hover{color:red}'
+            '@media (min-width:992px){.navbar{gap:1px}}',
+        )
+
+    def test_rebase_urls(self):
+        css = ".a{background:url('../images/lucy.jpeg')}.b{background:url(data:image/png;base64,x)}"
+        self.assertEqual(
+            assets.rebase_urls(css, 'css/proposal.css', 'dist/proposal.css'),
+            '.a{background:url("../images/lucy.jpeg")}.b{background:url(data:image/png;base64,x)}',
+        )
+
+    def test_fetch_vendor_checks_pinned_hashes(self):
+        pinned = {'a.css': assets.Vendored('https://cdn.example/a.css', assets.integrity(b'a{}', 'sha384'))}
+        with mock.patch.object(assets, 'VENDOR', pinned):
+            with mock.patch('urllib.request.urlopen', mock.mock_open(read_data=b'a{}')):
+                self.assertEqual(assets.fetch_vendor(self.tmp), ['a.css'])
+            self.assertEqual((self.tmp / 'a.css').read_bytes(), b'a{}')
+
+            with mock.patch('urllib.request.urlopen', mock.mock_open(read_data=b'tampered')):
+                with self.assertRaisesMessage(assets.AssetError, 'does not match its pinned hash'):
+                    assets.fetch_vendor(self.tmp, force=True)
+            # Nothing is written on a mismatch
+            self.assertEqual((self.tmp / 'a.css').read_bytes(), b'a{}')
+
+    def render(self):
+        return Template("{% load kagai_assets %}{% asset_styles 'app' %}{% asset_scripts 'app' %}").render(Context())
+
+    def test_tags_fall_back_to_sources_before_a_build(self):
+        with override_settings(KAGAI_ASSETS={'OUTPUT_DIR': self.tmp / 'dist'}):
+            html = self.render()
+        self.assertIn(assets.VENDOR['bootstrap.min.css'].url, html)
+        self.assertIn('/static/css/style.css', html)
+        self.assertIn('<script src="/static/js/main.js" defer></script>', html)
+
+    def test_build(self):
+        vendor = self.tmp / 'vendor'
+        (vendor / 'webfonts').mkdir(parents=True)
+        (vendor / 'bootstrap.min.css').write_text(
+            '.navbar{display:flex}.modal{display:none}\n/*# sourceMappingURL=bootstrap.min.css.map */'
+        )
+        (vendor / 'bootstrap.bundle.min.js').write_text('var bootstrap={}\n//# sourceMappingURL=bootstrap.bundle.min.js.map')
+        (vendor / 'fontawesome.min.css').write_text(self.FONT_AWESOME)
+        for font in ('fa-solid-900.woff2', 'fa-brands-400.woff2'):
+            (vendor / 'webfonts' / font).write_bytes(b'wOF2')
+
+        output = self.tmp / 'dist'
+        # The placeholder fonts cannot be subset; that path is covered by test_subset_font*
+        with override_settings(KAGAI_ASSETS={
+            'VENDOR_DIR': vendor, 'OUTPUT_DIR': output, 'ICON_SOURCES': [Path(__file__).parent.parent / 'templates'],
+        }), mock.patch.object(assets, 'subset_font', return_value=True) as subset_font:
+            call_command('build_assets', '--offline', stdout=io.StringIO())
+            html = self.render()
+        source, _, codepoints = subset_font.call_args.args
+        self.assertEqual(source, vendor / 'webfonts' / 'fa-solid-900.woff2')
+        self.assertEqual(codepoints, {0xf004, 0xf7a9})
+
+        manifest = json.loads((output / 'assets.json').read_text())
+        self.assertEqual(manifest['bundles']['app']['preload'], [
+            {'path': 'dist/fonts/fa-solid-900.woff2', 'as': 'font', 'type': 'font/woff2'},
+        ])
+        app_css = (output / 'app.css').read_text()
+        self.assertIn('.fa-heart:before', app_css)
+        self.assertNotIn('fa-zebra', app_css)
+        self.assertNotIn('sourceMappingURL', app_css + (output / 'app.js').read_text())
+        # Background images point at their derivatives, with a JPEG fallback
+        self.assertNotIn('lucy.jpeg', app_css)
+        self.assertRegex(app_css, r'url\("images/\w+-959\.jpeg"\)[^;]*;background:[^;]*image-set\(')
+
+        # Identical source files share one set of derivatives
+        images = manifest['images']
+        self.assertEqual(images['images/lucy.jpeg'], images['images/becky.jpeg'])
+        jpegs = manifest['image_sets'][images['images/becky.jpeg']]['variants']['jpeg']
+        self.assertEqual([width for width, _ in jpegs], [320, 640, 959])
+
+        self.assertIn('<link rel="preload" href="/static/dist/fonts/fa-solid-900.woff2" as="font"', html)
+        self.assertIn('<style>', html)
+        self.assertIn('.navbar{display:flex}', html)
+        self.assertNotIn('.modal{', html.split('</style>')[0])
+        self.assertIn('media="print" onload="this.media=\'all\'"', html)
+        self.assertIn('<script src="/static/dist/app.js" defer></script>', html)
+
+        with override_settings(KAGAI_ASSETS={'OUTPUT_DIR': output}):
+            picture = Template(
+                "{% load kagai_images %}{% picture 'images/lucy.jpeg' 'Lucy' sizes='400px' %}"
+            ).render(Context())
+        self.assertIn('<source type="image/webp" srcset="/static/dist/images/', picture)
+        self.assertIn('-320.webp 320w, ', picture)
+        self.assertIn('width="959" height="1280"', picture)
+        self.assertIn('loading="lazy"', picture)
+
+    def icon_font(self, path):
+        """Write a tiny woff2 font mapping the heart and zebra icon code points"""
+        from fontTools.fontBuilder import FontBuilder
+        from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+        pen = TTGlyphPen(None)
+        pen.moveTo((0, 0))
+        pen.lineTo((0, 500))
+        pen.lineTo((500, 500))
+        pen.closePath()
+        names = ['.notdef', 'heart', 'zebra']
+        builder = FontBuilder(1000, isTTF=True)
+        builder.setupGlyphOrder(names)
+        builder.setupCharacterMap({0xf004: 'heart', 0xf000: 'zebra'})
+        builder.setupGlyf({name: pen.glyph() for name in names})
+        builder.setupHorizontalMetrics({name: (500, 0) for name in names})
+        builder.setupHorizontalHeader(ascent=800, descent=-200)
+        builder.setupNameTable({'familyName': 'Icons', 'styleName': 'Regular'})
+        builder.setupOS2()
+        builder.setupPost()
+        builder.font.flavor = 'woff2'
+        builder.save(str(path))
+
+    def test_subset_font(self):
+        try:
+            from fontTools.ttLib import TTFont
+        except ImportError:
+            self.skipTest('fontTools is not installed')
+        self.icon_font(self.tmp / 'icons.woff2')
+        self.assertTrue(assets.subset_font(self.tmp / 'icons.woff2', self.tmp / 'subset.woff2', {0xf004}))
+        font = TTFont(self.tmp / 'subset.woff2')
+        self.assertEqual(font.flavor, 'woff2')
+        self.assertEqual(set(font.getBestCmap()), {0xf004})
+
+    def test_subset_font_copies_unreadable_fonts(self):
+        (self.tmp / 'broken.woff2').write_bytes(b'wOF2')
+        messages = []
+        copied = assets.subset_font(self.tmp / 'broken.woff2', self.tmp / 'out.woff2', {0xf004}, log=messages.append)
+        self.assertFalse(copied)
+        self.assertEqual((self.tmp / 'out.woff2').read_bytes(), b'wOF2')
+        self.assertEqual(len(messages), 1)
+        self.assertIn('broken.woff2', messages[0])
+        self.assertIn('without subsetting', messages[0])
+
+    def test_picture_falls_back_to_the_original(self):
+        with override_settings(KAGAI_ASSETS={'OUTPUT_DIR': self.tmp / 'dist'}):
+            html = Template("{% load kagai_images %}{% picture 'images/val_1.jpg' 'Lucy' %}").render(Context())
+        self.assertHTMLEqual(
+            html,
+            '<img src="/static/images/val_1.jpg" width="195" height="183" alt="Lucy" loading="lazy" decoding="async">',
+        )
+
+
+
+class SessionTests(TestCase):
+    """Session strategies, read requests without session writes, and the purge job"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+
+    def setUp(self):
+        cache.clear()
+
+    def session_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return [query['sql'] for query in ctx.captured_queries if '"django_session"' in query['sql']]
+
+    def test_reads_never_write_the_session(self):
+        for strategy, engine in settings.SESSION_PROFILES.items():
+            with self.subTest(strategy), override_settings(SESSION_ENGINE=engine):
+                # SessionMiddleware picks its engine when the client first loads it
+                self.client = Client()
+                self.client.post(reverse('kagai:login'), {'username': 'alice', 'password': 'password123'})
+                for name in ('dashboard', 'my_notes', 'notifications'):
+                    queries = self.session_queries(reverse(f'kagai:{name}'))
+                    self.assertEqual([sql for sql in queries if not sql.startswith('SELECT')], [], name)
+                    if strategy != 'db':
+                        # A warm cache or the cookie itself answers every read
+                        self.assertEqual(queries, [], name)
+                self.client.logout()
+
+    def test_purge_sessions_deletes_only_expired_rows(self):
+        now = timezone.now()
+        for i in range(5):
+            Session.objects.create(session_key=f'expired{i}', session_data='', expire_date=now - timedelta(days=1))
+        Session.objects.create(session_key='live', session_data='', expire_date=now + timedelta(days=1))
+
+        out = io.StringIO()
+        call_command('purge_sessions', batch_size=2, stdout=out)
+        self.assertIn('Deleted 5 expired sessions', out.getvalue())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+
+    def test_benchmark_compares_strategies(self):
+        call_command('seed_data', users=5, notes=2, connections=1, favorites=1, stdout=io.StringIO())
+        routes = [route for route in benchmark.ROUTES if route.name in ('dashboard', 'home', 'logout')]
+        results = benchmark.run_sessions(routes=routes, requests=1, warmup=1)
+        self.assertEqual(list(results), list(settings.SESSION_PROFILES))
+        for strategy, result in results.items():
+            self.assertEqual(list(result['routes']), ['dashboard'])
+            self.assertEqual(result['meta']['session_engine'], settings.SESSION_PROFILES[strategy])
+        self.assertEqual(results['signed_cookies']['routes']['dashboard']['session_queries'], 0)
+        self.assertEqual(results['db']['routes']['dashboard']['session_queries'], 1)
+
+
+class SQLiteTuningTests(TransactionTestCase):
+    """Connection pragmas and the concurrent read/write stress test"""
+
+    def test_connections_are_tuned(self):
+        # Tuning is opt-in (KAGAI_SQLITE_TUNING=1), so open a connection of
+        # its own with the tuned options
+        with tempfile.TemporaryDirectory() as tmp:
+            settings_dict = {
+                **connection.settings_dict,
+                'NAME': str(Path(tmp) / 'tuned.sqlite3'),
+                'OPTIONS': settings.SQLITE_TUNED_OPTIONS,
+            }
+            tuned = connections['default'].__class__(settings_dict, 'tuned')
+            try:
+                with tuned.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+                    cursor.execute('PRAGMA busy_timeout')
+                    self.assertEqual(cursor.fetchone()[0], 5000)
+                    cursor.execute('PRAGMA synchronous')
+                    # 1 is NORMAL
+                    self.assertEqual(cursor.fetchone()[0], 1)
+                self.assertEqual(tuned.transaction_mode, 'IMMEDIATE')
+            finally:
+                tuned.close()
+        self.assertTrue(settings.DATABASES['default']['CONN_HEALTH_CHECKS'])
+
+    def test_stress(self):
+        call_command('seed_data', users=10, notes=3, connections=1, favorites=1, stdout=io.StringIO())
+        favorites = Favorite.objects.count()
+        results = stress.run(readers=2, writers=2, seconds=0.5)
+        self.assertEqual(list(results), ['default', 'tuned'])
+        tuned = results['tuned']
+        self.assertGreater(tuned['read']['requests'], 0)
+        self.assertGreater(tuned['write']['requests'], 0)
+        self.assertEqual(tuned['read']['errors'] + tuned['write']['errors'], 0)
+        # The writes went to a scratch copy
+        self.assertEqual(Favorite.objects.count(), favorites)
+
+
+
+class RaceFreeTransitionTests(TestCase):
+    """Repeated favorite and connection requests change state exactly once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.note = LoveNote.objects.create(sender=cls.bob, recipient=cls.alice, content='Hi', status='sent')
+        UserStats.rebuild([cls.alice.pk, cls.bob.pk])
+
+    def setUp(self):
+        cache.clear()
+
+    def assertStatsConsistent(self):
+        for user in (self.alice, self.bob):
+            expected = UserStats.compute([user.pk])[0]
+            stats = UserStats.objects.get(pk=user.pk)
+            for field in UserStats.COUNTERS:
+                self.assertEqual(getattr(stats, field), getattr(expected, field), f'{user.username}.{field}')
+
+    def test_favorite_add_ignores_duplicates(self):
+        self.assertTrue(Favorite.add(self.alice, self.note))
+        self.assertFalse(Favorite.add(self.alice, self.note))
+        self.assertEqual(Favorite.objects.filter(user=self.alice).count(), 1)
+
+    def test_toggle_favorite(self):
+        self.client.force_login(self.alice)
+        url = reverse('kagai:toggle_favorite', args=[self.note.pk])
+        self.assertEqual(self.client.post(url).json(), {'favorited': True})
+        self.assertEqual(self.client.post(url).json(), {'favorited': False})
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(Notification.objects.filter(kind='favorite', user=self.bob).count(), 1)
+        self.assertStatsConsistent()
+
+    def test_duplicate_connection_requests(self):
+        self.assertIsNotNone(Connection.request(self.alice, self.bob))
+        self.assertIsNone(Connection.request(self.alice, self.bob))
+        self.assertIsNone(Connection.request(self.bob, self.alice))
+
+        self.client.force_login(self.bob)
+        self.client.get(reverse('kagai:send_connection_request', args=['alice']))
+        self.assertEqual(Connection.objects.count(), 1)
+        self.assertEqual(UserStats.objects.get(pk=self.bob.pk).pending_requests, 0)
+
+    def test_repeated_accept_counts_once(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse('kagai:send_connection_request', args=['bob']))
+        pk = Connection.objects.get().pk
+
+        self.client.force_login(self.bob)
+        for _ in range(3):
+            self.client.get(reverse('kagai:accept_connection', args=[pk]))
+        self.assertEqual(Connection.objects.get().status, 'accepted')
+        self.assertEqual(UserStats.objects.get(pk=self.alice.pk).connections, 1)
+        self.assertStatsConsistent()
+
+        # Removing it twice only takes it away once
+        self.client.get(reverse('kagai:remove_connection', args=[pk]))
+        self.client.get(reverse('kagai:remove_connection', args=[pk]))
+        self.assertFalse(Connection.objects.exists())
+        self.assertStatsConsistent()
+
+    def test_new_requests_and_favorites_refresh_the_cached_dashboard(self):
+        RecommendationQueue.objects.all().delete()
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(reverse('kagai:dashboard')).context['stats'].pending_requests, 0)
+
+        self.client.force_login(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('kagai:send_connection_request', args=['alice']))
+        self.assertEqual(RecommendationQueue.objects.filter(user__in=[self.alice, self.bob]).count(), 2)
+
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('kagai:dashboard'))
+        self.assertContains(response, 'You have 1 pending connection request(s)')
+        self.assertEqual(response.context['stats'].pending_requests, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('kagai:toggle_favorite', args=[self.note.pk]))
+        self.assertIsNone(cache.get(kagai_cache.make_key(kagai_cache.DASHBOARD_NOTES, self.alice.pk)))
+        self.assertStatsConsistent()
+
+    def test_transition_checks_the_current_status(self):
+        connection = Connection.request(self.alice, self.bob)
+        self.assertTrue(Connection.transition(connection.pk, 'pending', 'accepted'))
+        self.assertFalse(Connection.transition(connection.pk, 'pending', 'accepted'))
+
+
+class EndpointRaceTests(TransactionTestCase):
+    """The endpoint race harness finds no server errors or broken data"""
+
+    def test_hammer(self):
+        call_command('seed_data', users=4, notes=1, connections=0, favorites=0, stdout=io.StringIO())
+        results = stress.hammer(threads=2, rounds=2)
+        self.assertEqual(set(results), {scenario.name for scenario in stress.SCENARIOS})
+        for name, result in results.items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertEqual(result['problems'], [], name)
+
+@override_settings(KAGAI_REPLICA={'ALIAS': 'replica'})
+class ReplicaRoutingTests(TestCase):
+    """Read-only views read from the replica unless the browser has just written"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        # A missing stats row is rebuilt from the primary
+        UserStats.rebuild([cls.alice.pk])
+
+    def setUp(self):
+        cache.clear()
+        self.reads = []
+        route = routers.ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            self.reads.append((model, route(router, model, **hints) or 'default'))
+            # There is no second test database; run every query on the primary
+            return 'default'
+
+        patcher = mock.patch.object(routers.ReplicaRouter, 'db_for_read', record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The connection graph loads from the primary; keep that out of the way
+        graph.reset()
+        graph.get_graph()
+        self.client.force_login(self.alice)
+
+    def reads_for(self, name, *args, models=None):
+        """Where the view read ``models``, by default those not loaded to authenticate"""
+        self.reads.clear()
+        self.assertEqual(self.client.get(reverse(f'kagai:{name}', args=args)).status_code, 200)
+        if models is None:
+            return {alias for model, alias in self.reads if model not in (Session, User)}
+        return {alias for model, alias in self.reads if model in models}
+
+    def test_read_only_views_use_the_replica(self):
+        self.assertEqual(self.reads_for('browse_users'), {'replica'})
+        self.assertEqual(self.reads_for('my_notes'), {'replica'})
+        self.assertEqual(self.reads_for('profile', 'alice'), {'replica'})
+        self.assertEqual(self.reads_for('dashboard'), {'default'})
+
+    def test_authentication_reads_use_the_primary(self):
+        # A login the replica has not seen yet must still authenticate
+        self.assertEqual(self.reads_for('my_notes', models={Session, User}), {'default'})
+        self.assertEqual(self.reads_for('my_notes', models={LoveNote}), {'replica'})
+
+    @override_settings(ROOT_URLCONF=AsyncURLConf)
+    def test_async_authentication_reads_use_the_primary(self):
+        self.assertEqual(self.reads_for('my_notes', models={Session, User}), {'default'})
+        self.assertEqual(self.reads_for('my_notes', models={LoveNote}), {'replica'})
+
+    def test_missing_stats_are_not_read_back_from_the_replica(self):
+        UserStats.objects.filter(pk=self.alice.pk).delete()
+        LoveNote.objects.create(sender=self.alice, recipient=make_user('bob'), content='Hi', status='sent')
+        real_get = UserStats.objects.get
+
+        def lagging_get(*args, **kwargs):
+            # The replica never has the row the primary just built
+            if routers._replica_reads.get():
+                raise UserStats.DoesNotExist
+            return real_get(*args, **kwargs)
+
+        with mock.patch.object(UserStats.objects, 'get', lagging_get), routers.replica_reads():
+            stats = UserStats.for_user(self.alice)
+        self.assertEqual((stats.sent_notes, stats.total_sent_notes), (1, 1))
+        self.assertTrue(UserStats.objects.filter(pk=self.alice.pk, sent_notes=1).exists())
+
+    def test_stats_rebuilds_count_on_the_primary(self):
+        UserStats.objects.filter(pk=self.alice.pk).delete()
+        self.reads.clear()
+        with routers.replica_reads():
+            UserStats.for_user(self.alice)
+        self.assertEqual({alias for model, alias in self.reads if model is UserStats}, {'replica'})
+        self.assertEqual(
+            {alias for model, alias in self.reads if model in (LoveNote, Connection, Notification)}, {'default'},
+        )
+
+        # Same for a view reading from the replica
+        UserStats.objects.filter(pk=self.alice.pk).delete()
+        self.assertEqual(self.reads_for('browse_users', models={Connection, Notification}), {'default'})
+
+    def test_writes_pin_reads_to_the_primary(self):
+        response = self.client.post(reverse('kagai:mark_all_notifications_read'))
+        self.assertEqual(response.cookies['kagai_primary']['max-age'], 10)
+        self.assertEqual(self.reads_for('browse_users'), {'default'})
+
+        # Once the cookie expires the replica has caught up
+        del self.client.cookies['kagai_primary']
+        self.assertEqual(self.reads_for('browse_users'), {'replica'})
+
+    @override_settings(KAGAI_REPLICA={})
+    def test_without_a_replica_everything_uses_the_primary(self):
+        self.assertEqual(self.reads_for('browse_users'), {'default'})
+        response = self.client.post(reverse('kagai:mark_all_notifications_read'))
+        self.assertNotIn('kagai_primary', response.cookies)
+
+
+class BulkNoteTests(TestCase):
+    """Bulk send, delete and favorite endpoints"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.carol = make_user('carol')
+        cls.users = [make_user(f'user{i}') for i in range(4)]
+        UserStats.rebuild(User.objects.values_list('pk', flat=True))
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, name, payload):
+        return self.client.post(reverse(f'kagai:{name}'), payload, content_type='application/json')
+
+    def assertStatsConsistent(self, *users):
+        for user in users:
+            expected = UserStats.compute([user.pk])[0]
+            stats = UserStats.objects.get(pk=user.pk)
+            for field in UserStats.COUNTERS:
+                self.assertEqual(getattr(stats, field), getattr(expected, field), f'{user.username}.{field}')
+
+    def test_bulk_send(self):
+        self.client.force_login(self.bob)
+        response = self.post('bulk_send_notes', {
+            'recipients': ['alice', 'carol', 'nobody', 'bob', 'alice', 7],
+            'title': 'Hi', 'content': 'Roses are red', 'is_anonymous': True,
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['sent'], 2)
+        self.assertEqual(
+            [result.get('status') or result['error'] for result in data['results']],
+            ['sent', 'sent', 'not_found', 'self', 'duplicate', 'not_found'],
+        )
+        note = LoveNote.objects.get(pk=data['results'][0]['id'])
+        self.assertEqual((note.recipient, note.sender, note.is_anonymous), (self.alice, self.bob, True))
+        self.assertEqual(Notification.objects.filter(kind='note', actor=None).count(), 2)
+        self.assertStatsConsistent(self.alice, self.bob, self.carol)
+        self.assertEqual(search.get_search_backend().search_notes(self.carol, 'roses'), [data['results'][1]['id']])
+
+    def test_bulk_send_queries_do_not_grow_with_recipients(self):
+        self.client.force_login(self.bob)
+        counts = []
+        for recipients in (['alice', 'carol'], [user.username for user in self.users]):
+            with CaptureQueriesContext(connection) as ctx:
+                self.post('bulk_send_notes', {'recipients': recipients, 'content': 'Hello'})
+            counts.append(len(ctx))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_bulk_delete(self):
+        self.client.force_login(self.bob)
+        self.post('bulk_send_notes', {'recipients': ['alice', 'carol'], 'content': 'Gone soon'})
+        to_alice, to_carol = LoveNote.objects.order_by('recipient__username')
+        self.client.force_login(self.alice)
+        self.post('bulk_favorite_notes', {'ids': [to_alice.id]})
+        elsewhere = LoveNote.objects.create(sender=self.carol, recipient=self.bob, content='Not yours')
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post('bulk_delete_notes', {'ids': [to_alice.id, elsewhere.id, 'x', 999999]})
+        self.assertEqual(response.json(), {'deleted': 1, 'results': [
+            {'id': to_alice.id, 'status': 'deleted'},
+            {'id': elsewhere.id, 'error': 'forbidden'},
+            {'id': 'x', 'error': 'invalid'},
+            {'id': 999999, 'error': 'not_found'},
+        ]})
+        self.assertEqual(
+            sum('"kagai_lovenote"' in query['sql'] and query['sql'].startswith('DELETE') for query in ctx), 1,
+        )
+        self.assertEqual(set(LoveNote.objects.values_list('id', flat=True)), {to_carol.id, elsewhere.id})
+        self.assertFalse(Favorite.objects.exists())
+        self.assertFalse(Notification.objects.filter(note__isnull=True).exists())
+        self.assertStatsConsistent(self.alice, self.bob)
+        self.assertEqual(search.get_search_backend().search_notes(self.alice, 'gone'), [])
+
+    def test_bulk_favorite(self):
+        self.client.force_login(self.bob)
+        sent = self.post('bulk_send_notes', {'recipients': ['alice', 'carol'], 'content': 'One'}).json()
+        ids, own = [sent['results'][0]['id']], sent['results'][1]['id']
+        self.client.force_login(self.carol)
+        ids.append(self.post('bulk_send_notes', {'recipients': ['alice'], 'content': 'Two'}).json()['results'][0]['id'])
+
+        self.client.force_login(self.alice)
+        self.post('bulk_favorite_notes', {'ids': [ids[0]]})
+        data = self.post('bulk_favorite_notes', {'ids': [*ids, own]}).json()
+        self.assertEqual(data['favorited'], 1)
+        self.assertEqual(
+            [result.get('status') or result['error'] for result in data['results']],
+            ['unchanged', 'favorited', 'forbidden'],
+        )
+        self.assertEqual(Favorite.objects.filter(user=self.alice).count(), 2)
+        self.assertEqual(Notification.objects.filter(kind='favorite', user=self.carol).count(), 1)
+        self.assertStatsConsistent(self.alice, self.bob, self.carol)
+
+        data = self.post('bulk_favorite_notes', {'ids': ids, 'favorite': False}).json()
+        self.assertEqual(data['unfavorited'], 2)
+        self.assertFalse(Favorite.objects.exists())
+
+    def test_bulk_favorite_notifies_only_for_inserted_rows(self):
+        note = LoveNote.objects.create(sender=self.bob, recipient=self.alice, content='Raced')
+        bulk_notes = views._bulk_notes
+
+        def racing(user, values):
+            # Another request favorites the note after it was checked
+            checked = bulk_notes(user, values)
+            Favorite.objects.create(user=user, note=note)
+            return checked
+
+        self.client.force_login(self.alice)
+        with mock.patch('kagai.views._bulk_notes', racing):
+            data = self.post('bulk_favorite_notes', {'ids': [note.id]}).json()
+        self.assertEqual(data, {'favorited': 0, 'results': [{'id': note.id, 'status': 'unchanged'}]})
+        self.assertFalse(Notification.objects.filter(kind='favorite').exists())
+        self.assertEqual(Favorite.add_many(self.alice, [note.id]), set())
+
+    def test_bad_requests(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.post('bulk_delete_notes', {'ids': []}).status_code, 400)
+        self.assertEqual(self.post('bulk_delete_notes', {'ids': list(range(101))}).status_code, 400)
+        self.assertEqual(self.post('bulk_send_notes', {'recipients': ['alice'], 'content': ' '}).status_code, 400)
+        response = self.client.post(reverse('kagai:bulk_favorite_notes'), 'nope', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ConnectionGraphTests(TestCase):
+    """The in-memory connection graph and the views reading from it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol, cls.dave, cls.erin = (
+            make_user(name) for name in ('alice', 'bob', 'carol', 'dave', 'erin')
+        )
+        for user1, user2 in ((cls.alice, cls.bob), (cls.carol, cls.alice), (cls.bob, cls.dave), (cls.carol, cls.dave)):
+            Connection.objects.create(user1=user1, user2=user2, status='accepted')
+        Connection.objects.create(user1=cls.erin, user2=cls.dave)
+        UserStats.rebuild(User.objects.values_list('pk', flat=True))
+
+    def setUp(self):
+        cache.clear()
+        graph.reset()
+        self.addCleanup(graph.reset)
+
+    def test_queries(self):
+        connections = graph.ConnectionGraph([(1, 2), (3, 1), (2, 4), (3, 4), (4, 5), (1, 2)])
+        self.assertEqual(len(connections), 5)
+        self.assertEqual(connections.edge_count, 5)
+        self.assertEqual(list(connections.neighbors(1)), [2, 3])
+        self.assertEqual(connections.degree(4), 3)
+        self.assertEqual(connections.degree(99), 0)
+        self.assertTrue(connections.is_connected(3, 1))
+        self.assertFalse(connections.is_connected(1, 4))
+        self.assertEqual(connections.mutual(1, 4), [2, 3])
+        self.assertEqual(connections.suggestions(1), [(4, 2)])
+        self.assertEqual(connections.suggestions(2), [(3, 2), (5, 1)])
+
+        connections.add_edge(1, 4)
+        connections.add_edge(4, 1)
+        self.assertEqual(list(connections.neighbors(4)), [1, 2, 3, 5])
+        connections.remove_edge(5, 4)
+        self.assertEqual(connections.degree(5), 0)
+        self.assertEqual(len(connections), 4)
+        connections.remove_node(1)
+        self.assertEqual(connections.edge_count, 2)
+        self.assertEqual(list(connections.neighbors(3)), [4])
+
+    def test_built_from_accepted_connections(self):
+        with self.assertNumQueries(1):
+            connections = graph.get_graph()
+        with self.assertNumQueries(0):
+            self.assertIs(graph.get_graph(), connections)
+        self.assertEqual(connections.mutual(self.alice.pk, self.dave.pk), sorted([self.bob.pk, self.carol.pk]))
+        # Pending requests are not edges
+        self.assertEqual(connections.degree(self.erin.pk), 0)
+
+    def test_changes_apply_without_rebuilding(self):
+        connections = graph.get_graph()
+        self.client.force_login(self.dave)
+        pending = Connection.objects.get(user1=self.erin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('kagai:accept_connection', args=[pending.pk]))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('kagai:remove_connection', args=[Connection.objects.get(user1=self.bob).pk]))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.carol.delete()
+
+        with self.assertNumQueries(0):
+            self.assertIs(graph.get_graph(), connections)
+        self.assertEqual(list(connections.neighbors(self.dave.pk)), [self.erin.pk])
+        self.assertEqual(list(connections.neighbors(self.alice.pk)), [self.bob.pk])
+
+    def test_rebuilds_after_another_process_changed_it(self):
+        connections = graph.get_graph()
+        # Another worker accepted a connection and bumped the generation
+        Connection.objects.filter(user1=self.erin).update(status='accepted')
+        graph._bump_generation()
+        with self.assertNumQueries(1):
+            rebuilt = graph.get_graph()
+        self.assertIsNot(rebuilt, connections)
+        self.assertEqual(rebuilt.degree(self.erin.pk), 1)
+
+    def test_profile_shows_mutual_connections(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('kagai:profile', args=['dave']))
+        self.assertEqual(response.context['mutual_count'], 2)
+        self.assertEqual([user.username for user in response.context['mutual_connections']], ['bob', 'carol'])
+        self.assertEqual(response.context['connection_count'], 2)
+        self.assertContains(response, '2 mutual connections')
+
+    def test_dashboard_suggests_friends_of_friends(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('kagai:dashboard'))
+        self.assertEqual([(user.username, user.mutual_count) for user in response.context['suggestions']], [('dave', 2)])
+        self.assertContains(response, 'People You May Know')
+
+
+class RecommendationTests(TestCase):
+    """Precomputed recommendations and browse_users reading them"""
+
+    @classmethod
+    def setUpTestData(cls):
+        people = {
+            'alice': ('Nairobi', 'Hiking, Music'),
+            'bob': ('nairobi ', 'Hiking'),
+            'carol': ('Mombasa', 'Music, Hiking'),
+            'dave': ('', 'Chess'),
+            'erin': ('Nairobi', 'Hiking, Music'),
+            'frank': ('Kisumu', ''),
+        }
+        for username, (location, interests) in people.items():
+            user = make_user(username)
+            user.profile.location = location
+            user.profile.set_interests(interests)
+            user.profile.save()
+            setattr(cls, username, user)
+        Connection.objects.create(user1=cls.alice, user2=cls.frank, status='accepted')
+        Connection.objects.create(user1=cls.frank, user2=cls.carol, status='accepted')
+        Connection.objects.create(user1=cls.erin, user2=cls.alice)
+
+    def setUp(self):
+        cache.clear()
+
+    def recommended(self, user):
+        return [
+            (rec.candidate.username, rec.shared_interests, rec.shared_connections, rec.same_location)
+            for rec in Recommendation.objects.filter(user=user).select_related('candidate')
+        ]
+
+    def test_scores(self):
+        self.assertEqual(recommendations.run(full=True), 6)
+        # Carol shares both interests and a connection; bob one interest and
+        # the town; erin has a pending request and frank is connected
+        self.assertEqual(self.recommended(self.alice), [('carol', 2, 1, False), ('bob', 1, 0, True)])
+        self.assertEqual(self.recommended(self.dave), [])
+        self.assertEqual([rec.rank for rec in Recommendation.objects.filter(user=self.alice)], [1, 2])
+        self.assertFalse(RecommendationQueue.objects.exists())
+
+    def test_incremental_run(self):
+        recommendations.run()
+        self.assertEqual(recommendations.run(), 0)
+        kept = set(Recommendation.objects.exclude(user=self.bob).values_list('pk', flat=True))
+
+        self.bob.profile.set_interests('Chess')
+        self.bob.profile.save()
+        self.assertEqual(list(RecommendationQueue.objects.values_list('user_id', flat=True)), [self.bob.pk])
+        self.assertEqual(recommendations.run(), 1)
+        self.assertEqual(self.recommended(self.bob), [('dave', 1, 0, False), ('alice', 0, 0, True), ('erin', 0, 0, True)])
+        self.assertEqual(set(Recommendation.objects.exclude(user=self.bob).values_list('pk', flat=True)), kept)
+
+        Connection.objects.filter(user1=self.erin).delete()
+        self.assertEqual(
+            set(RecommendationQueue.objects.values_list('user_id', flat=True)), {self.alice.pk, self.erin.pk}
+        )
+
+    def test_changes_during_a_run_stay_queued(self):
+        recommendations.run()
+        RecommendationQueue.enqueue([self.bob.pk])
+        real_score = recommendations.score
+
+        def score(features, batch, top_k):
+            # Bob changes again while his recommendations are being computed
+            RecommendationQueue.enqueue([self.bob.pk])
+            return real_score(features, batch, top_k)
+
+        with mock.patch.object(recommendations, 'score', score):
+            self.assertEqual(recommendations.run(), 1)
+        self.assertEqual(list(RecommendationQueue.objects.values_list('user_id', flat=True)), [self.bob.pk])
+        self.assertEqual(recommendations.run(), 1)
+        self.assertFalse(RecommendationQueue.objects.exists())
+
+    def test_browse_users(self):
+        recommendations.run(full=True)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('kagai:browse_users'))
+        self.assertEqual([user.username for user in response.context['users']], ['carol', 'bob'])
+        self.assertEqual(response.context['sort'], 'recommended')
+
+        data = self.client.get(reverse('kagai:browse_users_json')).json()
+        self.assertEqual(
+            [(user['username'], user['shared_interests'], user['shared_connections']) for user in data['results']],
+            [('carol', 2, 1), ('bob', 1, 0)],
+        )
+
+    def test_browse_falls_back_to_newest(self):
+        recommendations.run(full=True)
+        self.client.force_login(self.dave)
+        response = self.client.get(reverse('kagai:browse_users'))
+        self.assertEqual(response.context['sort'], '-created_at')
+        self.assertEqual(len(response.context['users']), 5)
+
+
+class ConditionalGetTests(TestCase):
+    """Pages answer a repeated GET with 304 Not Modified until what they show changes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.note = LoveNote.objects.create(sender=cls.bob, recipient=cls.alice, content='Hello', status='opened')
+        LoveNote.objects.create(sender=cls.alice, recipient=cls.bob, content='Hi', status='sent')
+        UserStats.rebuild([cls.alice.id, cls.bob.id])
+
+    def setUp(self):
+        cache.clear()
+        graph.reset()
+        self.client.force_login(self.alice)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_not_modified(self):
+        for url in (
+            reverse('kagai:dashboard'), reverse('kagai:my_notes'),
+            reverse('kagai:profile', args=['bob']), reverse('kagai:view_note', args=[self.note.id]),
+        ):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Last-Modified', response)
+                self.assertIn('private', response['Cache-Control'])
+                with self.assertTemplateNotUsed('base.html'):
+                    revalidated = self.revalidate(url, response['ETag'])
+                self.assertEqual(revalidated.status_code, 304)
+                self.assertEqual(revalidated['ETag'], response['ETag'])
+                self.assertEqual(self.revalidate(url, '"stale"').status_code, 200)
+
+    def test_changes_invalidate(self):
+        my_notes = reverse('kagai:my_notes')
+        etag = self.client.get(my_notes)['ETag']
+        self.client.post(reverse('kagai:toggle_favorite', args=[self.note.id]))
+        self.assertEqual(self.revalidate(my_notes, etag).status_code, 200)
+
+        profile = reverse('kagai:profile', args=['bob'])
+        etag = self.client.get(profile)['ETag']
+        self.client.post(reverse('kagai:send_connection_request', args=['bob']))
+        self.assertEqual(self.revalidate(profile, etag).status_code, 200)
+
+        # Only the navbar changed: bob's note adds to alice's stats
+        view_note = reverse('kagai:view_note', args=[self.note.id])
+        etag = self.client.get(view_note)['ETag']
+        LoveNote.objects.create(sender=self.bob, recipient=self.alice, content='Again', status='sent')
+        UserStats.bump(self.alice, received_notes=1, total_received_notes=1)
+        self.assertEqual(self.revalidate(view_note, etag).status_code, 200)
+
+    def test_release_changes_etag(self):
+        url = reverse('kagai:dashboard')
+        etag = self.client.get(url)['ETag']
+        with override_settings(KAGAI_CONDITIONAL={'RELEASE': 'next'}):
+            self.assertEqual(self.revalidate(url, etag).status_code, 200)
+
+    def test_pending_messages_render(self):
+        url = reverse('kagai:dashboard')
+        etag = self.client.get(url)['ETag']
+        self.client.post(reverse('kagai:send_connection_request', args=['alice']))
+        response = self.revalidate(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    def test_unopened_note_renders(self):
+        note = LoveNote.objects.create(sender=self.bob, recipient=self.alice, content='New', status='sent')
+        response = self.client.get(reverse('kagai:view_note', args=[note.id]))
+        self.assertNotIn('ETag', response)
+        note.refresh_from_db()
+        self.assertEqual(note.status, 'opened')
+
+    @override_settings(ROOT_URLCONF=AsyncURLConf)
+    async def test_async_views(self):
+        await self.async_client.aforce_login(self.alice)
+        url = reverse('kagai:profile', args=['bob'])
+        etag = (await self.async_client.get(url))['ETag']
+        response = await self.async_client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+class ExportTests(TestCase):
+    """Notes and connections stream out as JSON Lines or CSV without being loaded at once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.carol = make_user('carol')
+        cls.secret = LoveNote.objects.create(
+            sender=cls.bob, recipient=cls.alice, content='Guess who', status='sent', is_anonymous=True,
+        )
+        LoveNote.objects.create(sender=cls.carol, recipient=cls.alice, title='=HYPERLINK("x")', content='Hey')
+        LoveNote.objects.create(sender=cls.alice, recipient=cls.bob, content='Hi, "Bob"\nSee you', status='opened')
+        Favorite.objects.create(user=cls.alice, note=cls.secret)
+        Connection.objects.create(user1=cls.alice, user2=cls.bob, status='accepted')
+        Connection.objects.create(user1=cls.carol, user2=cls.alice)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def download(self, dataset, **params):
+        response = self.client.get(reverse('kagai:export_data', args=[dataset]), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_notes_jsonl(self):
+        response, content = self.download('notes')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="kagai-alice-notes.jsonl"')
+        self.assertIn('no-store', response['Cache-Control'])
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(
+            [(row['box'], row['sender'], row['recipient']) for row in rows],
+            [('received', 'carol', 'alice'), ('received', None, 'alice'), ('sent', 'alice', 'bob')],
+        )
+        self.assertTrue(rows[1]['is_favorite'])
+        self.assertEqual(rows[2]['content'], 'Hi, "Bob"\nSee you')
+
+    def test_notes_csv_gzip(self):
+        response, content = self.download('notes', format='csv', gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = list(csv.reader(io.StringIO(gzip.decompress(content).decode())))
+        self.assertEqual(rows[0], exports.NOTE_FIELDS)
+        self.assertEqual(len(rows), 4)
+        # Spreadsheets must not run a note's text as a formula
+        self.assertEqual(rows[1][4], '\'=HYPERLINK("x")')
+        self.assertEqual(rows[3][5], 'Hi, "Bob"\nSee you')
+
+    def test_connections(self):
+        _, content = self.download('connections')
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(
+            [(row['user'], row['direction'], row['status']) for row in rows],
+            [('bob', 'outgoing', 'accepted'), ('carol', 'incoming', 'pending')],
+        )
+
+    @override_settings(KAGAI_EXPORTS={'CHUNK_SIZE': 1, 'BUFFER_SIZE': 1})
+    def test_streams_in_pieces(self):
+        response = self.client.get(reverse('kagai:export_data', args=['notes']))
+        with CaptureQueriesContext(connection) as ctx:
+            pieces = list(response.streaming_content)
+        # One query per box however many rows, and a piece per row
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(len(pieces), 3)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('kagai:export_data', args=['passwords'])).status_code, 404)
+        response = self.client.get(reverse('kagai:export_data', args=['notes']), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_user_data', 'bob', '--format', 'csv', stdout=out)
+        self.assertEqual(len(list(csv.reader(io.StringIO(out.getvalue())))), 3)
+
+        output = Path(tempfile.mkdtemp()) / 'connections.jsonl.gz'
+        self.addCleanup(shutil.rmtree, output.parent)
+        call_command(
+            'export_user_data', 'alice', '--dataset', 'connections', '--gzip', '-o', str(output), stderr=io.StringIO(),
+        )
+        self.assertEqual(len(gzip.decompress(output.read_bytes()).splitlines()), 2)
+
+    def test_admin_export_all(self):
+        User.objects.create_superuser('admin', password='password123')
+        self.client.login(username='admin', password='password123')
+        response = self.client.post(reverse('admin:kagai_lovenote_changelist'), {
+            'action': 'export_csv', 'select_across': '1', 'index': '0',
+            '_selected_action': [self.secret.pk],
+        })
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b''.join(response.streaming_content)).decode())))
+        self.assertEqual(rows[0], exports.ADMIN_NOTE_FIELDS)
+        # Staff see every note, with anonymous senders
+        self.assertEqual([row[1] for row in rows[1:]], ['bob', 'carol', 'alice'])
+
+    async def test_asgi_streams_async(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('kagai:export_data', args=['notes']))
+        self.assertTrue(response.is_async)
+        content = b''.join([piece async for piece in response.streaming_content])
+        self.assertEqual(len(content.splitlines()), 3)
+
+
+class AdminTests(TestCase):
+    """Admin changelists avoid full counts, N+1 queries and unindexed search"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='password123')
+        cls.alice = make_user('alice')
+        cls.bob = make_user('bob')
+        cls.bobby = make_user('Bobby')
+        for i in range(5):
+            note = LoveNote.objects.create(sender=cls.bob, recipient=cls.alice, content=f'Hello {i}', status='sent')
+            Favorite.objects.create(user=cls.alice, note=note)
+        LoveNote.objects.create(sender=cls.alice, recipient=cls.bobby, title='Moonlight', content='Picnic?')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def changelist(self, model, **params):
+        return self.client.get(reverse(f'admin:kagai_{model}_changelist'), params)
+
+    def found(self, model, query):
+        return self.changelist(model, q=query).context['cl'].result_count
+
+    def test_changelists(self):
+        for model in ('lovenote', 'favorite', 'connection', 'notification', 'userprofile', 'userstats'):
+            with self.subTest(model=model):
+                with CaptureQueriesContext(connection) as ctx:
+                    response = self.changelist(model)
+                self.assertEqual(response.status_code, 200)
+                sql = [query['sql'] for query in ctx.captured_queries]
+                # One page query whatever the rows link to, and no COUNT(*) of the whole table
+                self.assertLessEqual(len(sql), 8)
+                self.assertFalse([query for query in sql if 'COUNT(*)' in query and 'LIMIT' not in query])
+
+    def test_search(self):
+        self.assertEqual(self.found('lovenote', 'bob'), 5)
+        # Prefixes only, case-sensitively
+        self.assertEqual(self.found('lovenote', 'ob'), 0)
+        self.assertEqual(self.found('lovenote', 'Bob'), 1)
+        # No range ends after the last code point; a plain prefix match instead
+        self.assertEqual(self.found('lovenote', 'bob\U0010ffff'), 0)
+        # Titles and content through the full-text index
+        self.assertEqual(self.found('lovenote', 'moon'), 1)
+        self.assertEqual(self.found('lovenote', 'alice picnic'), 1)
+        self.assertEqual(self.found('favorite', 'ali'), 5)
+        # bob by username, Bobby through the case-insensitive full-text index
+        self.assertEqual(self.found('userprofile', 'bob'), 2)
+
+    def test_estimated_count(self):
+        paginator = EstimatedCountPaginator(LoveNote.objects.order_by('-pk'), 2)
+        paginator.count_limit = 3
+        LoveNote.objects.filter(content='Hello 2').delete()
+        with CaptureQueriesContext(connection) as ctx:
+            # The deleted row still counts towards the estimate
+            self.assertEqual(paginator.count, 6)
+        self.assertNotIn('COUNT', ctx.captured_queries[0]['sql'])
+
+        filtered = EstimatedCountPaginator(LoveNote.objects.filter(sender=self.bob).order_by('-pk'), 2)
+        filtered.count_limit = 3
+        self.assertEqual(filtered.count, 3)
+        self.assertEqual(filtered.num_pages, 2)
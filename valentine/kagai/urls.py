@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
 
 app_name = 'kagai'
 
+# Read-heavy pages have async versions for the ASGI deployment
+read_views = async_views if getattr(settings, 'KAGAI_ASYNC_VIEWS', False) else views
+
 urlpatterns = [
     # Authentication
     path('', views.home, name='home'),
@@ -14,18 +18,35 @@ urlpatterns = [
     path('valentine-proposal/', views.valentine_proposal, name='valentine_proposal'),
     
     # Dashboard
-    path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/', read_views.dashboard, name='dashboard'),
     
     # Profile
-    path('profile/<str:username>/', views.profile, name='profile'),
     path('profile/edit/', views.edit_profile, name='edit_profile'),
-    path('browse/', views.browse_users, name='browse_users'),
+    path('profile/<str:username>/', read_views.profile, name='profile'),
+    path('browse/', read_views.browse_users, name='browse_users'),
+    path('browse/json/', views.browse_users_json, name='browse_users_json'),
     
     # Love Notes
     path('note/send/<str:recipient_username>/', views.send_note, name='send_note'),
-    path('note/<int:note_id>/', views.view_note, name='view_note'),
+    path('note/<int:note_id>/', read_views.view_note, name='view_note'),
     path('note/favorite/<int:note_id>/', views.toggle_favorite, name='toggle_favorite'),
-    path('notes/', views.my_notes, name='my_notes'),
+    path('notes/', read_views.my_notes, name='my_notes'),
+    path('notes/json/', views.my_notes_json, name='my_notes_json'),
+    path('notes/bulk/send/', views.bulk_send_notes, name='bulk_send_notes'),
+    path('notes/bulk/delete/', views.bulk_delete_notes, name='bulk_delete_notes'),
+    path('notes/bulk/favorite/', views.bulk_favorite_notes, name='bulk_favorite_notes'),
+    
+    # Data export
+    path('export/<str:dataset>/', views.export_data, name='export_data'),
+    
+    # Notifications
+    path('notifications/', views.notifications, name='notifications'),
+    path('notifications/read/', views.mark_notifications_read, name='mark_notifications_read'),
+    path('notifications/read/all/', views.mark_all_notifications_read, name='mark_all_notifications_read'),
+    
+    # Live notifications (Server-Sent Events); 404 unless KAGAI_EVENTS is
+    # enabled and the request came in over ASGI
+    path('events/', async_views.events, name='events'),
     
     # Connections
     path('connect/<str:recipient_username>/', views.send_connection_request, name='send_connection_request'),
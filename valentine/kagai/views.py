@@ -1,27 +1,41 @@
+import json
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, F, FilteredRelation, Max, OuterRef, Prefetch, Q, Subquery
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.views.decorators.http import require_POST
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 
-from .models import UserProfile, LoveNote, Connection, Favorite
+from . import cache, events, exports, graph
+from .conditional import conditional_page, latest
+from .images import delete_avatar_variants
+from .models import (
+    UserProfile, LoveNote, Connection, Favorite, UserStats, UserInterest, ImageJob, Notification,
+    RecommendationQueue,
+)
+from .pagination import InvalidCursor, KeysetPaginator, ranked_page
+from .routers import read_from_replica
+from .search import bulk_removals, get_search_backend
 
 
 # ==================== Authentication Views ====================
 
+@read_from_replica
 def home(request):
     """Homepage view"""
     if request.user.is_authenticated:
         return redirect('kagai:dashboard')
     
-    context = {
+    context = cache.get_or_set(cache.GLOBAL_STATS, cache.make_key(cache.GLOBAL_STATS), lambda: {
         'total_notes': LoveNote.objects.filter(status='sent').count(),
         'total_users': User.objects.count(),
-    }
+    })
     return render(request, 'home.html', context)
 
 
@@ -108,39 +122,92 @@ def logout_view(request):
 
 # ==================== Dashboard & Main Views ====================
 
+def _dashboard_validators(request):
+    """What the dashboard shows besides the stats, which already track its recent notes"""
+    user = request.user
+    # Cached on the user for the view
+    profile = user.profile
+    suggestions = graph.get_graph().suggestions(user.id, limit=graph.config('SUGGESTIONS'))
+    return profile.updated_at, [profile.updated_at, suggestions]
+
+
 @login_required(login_url='kagai:login')
+@conditional_page(_dashboard_validators)
 def dashboard(request):
     """Main dashboard view"""
     user = request.user
     profile = user.profile
     
-    # Get statistics
-    sent_notes = LoveNote.objects.filter(sender=user, status='sent').count()
-    received_notes = LoveNote.objects.filter(recipient=user, status='sent').count()
-    connections = Connection.objects.filter(
-        Q(user1=user, status='accepted') | Q(user2=user, status='accepted')
-    ).count()
-    pending_requests = Connection.objects.filter(user2=user, status='pending').count()
-    
-    # Recent notes
-    recent_received = LoveNote.objects.filter(
-        recipient=user, status='sent'
-    ).order_by('-created_at')[:5]
+    # Statistics (kept up to date by the note and connection views) and
+    # recent notes are only loaded when their cached fragments miss
+    stats = getattr(request, 'kagai_stats', None) or SimpleLazyObject(lambda: UserStats.for_user(user))
+    # Shared with the navbar's unread badge
+    request.kagai_stats = stats
+    recent_received = LoveNote.objects.for_inbox(user).filter(status='sent').order_by('-created_at')[:5]
     
     context = {
         'profile': profile,
-        'sent_notes': sent_notes,
-        'received_notes': received_notes,
-        'connections': connections,
-        'pending_requests': pending_requests,
+        'stats': stats,
         'recent_received': recent_received,
+        'suggestions': SimpleLazyObject(lambda: _suggested_users(user)),
     }
     return render(request, 'dashboard.html', context)
 
 
+def _suggested_users(user):
+    """People the user's connections know, ranked in memory by the connection graph"""
+    suggestions = graph.get_graph().suggestions(user.id, limit=graph.config('SUGGESTIONS'))
+    if not suggestions:
+        return []
+    users = User.objects.in_bulk([user_id for user_id, _ in suggestions])
+    people = []
+    for user_id, mutual in suggestions:
+        if user_id in users:
+            users[user_id].mutual_count = mutual
+            people.append(users[user_id])
+    return people
+
+
+def _mutual_connections(user, other, shown=3):
+    """Count of the connections two users share, and the first few of them"""
+    mutual = graph.get_graph().mutual(user.id, other.id)
+    return len(mutual), SimpleLazyObject(
+        lambda: list(User.objects.filter(pk__in=mutual[:shown]).order_by('username')) if mutual else []
+    )
+
+
 # ==================== Profile Views ====================
 
+def _profile_validators(request, username):
+    """The profile's own fields, the connection between the two users and graph counts"""
+    pair = (
+        Q(user1=request.user, user2=OuterRef('pk')) | Q(user1=OuterRef('pk'), user2=request.user)
+    )
+    connection = Connection.objects.filter(pair).order_by()[:1]
+    row = (
+        User.objects.filter(username=username)
+        .annotate(
+            connection_user1=Subquery(connection.values('user1_id')),
+            connection_status=Subquery(connection.values('status')),
+            connection_updated_at=Subquery(connection.values('updated_at')),
+        )
+        .values_list(
+            'id', 'first_name', 'profile__updated_at',
+            'connection_user1', 'connection_status', 'connection_updated_at',
+        )
+        .first()
+    )
+    if row is None:
+        return None
+    user_id, updated_at, connection_updated_at = row[0], row[2], row[5]
+    connection_graph = graph.get_graph()
+    state = [row, connection_graph.degree(user_id), connection_graph.mutual(request.user.id, user_id)]
+    return latest(updated_at, connection_updated_at), state
+
+
+@read_from_replica
 @login_required(login_url='kagai:login')
+@conditional_page(_profile_validators)
 def profile(request, username):
     """View user profile"""
     user_obj = get_object_or_404(User, username=username)
@@ -152,20 +219,29 @@ def profile(request, username):
     is_pending = False
     
     if request.user != user_obj:
-        connection = Connection.objects.filter(
-            Q(user1=request.user, user2=user_obj) | Q(user1=user_obj, user2=request.user)
-        ).first()
+        connection = Connection.between(request.user, user_obj)
         
         if connection:
             is_friend = connection.status == 'accepted'
             is_pending = connection.status == 'pending'
     
+    # Both come from the in-memory connection graph, not the database
+    mutual_count, mutual_connections = (
+        _mutual_connections(request.user, user_obj) if request.user != user_obj else (0, [])
+    )
+    
     context = {
         'profile_user': user_obj,
         'profile': profile,
+        'interests': SimpleLazyObject(lambda: sorted(
+            profile.profile_interests.select_related('interest'), key=lambda tag: tag.position
+        )),
         'connection': connection,
         'is_friend': is_friend,
         'is_pending': is_pending,
+        'connection_count': graph.get_graph().degree(user_obj.id),
+        'mutual_count': mutual_count,
+        'mutual_connections': mutual_connections,
     }
     return render(request, 'profile.html', context)
 
@@ -178,22 +254,28 @@ def edit_profile(request):
     if request.method == 'POST':
         profile.bio = request.POST.get('bio', '')
         profile.location = request.POST.get('location', '')
-        profile.interests = request.POST.get('interests', '')
         profile.website = request.POST.get('website', '')
         profile.phone = request.POST.get('phone', '')
         profile.gender = request.POST.get('gender', '')
         
-        # Handle avatar upload
+        # Handle avatar upload; resizing happens in the process_image_jobs worker
+        old_variants = None
         if 'avatar' in request.FILES:
             profile.avatar = request.FILES['avatar']
+            old_variants, profile.avatar_variants = profile.avatar_variants, {}
         
-        profile.save()
+        with transaction.atomic():
+            profile.set_interests(request.POST.get('interests', ''))
+            profile.save()
+            if old_variants is not None:
+                ImageJob.objects.create(profile=profile, source=profile.avatar.name)
+                transaction.on_commit(lambda: delete_avatar_variants(old_variants))
         
         # Update user info
         request.user.first_name = request.POST.get('first_name', '')
         request.user.last_name = request.POST.get('last_name', '')
         request.user.email = request.POST.get('email', '')
-        request.user.save()
+        request.user.save(update_fields=['first_name', 'last_name', 'email'])
         
         messages.success(request, 'Profile updated successfully!')
         return redirect('kagai:profile', username=request.user.username)
@@ -224,15 +306,28 @@ def send_note(request, recipient_username):
             messages.error(request, 'Note content cannot be empty')
             return redirect('kagai:send_note', recipient_username=recipient_username)
         
-        note = LoveNote.objects.create(
-            sender=request.user,
-            recipient=recipient,
-            title=title,
-            content=content,
-            is_anonymous=is_anonymous,
-            status='sent',
-            sent_at=timezone.now()
-        )
+        with transaction.atomic():
+            note = LoveNote.objects.create(
+                sender=request.user,
+                recipient=recipient,
+                title=title,
+                content=content,
+                is_anonymous=is_anonymous,
+                status='sent',
+                sent_at=timezone.now()
+            )
+            UserStats.bump(request.user, sent_notes=1, total_sent_notes=1)
+            UserStats.bump(recipient, received_notes=1, total_received_notes=1)
+            Notification.notify(
+                recipient, 'note', actor=None if note.is_anonymous else request.user, note=note,
+            )
+            events.publish(
+                recipient.id, 'note',
+                id=note.id,
+                title=note.title,
+                sender=None if note.is_anonymous else request.user.username,
+                deltas={'received_notes': 1, 'total_received_notes': 1, 'unread_notifications': 1},
+            )
         
         messages.success(request, 'Love note sent successfully! 💌')
         return redirect('kagai:dashboard')
@@ -243,66 +338,482 @@ def send_note(request, recipient_username):
     return render(request, 'send_note.html', context)
 
 
+def _view_note_validators(request, note_id):
+    """The note, its favorite flag and the sender's profile, for its sender or recipient"""
+    note = (
+        LoveNote.objects.filter(id=note_id).order_by().with_favorite(request.user)
+        .values('sender_id', 'recipient_id', 'status', 'opened_at', 'emoji_reaction', 'is_favorite',
+                'sender__first_name', 'sender__profile__updated_at')
+        .first()
+    )
+    if note is None or request.user.id not in (note['sender_id'], note['recipient_id']):
+        return None
+    # The recipient's first view marks the note opened; always run it
+    if request.user.id == note['recipient_id'] and note['status'] == 'sent':
+        return None
+    return latest(note['opened_at'], note['sender__profile__updated_at']), note
+
+
 @login_required(login_url='kagai:login')
+@conditional_page(_view_note_validators)
 def view_note(request, note_id):
     """View a specific love note"""
-    note = get_object_or_404(LoveNote, id=note_id)
+    notes = LoveNote.objects.with_people().with_favorite(request.user)
+    note = get_object_or_404(notes, id=note_id)
     
     # Check if user has permission to view
-    if request.user != note.recipient and request.user != note.sender:
+    if request.user.id not in (note.recipient_id, note.sender_id):
         messages.error(request, 'You do not have permission to view this note')
         return redirect('kagai:dashboard')
     
     # Mark as opened if recipient is viewing
-    if request.user == note.recipient and note.status == 'sent':
-        note.status = 'opened'
-        note.opened_at = timezone.now()
-        note.save()
+    if request.user.id == note.recipient_id and note.status == 'sent':
+        _mark_opened(note)
     
     sender_profile = note.sender.profile if not note.is_anonymous else None
-    is_favorite = Favorite.objects.filter(user=request.user, note=note).exists()
     
     context = {
         'note': note,
         'sender_profile': sender_profile,
-        'is_favorite': is_favorite,
+        'is_favorite': note.is_favorite,
     }
     return render(request, 'view_note.html', context)
 
 
+def _mark_opened(note):
+    """Record that the recipient has read ``note``"""
+    note.status = 'opened'
+    note.opened_at = timezone.now()
+    with transaction.atomic():
+        note.save(update_fields=['status', 'opened_at'])
+        UserStats.bump(note.sender, sent_notes=-1)
+        UserStats.bump(note.recipient, received_notes=-1)
+        _mark_notifications_read(note.recipient, note=note, kind='note')
+
+
+NOTES_PER_PAGE = 24
+NOTE_ORDERING = ('-created_at', '-id')
+
+
+def _notes_queryset(user, box):
+    if box == 'sent':
+        return LoveNote.objects.for_outbox(user)
+    return LoveNote.objects.for_inbox(user)
+
+
+def _notes_page(user, box, cursor=None, query=''):
+    """Return one page of a user's received or sent notes, optionally searched"""
+    notes = _notes_queryset(user, box)
+    
+    if query:
+        def search(limit, offset):
+            return get_search_backend().search_notes(user, query, box=box, limit=limit, offset=offset)
+        return ranked_page(search, notes, cursor, per_page=NOTES_PER_PAGE)
+    
+    return KeysetPaginator(notes, NOTE_ORDERING, per_page=NOTES_PER_PAGE).page(cursor)
+
+
+def _note_json(note, box):
+    """Serialize a note for the JSON listing endpoints"""
+    data = {
+        'id': note.id,
+        'title': note.title,
+        'content': note.content,
+        'status': note.status,
+        'is_anonymous': note.is_anonymous,
+        'created_at': note.created_at.isoformat(),
+        'is_favorite': note.is_favorite,
+    }
+    if box == 'sent':
+        data['recipient'] = note.recipient.username
+    else:
+        data['sender'] = None if note.is_anonymous else note.sender.username
+    return data
+
+
+def _my_notes_validators(request):
+    """Counts and newest changes of the user's notes and the favorites among them"""
+    user = request.user
+    notes = (
+        LoveNote.objects.filter(Q(sender=user) | Q(recipient=user))
+        # At most one favorite per note and user, so nothing is counted twice
+        .annotate(favorite=FilteredRelation('favorited_by', condition=Q(favorited_by__user=user)))
+        .aggregate(
+            received=Count('id', filter=Q(recipient=user)),
+            sent=Count('id', filter=Q(sender=user)),
+            created_at=Max('created_at'),
+            opened_at=Max('opened_at'),
+            favorites=Count('favorite'),
+            favorited_at=Max('favorite__created_at'),
+        )
+    )
+    return latest(notes['created_at'], notes['opened_at'], notes['favorited_at']), notes
+
+
+@read_from_replica
 @login_required(login_url='kagai:login')
+@conditional_page(_my_notes_validators)
 def my_notes(request):
     """View all user's notes"""
-    sent_notes = LoveNote.objects.filter(sender=request.user).order_by('-created_at')
-    received_notes = LoveNote.objects.filter(recipient=request.user).order_by('-created_at')
+    query = request.GET.get('q', '').strip()
+    received_cursor = request.GET.get('received', '')
+    sent_cursor = request.GET.get('sent', '')
+    
+    try:
+        received_notes = _notes_page(request.user, 'received', received_cursor, query)
+        sent_notes = _notes_page(request.user, 'sent', sent_cursor, query)
+    except InvalidCursor:
+        messages.error(request, 'That page link is no longer valid')
+        return redirect('kagai:my_notes')
+    
+    # Usually loaded already for the ETag
+    stats = getattr(request, 'kagai_stats', None) or UserStats.for_user(request.user)
+    request.kagai_stats = stats
     
     context = {
         'sent_notes': sent_notes,
         'received_notes': received_notes,
+        'sent_cursor': sent_cursor,
+        'received_cursor': received_cursor,
+        'query': query,
+        'total_sent': stats.total_sent_notes,
+        'total_received': stats.total_received_notes,
     }
     return render(request, 'my_notes.html', context)
 
 
+@read_from_replica
+@login_required(login_url='kagai:login')
+def my_notes_json(request):
+    """JSON variant of my_notes: one page of received or sent notes"""
+    box = request.GET.get('box', 'received')
+    if box not in ('received', 'sent'):
+        return JsonResponse({'error': 'Unknown box'}, status=400)
+    
+    try:
+        page = _notes_page(request.user, box, request.GET.get('cursor'), request.GET.get('q', '').strip())
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    return JsonResponse({
+        'results': [_note_json(note, box) for note in page],
+        'next_cursor': page.next_cursor,
+    })
+
+
 @login_required(login_url='kagai:login')
 @require_POST
 def toggle_favorite(request, note_id):
     """Toggle favorite status of a note"""
     note = get_object_or_404(LoveNote, id=note_id)
     
-    if request.user != note.recipient and request.user != note.sender:
+    if request.user.id not in (note.recipient_id, note.sender_id):
         return JsonResponse({'error': 'Permission denied'}, status=403)
     
-    favorite, created = Favorite.objects.get_or_create(user=request.user, note=note)
-    
-    if not created:
-        favorite.delete()
-        return JsonResponse({'favorited': False})
+    # One conditional DELETE, else one INSERT ... ON CONFLICT DO NOTHING, so
+    # concurrent double clicks never trip the unique constraint
+    with transaction.atomic():
+        if Favorite.objects.filter(user=request.user, note=note).delete()[0]:
+            return JsonResponse({'favorited': False})
+        
+        if not Favorite.add(request.user, note):
+            # A concurrent click favorited it first
+            return JsonResponse({'favorited': True})
+        
+        # Let the sender know their note was loved
+        if request.user.id == note.recipient_id and note.sender_id != note.recipient_id:
+            Notification.notify(note.sender, 'favorite', actor=request.user, note=note)
+            events.publish(
+                note.sender_id, 'favorite',
+                id=note.id,
+                title=note.title,
+                user=request.user.username,
+                deltas={'unread_notifications': 1},
+            )
     
     return JsonResponse({'favorited': True})
 
 
+# ==================== Bulk Note API ====================
+
+BULK_MAX_ITEMS = 100
+
+
+class BulkRequestError(ValueError):
+    pass
+
+
+def _bulk_payload(request, key):
+    """
+    Read a bulk request: a JSON object, or form fields with ``key`` repeated.
+    Returns the payload and its ``key`` list.
+    """
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            raise BulkRequestError('The request body is not valid JSON')
+        if not isinstance(payload, dict):
+            raise BulkRequestError('The request body must be a JSON object')
+    else:
+        payload = {**request.POST.dict(), key: request.POST.getlist(key)}
+    
+    items = payload.get(key)
+    if not isinstance(items, list) or not items:
+        raise BulkRequestError(f'{key} must be a non-empty list')
+    if len(items) > BULK_MAX_ITEMS:
+        raise BulkRequestError(f'At most {BULK_MAX_ITEMS} {key} per request')
+    return payload, items
+
+
+def _flag(value, default=False):
+    """A boolean sent as JSON or as a form value"""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'on', 'yes')
+    return value is True
+
+
+def _note_id(value):
+    """A note id from the request, or None when it is not one"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+def _bulk_notes(user, values):
+    """
+    Check each posted note id against the notes ``user`` sent or received,
+    with one query. Returns ``[(value, note_id, note or None, error)]`` in
+    request order, where ``note`` is an id/sender/recipient tuple.
+    """
+    ids = [_note_id(value) for value in values]
+    found = {
+        note[0]: note
+        for note in LoveNote.objects.filter(id__in={i for i in ids if i is not None})
+        .values_list('id', 'sender_id', 'recipient_id')
+    }
+    checked, seen = [], set()
+    for value, note_id in zip(values, ids):
+        note = found.get(note_id)
+        if note_id is None:
+            error = 'invalid'
+        elif note is None:
+            error = 'not_found'
+        elif user.id not in (note[1], note[2]):
+            error = 'forbidden'
+        elif note_id in seen:
+            error = 'duplicate'
+        else:
+            error = None
+            seen.add(note_id)
+        checked.append((value, note_id, None if error else note, error))
+    return checked
+
+
+@login_required(login_url='kagai:login')
+@require_POST
+def bulk_send_notes(request):
+    """Send one note to several recipients with a single INSERT per table"""
+    try:
+        payload, usernames = _bulk_payload(request, 'recipients')
+    except BulkRequestError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    
+    title = str(payload.get('title') or '')
+    content = str(payload.get('content') or '')
+    is_anonymous = _flag(payload.get('is_anonymous'))
+    if not content.strip():
+        return JsonResponse({'error': 'Note content cannot be empty'}, status=400)
+    if len(title) > LoveNote._meta.get_field('title').max_length:
+        return JsonResponse({'error': 'The title is too long'}, status=400)
+    
+    recipients = User.objects.in_bulk([name for name in usernames if isinstance(name, str)], field_name='username')
+    now = timezone.now()
+    results, notes = [], []
+    for username in usernames:
+        recipient = recipients.get(username) if isinstance(username, str) else None
+        if recipient is None:
+            results.append({'recipient': username, 'error': 'not_found'})
+        elif recipient.id == request.user.id:
+            results.append({'recipient': username, 'error': 'self'})
+        elif any(note.recipient_id == recipient.id for note in notes):
+            results.append({'recipient': username, 'error': 'duplicate'})
+        else:
+            notes.append(LoveNote(
+                sender=request.user,
+                recipient=recipient,
+                title=title,
+                content=content,
+                is_anonymous=is_anonymous,
+                status='sent',
+                sent_at=now,
+            ))
+            results.append({'recipient': username, 'note': notes[-1]})
+    
+    if notes:
+        with transaction.atomic():
+            # bulk_create sends no post_save, so do what the signal handlers would
+            LoveNote.objects.bulk_create(notes)
+            UserStats.bump(request.user, sent_notes=len(notes), total_sent_notes=len(notes))
+            UserStats.bump_many(
+                [note.recipient_id for note in notes], received_notes=1, total_received_notes=1,
+            )
+            Notification.notify_many([
+                Notification(user_id=note.recipient_id, kind='note', actor=None if is_anonymous else request.user,
+                             note=note)
+                for note in notes
+            ])
+            get_search_backend().index_notes(notes)
+            cache.invalidate_global_stats()
+            cache.invalidate_dashboard(request.user.id, *(note.recipient_id for note in notes))
+            for note in notes:
+                events.publish(
+                    note.recipient_id, 'note',
+                    id=note.id,
+                    title=note.title,
+                    sender=None if is_anonymous else request.user.username,
+                    deltas={'received_notes': 1, 'total_received_notes': 1, 'unread_notifications': 1},
+                )
+    
+    for result in results:
+        note = result.pop('note', None)
+        if note is not None:
+            result.update(id=note.id, status='sent')
+    return JsonResponse({'sent': len(notes), 'results': results})
+
+
+@login_required(login_url='kagai:login')
+@require_POST
+def bulk_delete_notes(request):
+    """Delete several notes the user sent or received with a single DELETE"""
+    try:
+        _, values = _bulk_payload(request, 'ids')
+    except BulkRequestError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    
+    checked = _bulk_notes(request.user, values)
+    notes = [note for _, _, note, _ in checked if note]
+    if notes:
+        ids = [note[0] for note in notes]
+        with transaction.atomic(), bulk_removals():
+            # Notifications about the notes are moot; drop them before the
+            # counters are rebuilt from what is left
+            Notification.objects.filter(note_id__in=ids).delete()
+            LoveNote.objects.filter(id__in=ids).delete()
+            UserStats.rebuild({user_id for note in notes for user_id in note[1:]})
+    
+    results = [
+        {'id': value, 'error': error} if error else {'id': note_id, 'status': 'deleted'}
+        for value, note_id, _, error in checked
+    ]
+    return JsonResponse({'deleted': len(notes), 'results': results})
+
+
+@login_required(login_url='kagai:login')
+@require_POST
+def bulk_favorite_notes(request):
+    """
+    Favorite (or with ``"favorite": false``, unfavorite) several notes with
+    one INSERT or DELETE
+    """
+    try:
+        payload, values = _bulk_payload(request, 'ids')
+    except BulkRequestError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    
+    favorite = _flag(payload.get('favorite'), default=True)
+    checked = _bulk_notes(request.user, values)
+    allowed = [note for _, _, note, _ in checked if note]
+    
+    if favorite:
+        with transaction.atomic():
+            # Only rows the INSERT really added count: a concurrent request
+            # may have favorited some of the notes since they were checked
+            created = Favorite.add_many(request.user, [note[0] for note in allowed])
+            changed = [note for note in allowed if note[0] in created]
+            # Let the senders know their notes were loved
+            loved = [note for note in changed if note[2] == request.user.id and note[1] != request.user.id]
+            Notification.notify_many([
+                Notification(user_id=note[1], kind='favorite', actor=request.user, note_id=note[0])
+                for note in loved
+            ])
+        for note in loved:
+            events.publish(
+                note[1], 'favorite',
+                id=note[0],
+                user=request.user.username,
+                deltas={'unread_notifications': 1},
+            )
+    else:
+        existing = set(
+            Favorite.objects.filter(user=request.user, note_id__in=[note[0] for note in allowed])
+            .values_list('note_id', flat=True)
+        ) if allowed else set()
+        changed = [note for note in allowed if note[0] in existing]
+        if changed:
+            Favorite.objects.filter(user=request.user, note_id__in=[note[0] for note in changed]).delete()
+    
+    status = 'favorited' if favorite else 'unfavorited'
+    changed_ids = {note[0] for note in changed}
+    results = [
+        {'id': value, 'error': error} if error
+        else {'id': note_id, 'status': status if note_id in changed_ids else 'unchanged'}
+        for value, note_id, _, error in checked
+    ]
+    return JsonResponse({status: len(changed), 'results': results})
+
+
+# ==================== Data Export ====================
+
+@read_from_replica
+@login_required(login_url='kagai:login')
+def export_data(request, dataset):
+    """Download all of the user's notes or connections as JSON Lines or CSV, optionally gzipped"""
+    if dataset not in exports.DATASETS:
+        raise Http404('Unknown export')
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in exports.FORMATS:
+        return JsonResponse({'error': f'format must be one of: {", ".join(exports.FORMATS)}'}, status=400)
+    
+    # Streamed as it is read; see kagai.exports
+    fields, rows = exports.DATASETS[dataset](request.user)
+    name = f'kagai-{request.user.username}-{dataset}'
+    return exports.response(request, name, fields, rows, fmt, compress=_flag(request.GET.get('gzip')))
+
+
 # ==================== Connection Views ====================
 
+def _delete_connection(connection):
+    """
+    Delete a connection and roll back the counters it contributed to.
+    Returns False if its status changed since it was loaded.
+    """
+    with transaction.atomic():
+        # Unread notifications about it are moot once it is gone; clear them
+        # while the connection still has its id
+        if connection.status == 'pending':
+            _mark_notifications_read(connection.user2, connection=connection)
+        elif connection.status == 'accepted':
+            _mark_notifications_read(connection.user1, connection=connection)
+        _, deleted = Connection.objects.filter(pk=connection.pk, status=connection.status).delete()
+        if not deleted.get(Connection._meta.label):
+            # A concurrent request removed or accepted it first
+            transaction.set_rollback(True)
+            return False
+        if connection.status == 'pending':
+            UserStats.bump(connection.user2, pending_requests=-1)
+        elif connection.status == 'accepted':
+            UserStats.bump(connection.user1, connections=-1)
+            UserStats.bump(connection.user2, connections=-1)
+    return True
+
+
 @login_required(login_url='kagai:login')
 def send_connection_request(request, recipient_username):
     """Send a connection request"""
@@ -312,19 +823,24 @@ def send_connection_request(request, recipient_username):
         messages.error(request, 'You cannot connect with yourself')
         return redirect('kagai:profile', username=recipient_username)
     
-    # Check if connection already exists
-    existing = Connection.objects.filter(
-        Q(user1=request.user, user2=recipient) | Q(user1=recipient, user2=request.user)
-    ).first()
-    
-    if existing:
-        if existing.status == 'blocked':
-            messages.error(request, 'You blocked this user or they blocked you')
-        else:
-            messages.info(request, 'Connection already requested')
-        return redirect('kagai:profile', username=recipient_username)
-    
-    Connection.objects.create(user1=request.user, user2=recipient)
+    with transaction.atomic():
+        connection = Connection.request(request.user, recipient)
+        if connection is None:
+            existing = Connection.between(request.user, recipient)
+            if existing and existing.status == 'blocked':
+                messages.error(request, 'You blocked this user or they blocked you')
+            else:
+                messages.info(request, 'Connection already requested')
+            return redirect('kagai:profile', username=recipient_username)
+        
+        UserStats.bump(recipient, pending_requests=1)
+        Notification.notify(recipient, 'connection_request', actor=request.user, connection=connection)
+        events.publish(
+            recipient.id, 'connection_request',
+            id=connection.id,
+            sender=request.user.username,
+            deltas={'pending_requests': 1, 'unread_notifications': 1},
+        )
     messages.success(request, 'Connection request sent!')
     return redirect('kagai:profile', username=recipient_username)
 
@@ -336,12 +852,30 @@ def accept_connection(request, connection_id):
     
     if request.user != connection.user2:
         messages.error(request, 'You do not have permission')
-        return redirect('dashboard')
+        return redirect('kagai:dashboard')
     
-    connection.status = 'accepted'
-    connection.save()
+    # Only the request that moves it out of pending counts it; a repeated
+    # accept updates nothing
+    with transaction.atomic():
+        if Connection.transition(connection.id, 'pending', 'accepted', user2=request.user):
+            connection.status = 'accepted'
+            cache.invalidate_dashboard(connection.user1_id, connection.user2_id)
+            graph.connect(connection.user1_id, connection.user2_id)
+            RecommendationQueue.enqueue([connection.user1_id, connection.user2_id])
+            UserStats.bump(connection.user1, connections=1)
+            UserStats.bump(connection.user2, connections=1, pending_requests=-1)
+            _mark_notifications_read(connection.user2, connection=connection)
+            Notification.notify(
+                connection.user1, 'connection_accepted', actor=connection.user2, connection=connection,
+            )
+            events.publish(
+                connection.user1_id, 'connection_accepted',
+                id=connection.id,
+                user=connection.user2.username,
+                deltas={'connections': 1, 'unread_notifications': 1},
+            )
     messages.success(request, f'You are now connected with {connection.user1.username}! 💕')
-    return redirect('dashboard')
+    return redirect('kagai:dashboard')
 
 
 @login_required(login_url='kagai:login')
@@ -351,10 +885,12 @@ def reject_connection(request, connection_id):
     
     if request.user != connection.user2:
         messages.error(request, 'You do not have permission')
-        return redirect('dashboard')
+        return redirect('kagai:dashboard')
     
-    connection.delete()
-    messages.success(request, 'Connection request rejected')
+    if _delete_connection(connection):
+        messages.success(request, 'Connection request rejected')
+    else:
+        messages.info(request, 'That request has already been answered')
     return redirect('kagai:dashboard')
 
 
@@ -367,41 +903,255 @@ def remove_connection(request, connection_id):
         messages.error(request, 'You do not have permission')
         return redirect('kagai:dashboard')
     
-    connection.delete()
-    messages.success(request, 'Connection removed')
+    if _delete_connection(connection):
+        messages.success(request, 'Connection removed')
+    else:
+        messages.info(request, 'That connection has already changed')
     return redirect('kagai:dashboard')
 
 
-# ==================== Browse & Discover ====================
+# ==================== Notifications ====================
+
+NOTIFICATIONS_PER_PAGE = 30
+NOTIFICATION_ORDERING = ('-created_at', '-id')
+
+
+def _mark_notifications_read(user, ids=None, **filters):
+    """Mark notifications read and tell the user's other open pages"""
+    count = Notification.mark_read(user, ids, **filters)
+    if count:
+        events.publish(user.id, 'notifications_read', deltas={'unread_notifications': -count})
+    return count
+
 
 @login_required(login_url='kagai:login')
-def browse_users(request):
-    """Browse other users"""
-    query = request.GET.get('q', '')
-    gender = request.GET.get('gender', '')
-    sort = request.GET.get('sort', '-created_at')
-    
-    users = User.objects.exclude(id=request.user.id).prefetch_related('profile')
+def notifications(request):
+    """View the user's notifications, newest first"""
+    notifications = Notification.objects.filter(user=request.user).select_related('actor', 'note', 'connection')
     
-    if query:
-        users = users.filter(
-            Q(username__icontains=query) | Q(first_name__icontains=query)
+    try:
+        page = KeysetPaginator(notifications, NOTIFICATION_ORDERING, per_page=NOTIFICATIONS_PER_PAGE).page(
+            request.GET.get('cursor')
         )
+    except InvalidCursor:
+        messages.error(request, 'That page link is no longer valid')
+        return redirect('kagai:notifications')
+    
+    context = {
+        'notifications': page,
+        'cursor': request.GET.get('cursor', ''),
+    }
+    return render(request, 'notifications.html', context)
+
+
+def _notification_ids(request):
+    """
+    Notification ids posted as a JSON body (``{"ids": [...]}``) or form
+    fields. Raises ValueError unless every one is an id.
+    """
+    if request.content_type == 'application/json':
+        payload = json.loads(request.body or b'{}')
+        if not isinstance(payload, dict):
+            raise ValueError('Expected a JSON object')
+        ids = payload.get('ids', [])
+        if not isinstance(ids, list):
+            raise ValueError('ids must be a list')
+    else:
+        ids = request.POST.getlist('ids')
+    # Ids are checked like note ids: JSON true/false are not 1 and 0
+    ids = [_note_id(value) for value in ids]
+    if None in ids:
+        raise ValueError('ids must be integers')
+    return ids
+
+
+def _notifications_read_response(request, count):
+    if request.content_type == 'application/json' or request.headers.get('Accept') == 'application/json':
+        return JsonResponse({'marked': count})
+    if count:
+        messages.success(request, f'Marked {count} notification(s) as read')
+    return redirect('kagai:notifications')
+
+
+@login_required(login_url='kagai:login')
+@require_POST
+def mark_notifications_read(request):
+    """Mark the posted notifications as read with a single UPDATE"""
+    try:
+        ids = _notification_ids(request)
+    except ValueError:
+        return JsonResponse({'error': 'ids must be a list of integers'}, status=400)
     
-    if gender and gender != 'all':
+    count = _mark_notifications_read(request.user, ids) if ids else 0
+    return _notifications_read_response(request, count)
+
+
+@login_required(login_url='kagai:login')
+@require_POST
+def mark_all_notifications_read(request):
+    """Mark every unread notification as read with a single UPDATE"""
+    count = _mark_notifications_read(request.user)
+    return _notifications_read_response(request, count)
+
+
+# ==================== Browse & Discover ====================
+
+USERS_PER_PAGE = 30
+
+# Accepted values of the ``sort`` parameter, mapped to a keyset ordering
+# whose last field is unique
+BROWSE_SORTS = {
+    'recommended': ('recommendation_rank',),
+    '-created_at': ('-date_joined', '-id'),
+    'created_at': ('date_joined', 'id'),
+    'username': ('username',),
+    'overlap': ('-overlap', '-id'),
+}
+DEFAULT_BROWSE_SORT = 'recommended'
+# Used when the chosen sort has nothing to go on, e.g. before the first
+# recommend_users run or for a user without interests
+FALLBACK_BROWSE_SORT = '-created_at'
+
+# Interest tags shown on each card; templates sort them by position in
+# Python so the prefetch query needs no ORDER BY
+INTEREST_PREFETCH = Prefetch(
+    'profile__profile_interests',
+    queryset=UserInterest.objects.select_related('interest'),
+)
+
+
+def _browse_params(request):
+    """Read and sanitize the browse_users filters"""
+    sort = request.GET.get('sort', DEFAULT_BROWSE_SORT)
+    if sort not in BROWSE_SORTS:
+        sort = DEFAULT_BROWSE_SORT
+    return {
+        'query': request.GET.get('q', '').strip(),
+        'gender': request.GET.get('gender', ''),
+        'interest': request.GET.get('interest', '').strip(),
+        'sort': sort,
+    }
+
+
+def _browse_queryset(user, params):
+    """Other users matching the interest filter, with everything a card renders"""
+    users = User.objects.exclude(id=user.id).select_related('profile').prefetch_related(INTEREST_PREFETCH)
+    if params['interest']:
+        users = users.filter(profile__profile_interests__interest__slug=params['interest'])
+    return users
+
+
+def _with_overlap(users, interest_ids):
+    """Keep users sharing any of ``interest_ids`` and annotate how many they share"""
+    shared = UserInterest.objects.filter(interest_id__in=interest_ids)
+    overlap = (shared.filter(profile=OuterRef('profile')).order_by()
+               .values('profile').annotate(total=Count('*')).values('total'))
+    return users.filter(profile__in=shared.values('profile')).annotate(overlap=Subquery(overlap))
+
+
+def _with_recommendations(users, user):
+    """Keep the users recommended to ``user``, annotated with why and in which rank"""
+    # Filtering first makes the annotations read the same joined row
+    return users.filter(recommended_to__user=user).annotate(
+        recommendation_rank=F('recommended_to__rank'),
+        shared_interests=F('recommended_to__shared_interests'),
+        shared_connections=F('recommended_to__shared_connections'),
+    )
+
+
+def _browse_page(user, params, cursor=None):
+    """Return one page of users matching the browse filters"""
+    users = _browse_queryset(user, params)
+    gender = params['gender'] if params['gender'] != 'all' else ''
+    
+    # Searches are ordered by relevance from the search index
+    if params['query']:
+        def search(limit, offset):
+            return get_search_backend().search_users(
+                params['query'], exclude_id=user.id, gender=gender, interest=params['interest'],
+                limit=limit, offset=offset,
+            )
+        return ranked_page(search, users, cursor, per_page=USERS_PER_PAGE)
+    
+    if gender:
         users = users.filter(profile__gender=gender)
     
-    users = users.order_by(sort)[:50]
+    sort = params['sort']
+    if sort == 'recommended':
+        page = KeysetPaginator(
+            _with_recommendations(users, user), BROWSE_SORTS[sort], per_page=USERS_PER_PAGE
+        ).page(cursor)
+        if page or cursor:
+            return page
+        sort = FALLBACK_BROWSE_SORT
+    elif sort == 'overlap':
+        mine = list(
+            UserInterest.objects.filter(profile__user=user).values_list('interest_id', flat=True)
+        )
+        if mine:
+            users = _with_overlap(users, mine)
+        else:
+            sort = FALLBACK_BROWSE_SORT
+    
+    # Page links must carry the sort their cursor was made for
+    params['sort'] = sort
+    return KeysetPaginator(users, BROWSE_SORTS[sort], per_page=USERS_PER_PAGE).page(cursor)
+
+
+@read_from_replica
+@login_required(login_url='kagai:login')
+def browse_users(request):
+    """Browse other users"""
+    params = _browse_params(request)
+    
+    try:
+        users = _browse_page(request.user, params, request.GET.get('cursor'))
+    except InvalidCursor:
+        messages.error(request, 'That page link is no longer valid')
+        return redirect('kagai:browse_users')
     
     context = {
         'users': users,
-        'query': query,
-        'gender': gender,
-        'sort': sort,
+        'query': params['query'],
+        'gender': params['gender'],
+        'interest': params['interest'],
+        'sort': params['sort'],
     }
     return render(request, 'browse_users.html', context)
 
 
+@read_from_replica
+@login_required(login_url='kagai:login')
+def browse_users_json(request):
+    """JSON variant of browse_users"""
+    params = _browse_params(request)
+    
+    try:
+        users = _browse_page(request.user, params, request.GET.get('cursor'))
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    results = []
+    for user_obj in users:
+        profile = getattr(user_obj, 'profile', None)
+        results.append({
+            'username': user_obj.username,
+            'first_name': user_obj.first_name,
+            'location': profile.location if profile else '',
+            'bio': profile.bio if profile else '',
+            'avatar': profile.avatar_url('thumb') if profile else None,
+            'interests': [
+                tag.interest.name
+                for tag in sorted(profile.profile_interests.all(), key=lambda tag: tag.position)
+            ] if profile else [],
+        })
+        if hasattr(user_obj, 'recommendation_rank'):
+            results[-1]['shared_interests'] = user_obj.shared_interests
+            results[-1]['shared_connections'] = user_obj.shared_connections
+    
+    return JsonResponse({'results': results, 'sort': params['sort'], 'next_cursor': users.next_cursor})
+
+
 def valentine_proposal(request):
     """Special Valentine's proposal page for Lucy"""
     context = {
@@ -8,6 +8,7 @@ document.addEventListener('DOMContentLoaded', function() {
     initializeTooltips();
     initializeFormValidation();
     initializeCharCounters();
+    initializeLiveEvents();
 });
 
 // ============ Tooltips ============
@@ -126,6 +127,58 @@ function showNotification(message, type = 'info') {
     }
 }
 
+// ============ Live Notifications ============
+// The server pushes an event whenever a note, connection request or favorite arrives.
+// Each one carries counter deltas, so badges update without a page reload.
+function initializeLiveEvents() {
+    const url = document.body.dataset.eventsUrl;
+    if (!url || !window.EventSource) {
+        return;
+    }
+
+    const source = new EventSource(url);
+    const messages = {
+        note: data => data.sender
+            ? `New love note from <strong>${escapeHtml(data.sender)}</strong> 💌`
+            : 'You received an anonymous love note 💌',
+        connection_request: data => `<strong>${escapeHtml(data.sender)}</strong> wants to connect`,
+        connection_accepted: data => `You are now connected with <strong>${escapeHtml(data.user)}</strong>! 💕`,
+        favorite: data => `<strong>${escapeHtml(data.user)}</strong> loved your note ⭐`
+    };
+
+    Object.entries(messages).forEach(([type, message]) => {
+        source.addEventListener(type, event => {
+            const data = JSON.parse(event.data);
+            applyCounterDeltas(data.deltas || {});
+            showNotification(message(data), 'info');
+        });
+    });
+
+    // Notifications read in another tab only change the badge
+    source.addEventListener('notifications_read', event => {
+        applyCounterDeltas(JSON.parse(event.data).deltas || {});
+    });
+}
+
+function applyCounterDeltas(deltas) {
+    Object.entries(deltas).forEach(([name, delta]) => {
+        document.querySelectorAll(`[data-live-stat="${name}"]`).forEach(el => {
+            el.textContent = (parseInt(el.textContent, 10) || 0) + delta;
+        });
+        document.querySelectorAll(`[data-live-badge="${name}"]`).forEach(el => {
+            const count = (parseInt(el.textContent, 10) || 0) + delta;
+            el.textContent = count;
+            el.classList.toggle('d-none', count <= 0);
+        });
+    });
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
 // ============ Image Preview ============
 function previewImage(input) {
     if (input.files && input.files[0]) {
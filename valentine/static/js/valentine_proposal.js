@@ -0,0 +1,54 @@
+// Valentine proposal page
+
+function showResponse() {
+    document.getElementById('responseMessage').classList.add('show');
+    triggerConfetti();
+    // Smooth scroll to message
+    setTimeout(() => {
+        document.getElementById('responseMessage').scrollIntoView({ behavior: 'smooth', block: 'start' });
+    }, 100);
+}
+
+function runAwayButton() {
+    const btn = event.target;
+    const randomX = Math.random() * 200 - 100;
+    const randomY = Math.random() * 200 - 100;
+    btn.style.position = 'relative';
+    btn.style.left = randomX + 'px';
+    btn.style.top = randomY + 'px';
+    btn.style.transition = 'all 0.3s ease';
+}
+
+function triggerConfetti() {
+    // Create confetti pieces
+    for (let i = 0; i < 50; i++) {
+        createConfetti();
+    }
+}
+
+function createConfetti() {
+    const confetti = document.createElement('div');
+    confetti.className = 'confetti';
+    confetti.innerHTML = ['❤️', '💕', '💖', '✨', '🎉', '🌹'][Math.floor(Math.random() * 6)];
+    confetti.style.left = Math.random() * window.innerWidth + 'px';
+    confetti.style.top = '-10px';
+    confetti.style.fontSize = Math.random() * 30 + 20 + 'px';
+    confetti.style.opacity = 1;
+    document.body.appendChild(confetti);
+
+    let top = 0;
+    const speed = Math.random() * 3 + 2;
+    const sway = Math.random() * 2 - 1;
+
+    const fall = setInterval(() => {
+        top += speed;
+        confetti.style.top = top + 'px';
+        confetti.style.left = (parseFloat(confetti.style.left) + sway) + 'px';
+        confetti.style.opacity = 1 - (top / window.innerHeight);
+
+        if (top > window.innerHeight) {
+            clearInterval(fall);
+            confetti.remove();
+        }
+    }, 10);
+}
@@ -3,6 +3,11 @@ ASGI config for valentine project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it with uvicorn locally or with gunicorn's uvicorn worker in production::
+
+    uvicorn valentine.asgi:application --reload
+    gunicorn valentine.asgi:application -c gunicorn_asgi.py
+
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 """
@@ -12,5 +17,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valentine.settings')
+os.environ.setdefault('KAGAI_ASYNC_VIEWS', 'true')
 
 application = get_asgi_application()